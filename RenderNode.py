@@ -16,78 +16,320 @@ import json
 import uuid
 import socket
 import sys
-from requests_toolbelt import MultipartEncoder
 import requests
 import argparse
-from node import RenderNode
+from node import RenderNode, RenderUploader, EventPublisher, SceneCache, ResourceMonitor
+from node import PhaseMetrics, MetricsServer, job_phases, RenderSpool, PostProcessor, RenderHistory
+from node import RendererLoader, ResultCache, InputPrefetcher
 import os 
 import traceback
+import shutil
 import socket
 import ConfigParser
-import importlib
+import signal
 import io
 import struct
+import random
+import functools
+from collections import OrderedDict
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            encoded_object = list(obj.timetuple())[0:6]
-        else:
-            encoded_object =json.JSONEncoder.default(self, obj)
-        return encoded_object
+def setting(config, option, default, section='settings'):
+    """Reads an optional setting, falling back to default when it is absent."""
+    if not config.has_option( section, option ):
+        return default
+    if isinstance( default, bool ):
+        return config.getboolean( section, option )
+    return type(default)( config.get( section, option ) )
+
+def read_region(region):
+    """Checks a tiled job's region, [xmin, xmax, ymin, ymax] in fractions of
+    the frame from its top left. None means the whole frame."""
+    if region == None:
+        return None
+    xmin, xmax, ymin, ymax = [ float(value) for value in region ]
+    if not ( 0.0 <= xmin < xmax <= 1.0 and 0.0 <= ymin < ymax <= 1.0 ):
+        raise ValueError( "invalid region {:s}".format( str(region) ) )
+    return ( xmin, xmax, ymin, ymax )
+
+def history_scene(job):
+    """Tiles take a fraction of a frame's time, so each region keeps its
+    own render history."""
+    if job.get( "region" ) == None:
+        return job["scene"]
+    return "{:s} {:s}".format( job["scene"], ",".join( "{:g}".format( value ) for value in job["region"] ) )
 
 class RenderWorker(object):
     
-    def __init__(self, comm_host, config ):
+    def __init__(self, comm_host, config, config_path=None ):
         self._comm_host = comm_host
         self._murl = config.get( 'settings', 'manager_url' );
+        self._events = EventPublisher( comm_host,
+                                       buffer_size = setting( config, 'event_buffer_size', 10000 ),
+                                       batch_size = setting( config, 'event_batch_size', 100 ) )
 
         # These are the communication members
         self._connection = None
         self.channel = None
-        self.active_queue = ""
-        self.active_queue_tag = None
+        self.active_queues = {}
+        # Counts broker connections, so deliveries from a lost one are told
+        # apart from (and never settled on) the current one
+        self._connection_id = 0
+        self._reconnect_interval = setting( config, 'reconnect_interval', 1.0 )
+        self._reconnect_max_interval = setting( config, 'reconnect_max_interval', 60.0 )
         self.queue_was_filled = False
         
-        # Load Renderer Modules
-        self._renderManager = RenderNode();
-        for module in config.options('modules'):
-            status = config.getboolean( 'modules', module )
-            if status:
-                print "Loading render module", module, "..."
-                mod = importlib.import_module(config.get(module,'module'))
-                renderer_args = dict( config.items(module))
-                renderer_args["scene_path"] = config.get('settings', 'scene_path' );
-                renderer = mod.BuildRenderer( renderer_args )
-                self._renderManager.register_renderer(renderer.NodeType(), renderer )
-
-        # periodic checks
+        # periodic checks; renderer exits and finished uploads wake the
+        # loop directly, these intervals are only the fallback
         self.last_render_check = datetime.datetime.now()
-        self.render_started = False
+        self.next_queue_poll = 0
+        self._render_check_interval = setting( config, 'render_check_interval', 1.0 )
+        self._queue_update_interval = setting( config, 'queue_update_interval', 5.0 )
+        self._queue_push_poll_interval = setting( config, 'queue_push_poll_interval', 60.0 )
+
+        # Job priority list: pushed over a fanout exchange when the manager
+        # publishes one, with conditional GETs of /available_jobs as fallback
+        self._job_exchange = setting( config, 'job_exchange', 'job_updates' )
+        self._consume_queues = max( 1, setting( config, 'consume_queues', 1 ) )
+        self._queue_policy = setting( config, 'queue_policy', 'strict' )
+        self._queue_rank = {}
+        self._job_channel = None
+        # Polling only slows down once the manager has actually pushed an update
+        self._job_updates_received = False
+        self._jobs_session = requests.Session()
+        self._jobs_etag = None
+        self._jobs = []
+        self._jobs_failures = 0
+        self._progress_interval = setting( config, 'progress_interval', 10.0 )
+        # node_status heartbeats go out every status_interval seconds and
+        # whenever a slot changes state
+        self._status_interval = setting( config, 'status_interval', 30.0 )
+        self._next_status = 0
+        self._last_status = None
         self._save_location = config.get( 'settings', 'save_cache_path' );
 
+        self._uploader = RenderUploader( self._murl,
+                                         workers = setting( config, 'upload_workers', 4 ),
+                                         retries = setting( config, 'upload_retries', 3 ),
+                                         timeout = setting( config, 'upload_timeout', 300 ),
+                                         notify = self.wake )
+
+        # Per-phase job timings, served to Prometheus and/or written for
+        # node_exporter's textfile collector
+        self._metrics = PhaseMetrics()
+        self._metrics_textfile = setting( config, 'metrics_textfile', '' )
+        metrics_port = setting( config, 'metrics_port', 0 )
+        if metrics_port > 0:
+            MetricsServer( self._metrics, metrics_port ).start()
+
+        # Finished outputs wait in a durable spool until the manager has them,
+        # so a failed upload is retried rather than rendered again
+        self._spool = RenderSpool( os.path.join( self._save_location, "spool" ),
+                                   self._uploader,
+                                   retry_interval = setting( config, 'spool_retry_interval', 30 ),
+                                   max_retry_interval = setting( config, 'spool_max_retry_interval', 600 ),
+                                   max_attempts = setting( config, 'spool_max_attempts', 0 ),
+                                   max_age = setting( config, 'spool_max_age', 172800 ),
+                                   metrics = self._metrics,
+                                   on_failed = self.upload_failed,
+                                   notify = self.wake )
+        # Frames handed to the spool and not on disk yet, by uuid
+        self._spooling = {}
+
+        # Optional post-render stage, run in its own processes between
+        # spooling and uploading
+        self._postprocess = None
+        if config.has_section( 'postprocess' ) and setting( config, 'enabled', False, section='postprocess' ):
+            self._postprocess = PostProcessor( workers = setting( config, 'workers', 2, section='postprocess' ),
+                                               notify = self.wake,
+                                               timeout = setting( config, 'timeout', 600, section='postprocess' ),
+                                               tool = setting( config, 'exec', 'oiiotool', section='postprocess' ),
+                                               exr_compression = setting( config, 'exr_compression', '', section='postprocess' ),
+                                               preview_size = setting( config, 'preview_size', 256, section='postprocess' ),
+                                               preview_label = setting( config, 'preview_label', 'beauty', section='postprocess' ),
+                                               stats = setting( config, 'stats', True, section='postprocess' ) )
+
+        # Recent frame times per scene, from which frame timeouts are derived
+        self._history = RenderHistory( os.path.join( self._save_location, "render_history.json" ),
+                                       max_samples = setting( config, 'history_samples', 50 ),
+                                       percentile = setting( config, 'timeout_percentile', 0.95 ),
+                                       factor = setting( config, 'timeout_factor', 3.0 ),
+                                       min_timeout = setting( config, 'timeout_min', 300.0 ),
+                                       max_timeout = setting( config, 'timeout_max', 86400.0 ) )
+        self._adaptive_timeout = setting( config, 'adaptive_timeout', True )
+
+        # Optional node-local copy of the scenes, shared by every slot
+        self._scene_cache = None
+        scene_cache_size = setting( config, 'scene_cache_size', 0 )
+        if scene_cache_size > 0:
+            self._scene_cache = SceneCache( config.get( 'settings', 'scene_path' ),
+                                            os.path.join( self._save_location, "scene_cache" ),
+                                            scene_cache_size * 1024 * 1024,
+                                            setting( config, 'scene_cache_revalidate', 30 ) )
+
+        # Build one render slot per concurrent render, each with its own
+        # renderer instances and scratch directory
+        self._slot_count = max( 1, setting( config, 'slots', 1 ) )
+        self._batch_size = max( 1, setting( config, 'batch_size', 1 ) )
+        self._pending = []
+        # Frames taken beyond what the slots hold, whose inputs are read
+        # while the slots render; handed back to the broker when no slot is
+        # expected to take them within prefetch_max_wait seconds
+        self._prefetch_frames = max( 0, setting( config, 'prefetch_frames', 1 ) )
+        self._prefetch_max_wait = setting( config, 'prefetch_max_wait', 120.0 )
+        self._prefetching = None
+        self._deliveries = {}
+        # Frames settled after their delivery's connection was lost, whose
+        # redelivered messages only need acking. The broker may redeliver
+        # them to another node instead, so only the newest are remembered
+        self._reported = OrderedDict()
+        self._max_reported = 10000
+        self._slots = []
+        for slot in range(self._slot_count):
+            render_path = os.path.join( self._save_location, "slot_%d" % slot )
+            if not os.path.isdir( render_path ):
+                os.makedirs( render_path )
+            self._slots.append( RenderNode( slot, render_path ) )
+
+        # Renderers split the node's cores between the slots, and new work
+        # is held back while the node is overloaded
+        self._resources = ResourceMonitor( max_load = setting( config, 'max_load', 2.0 ),
+                                           min_free_memory = setting( config, 'min_free_memory', 1024 ) )
+        self._threads = self._resources.threads_per_slot( self._slot_count )
+
+        # Renderer modules are built per slot when their job type first
+        # comes up, and rebuilt between frames after a config reload
+        # (SIGHUP, or a change to the file when watch_config is on)
+        self._renderers = RendererLoader( config, config_path,
+                                          scene_path = config.get( 'settings', 'scene_path' ),
+                                          scene_cache = self._scene_cache,
+                                          threads = self._threads,
+                                          exit_callback = self.wake,
+                                          save_path = self._save_location )
+        self._watch_config = setting( config, 'watch_config', True )
+        self._reload_requested = False
+
+        # Optional cache of finished renders from deterministic renderers,
+        # so a frame submitted again is uploaded without rendering it
+        self._results = None
+        result_cache_path = setting( config, 'result_cache_path', '' )
+        if result_cache_path:
+            self._results = ResultCache( result_cache_path,
+                                         setting( config, 'result_cache_size', 10240 ) * 1024 * 1024,
+                                         config.get( 'settings', 'scene_path' ),
+                                         os.path.join( self._save_location, "result_cache_staging" ),
+                                         revalidate_interval = setting( config, 'result_cache_revalidate', 30 ),
+                                         notify = self.wake )
+        # Frames being looked up in the result cache, which join the pending
+        # frames if they are not there
+        self._cache_lookups = []
+
+        self._prefetcher = InputPrefetcher( self._metrics )
+
     def initiate_broker_communications(self, ):
+        """Connects to the broker, retrying with jittered exponential backoff.
+        Running renders are checked while it waits, so frames that finish
+        during an outage are still spooled and uploaded. Nothing is sent to
+        the broker while there is no channel."""
+        self.close_connection()
         self._connection = None
+        self.channel = None
+        self._connection_id = self._connection_id + 1
+        attempt = 0
         while self._connection == None:
             try:
                 LOGGER.info( "Connecting to Broker..." )
                 parameters = pika.URLParameters(self._comm_host)
-                self._connection = pika.BlockingConnection(parameters)
+                connection = pika.BlockingConnection(parameters)
+                self.channel = connection.channel()
+                # Frames pending before the outage were requeued, so start prefetching again
+                self._prefetching = None
+                self.set_prefetching( True )
+                self._connection = connection
             except Exception, e:
-                LOGGER.info(str(e))
-                LOGGER.info(traceback.format_exc())
-                time.sleep(5)
+                self.channel = None
+                delay = random.uniform( 0, min( self._reconnect_max_interval, self._reconnect_interval * 2**attempt ) )
+                attempt = attempt + 1
+                LOGGER.info("Failed to connect to the broker (%s), retrying in %.1f seconds", str(e), delay)
+                self.wait_for_broker( delay )
+
+        LOGGER.info(' [*] Waiting for messages. To exit press CTRL+C')
+
+        # Consumers did not survive the old connection
+        self.active_queues = {}
+        self.next_queue_poll = 0
+        self.subscribe_job_updates()
 
+    def close_connection(self, ):
+        """Closes what is left of the broker connection, so a broken one
+        does not linger with its socket until it is collected."""
+        if self._connection == None:
+            return
+        try:
+            if self._connection.is_open:
+                self._connection.close()
+        except Exception, e:
+            LOGGER.debug("Failed to close the broker connection: %s", str(e))
+
+    def reopen_channel(self, ):
+        """Replaces the closed channel of a connection that is still open.
+        Delivery tags belong to the channel, so its deliveries are forgotten
+        like those of a lost connection."""
+        self.channel = None
+        self._connection_id = self._connection_id + 1
         self.channel = self._connection.channel()
+        self._prefetching = None
+        self.set_prefetching( True )
+        # Its consumers went with it
+        self.active_queues = {}
+        self.next_queue_poll = 0
 
-        self.channel.queue_declare(queue='log_queue',
-                                   durable=True,
-                                   exclusive=False,
-                                   auto_delete=False)
-                                   
-        LOGGER.info(' [*] Waiting for messages. To exit press CTRL+C')
+    def release_deliveries(self, ):
+        """Forgets the frames not started yet; the broker requeues them."""
+        for job in self._pending + self._cache_lookups:
+            job["released"] = True
+            self._deliveries.pop( job["tag"], None )
+        self._pending = []
+        self._cache_lookups = []
+
+    def wait_for_broker(self, delay):
+        deadline = time.time() + delay
+        while True:
+            self.check_render()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            time.sleep( min( remaining, self._render_check_interval ) )
 
-        self.channel.basic_qos(prefetch_count=1)
+    def subscribe_job_updates(self, ):
+        """Listens for job list changes on the manager's fanout exchange. The
+        exchange is the manager's to declare, so a missing one disables the
+        push; this uses its own channel so that only closes the channel."""
+        self._job_channel = None
+        if not self._job_exchange:
+            return
+        try:
+            channel = self._connection.channel()
+            channel.exchange_declare( exchange=self._job_exchange, exchange_type='fanout', passive=True )
+            result = channel.queue_declare( queue='', exclusive=True, auto_delete=True )
+            channel.queue_bind( exchange=self._job_exchange, queue=result.method.queue )
+            channel.basic_consume( self.job_update_callback, queue=result.method.queue, no_ack=True )
+        except Exception, e:
+            LOGGER.warning("Failed to subscribe to job updates, polling instead: %s", str(e))
+        else:
+            self._job_channel = channel
+
+    def job_update_callback(self, ch, method, properties, body):
+        self._job_updates_received = True
+        # The update either carries the new job list or just announces a change
+        try:
+            jobs = json.loads( body )
+        except ValueError:
+            jobs = None
+        if isinstance( jobs, list ):
+            self._jobs = jobs
+            self.update_queue( jobs )
+        else:
+            self.next_queue_poll = 0
 
 
     def spin_up_new_pid(self,config):
@@ -99,109 +341,520 @@ class RenderWorker(object):
     def check_pid_status(self, ):
         pass
 
-    def send_status_update(self, ):
-        pass
+    def status_key(self, slots):
+        """The parts of a status update whose change is worth reporting
+        straight away; progress and memory only go out with the heartbeat."""
+        return ( tuple( ( slot["state"], slot.get( "scene" ), tuple( slot.get( "frames", [] ) ),
+                          tuple( slot["renderers"] ) ) for slot in slots ),
+                 self._spool.pending() > 0,
+                 self._resources.overloaded(),
+                 tuple( sorted( self._renderers.failures().keys() ) ) )
+
+    def check_status(self, ):
+        slots = [ render_slot.describe() for render_slot in self._slots ]
+        key = self.status_key( slots )
+        if time.time() >= self._next_status or key != self._last_status:
+            self.send_status_update( slots, key )
+
+    def send_status_update(self, slots=None, key=None):
+        if slots == None:
+            slots = [ render_slot.describe() for render_slot in self._slots ]
+            key = self.status_key( slots )
+        self._last_status = key
+        self._next_status = time.time() + self._status_interval
+        resources = self._resources.sample()
+        scenes = []
+        if self._scene_cache != None:
+            scenes = sorted( self._scene_cache.scenes() )
+        # The full history would grow every heartbeat; the manager only
+        # needs the times of the frames this node is holding
+        jobs = self._pending + [ job for render_slot in self._slots for job in render_slot.unfinished_jobs() ]
+        active = set( ( history_scene( job ), job["type"] ) for job in jobs )
+        self._events.publish( "node_status",
+                              host = socket.gethostname(),
+                              slots = slots,
+                              free_slots = len( [ slot for slot in slots if slot["state"] == "idle" ] ),
+                              cores = resources["cores"],
+                              memory = resources["memory"],
+                              free_memory = resources["free_memory"],
+                              load = round( resources["load"], 2 ),
+                              overloaded = key[2],
+                              renderer_types = sorted( self._renderers.types() ),
+                              failed_renderers = self._renderers.failures(),
+                              cached_scenes = scenes,
+                              pending_frames = len(self._pending),
+                              spooled_frames = self._spool.pending(),
+                              postprocessing = self._postprocess.pending() if self._postprocess != None else 0,
+                              render_times = self._history.stats( active ) )
 
 
+    def wake(self, ):
+        """Asks the main loop to check the render slots right away. Safe to
+        call from any thread."""
+        connection = self._connection
+        if connection == None:
+            return
+        try:
+            connection.add_callback_threadsafe( self.check_render )
+        except Exception, e:
+            # The fallback interval will pick the change up instead
+            LOGGER.debug("Failed to wake the worker loop: %s", str(e))
+
+    def request_reload(self, signum=None, frame=None):
+        self._reload_requested = True
+
+    def check_reload(self, ):
+        changed = self._watch_config and self._renderers.config_changed()
+        if self._reload_requested or changed:
+            self._reload_requested = False
+            self._renderers.reload()
+            # Renderers that failed may be retried, so re-pick the queues
+            self.next_queue_poll = 0
+
     def check_render(self, ):
         self.last_render_check = datetime.datetime.now()
-        if self.render_started:
-            status = self._renderManager.status();
-            log_text = self._renderManager.last_log()
+        self.check_reload()
+        for render_slot in self._slots:
+            self.check_slot( render_slot )
+        self.check_spooled()
+        self.check_postprocess()
+        self.check_cache_hits()
+        self.dispatch_pending()
+        self.release_waiting()
+        self.check_status()
+
+    def settle_delivery(self, key, requeue=False):
+        """Marks one frame of a delivery as done; the delivery is acked (or
+        requeued if any of its uploads failed) once all its frames are.
+
+        Deliveries are keyed by (connection, delivery tag). One from a lost
+        connection was already requeued by the broker, so it is only
+        forgotten; its frames reach the manager by uuid."""
+        delivery = self._deliveries[key]
+        delivery["frames"] = delivery["frames"] - 1
+        delivery["requeue"] = delivery["requeue"] or requeue
+        if delivery["frames"] == 0:
+            del self._deliveries[key]
+            connection_id, tag = key
+            if connection_id != self._connection_id or self.channel == None:
+                LOGGER.debug("Dropping delivery %d of a lost broker connection", tag)
+            elif delivery["requeue"]:
+                self.channel.basic_reject(delivery_tag=tag, requeue=True);
+            else:
+                self.channel.basic_ack(delivery_tag = tag)
+
+    def settle_job(self, job, requeue=False):
+        if job["tag"][0] != self._connection_id and not requeue:
+            self._reported[job["uuid"]] = True
+            while len(self._reported) > self._max_reported:
+                self._reported.popitem( last=False )
+        self.settle_delivery( job["tag"], requeue )
+
+    def running_job(self, uuid):
+        for render_slot in self._slots:
+            for job in render_slot.unfinished_jobs():
+                if job["uuid"] == uuid:
+                    return job
+        return None
+
+    def record_job(self, job, result):
+        self._metrics.observe_job( job, result )
+        if self._metrics_textfile:
+            try:
+                self._metrics.write_textfile( self._metrics_textfile )
+            except (IOError, OSError), e:
+                LOGGER.warning("Failed to write the metrics textfile: %s", str(e))
+
+    def finish_job(self, render_slot, job, outputs):
+        LOGGER.info("Render of frame %s complete.", str(job["frame"]))
+        phases = job_phases( job["times"] )
+        if "render" in phases:
+            self._history.record( history_scene( job ), job["type"], phases["render"] + phases.get( "scene_load", 0 ) )
+        self._events.publish( "render_finish",
+                              frame = job["frame"],
+                              scene = job["scene"],
+                              uuid = job["uuid"],
+                              type = job["type"],
+                              timings = dict( ( phase, round( seconds, 3 ) )
+                                              for phase, seconds in phases.items() ) )
+
+        # The cache links the outputs before the spool moves them
+        if job.get( "cache_key" ) != None:
+            self._results.store( job["cache_key"], outputs, render_slot.extension() )
+        render_slot.remove_job( job )
+        if not self.spool_job( job, outputs, render_slot.extension(), "finished" ):
+            render_slot.clear_outputs( outputs )
+
+    def spool_job(self, job, outputs, extension, result):
+        """Moves the outputs into the spool. The frame is settled by
+        check_spooled once the spool has them on disk."""
+        try:
+            self._spool.submit( job["uuid"], outputs, extension, job["type"],
+                                hold = self._postprocess != None )
+        except Exception, e:
+            LOGGER.warning("Failed to spool the render outputs: %s" % str(e) )
+            self.settle_job( job, requeue=True )
+            self.record_job( job, "spool_failed" )
+            return False
+        self._spooling[job["uuid"]] = ( job, result )
+        return True
+
+    def check_spooled(self, ):
+        """Once the outputs are in the durable spool the frame is safe, so it
+        is acked; post-processing and the upload carry on alongside the next
+        render."""
+        for uuid, error in self._spool.durable():
+            job, result = self._spooling.pop( uuid )
+            if error != None:
+                self.settle_job( job, requeue=True )
+                self.record_job( job, "spool_failed" )
+                continue
+            job["times"]["spooled"] = time.time()
+            self.settle_job( job )
+            self.record_job( job, result )
+            if self._postprocess != None:
+                self._postprocess.submit( job, self._spool.outputs( uuid ) )
+
+    def upload_failed(self, manifest, reason):
+        """Reports a spooled frame whose upload the spool gave up on. Called
+        from the spool's thread."""
+        self._events.publish( "upload_failed",
+                              uuid = manifest["uuid"],
+                              type = manifest.get( "type" ),
+                              attempts = manifest["attempts"],
+                              reason = reason )
+
+    def cache_key(self, job):
+        """The result cache key of job, or None when its renderer is not
+        deterministic, the cache is off or the scene is still being hashed."""
+        if self._results == None or not self._renderers.deterministic( job["type"] ):
+            return None
+        return self._results.key( job["scene"], job["frame"], job["type"],
+                                  self._renderers.settings( job["type"] ), job["region"] )
+
+    def check_cache_hits(self, ):
+        """Uploads the frames the result cache had and hands the others to
+        the slots."""
+        if self._results == None:
+            return
+        for job, outputs, extension, staging in self._results.fetched():
+            if job in self._cache_lookups:
+                self._cache_lookups.remove( job )
+            # Handed back to the broker while it was looked up
+            if job.get( "released" ):
+                shutil.rmtree( staging, ignore_errors=True )
+                continue
+            if outputs == None:
+                self._pending.append( job )
+                self.prefetch( job )
+                continue
+            LOGGER.info("Frame %s of %s is in the result cache, uploading it", str(job["frame"]), job["scene"])
+            self._events.publish( "render_finish",
+                                  frame = job["frame"],
+                                  scene = job["scene"],
+                                  uuid = job["uuid"],
+                                  type = job["type"],
+                                  cached = True,
+                                  timings = {} )
+            self.spool_job( job, outputs, extension, "cached" )
+            shutil.rmtree( staging, ignore_errors=True )
+
+    def check_postprocess(self, ):
+        """Hands post-processed outputs back to the spool for upload."""
+        if self._postprocess == None:
+            return
+        for job, result in self._postprocess.finished():
+            self._metrics.observe( "postprocess", job["type"], time.time() - job["times"]["spooled"] )
+            if "error" in result:
+                LOGGER.warning("Post-processing of frame %s failed, uploading it as rendered: %s",
+                               str(job["frame"]), result["error"])
+            else:
+                for label, path in result["outputs"].items():
+                    try:
+                        self._spool.add_output( job["uuid"], label, path )
+                    except (IOError, OSError), e:
+                        LOGGER.warning("Failed to spool the %s output of frame %s: %s", label, str(job["frame"]), str(e))
+                self._events.publish( "render_postprocess",
+                                      frame = job["frame"],
+                                      scene = job["scene"],
+                                      uuid = job["uuid"],
+                                      type = job["type"],
+                                      outputs = result["outputs"].keys(),
+                                      stats = result["stats"],
+                                      bytes_before = result["bytes_before"],
+                                      bytes_after = result["bytes_after"] )
+            self._spool.release( job["uuid"] )
+
+    def fail_job(self, render_slot, job):
+        LOGGER.info("Render of frame %s failed.", str(job["frame"]))
+        self._events.publish( "render_fail",
+                              frame = job["frame"],
+                              scene = job["scene"],
+                              uuid = job["uuid"],
+                              type = job["type"] )
+        render_slot.remove_job( job )
+        self.settle_job( job )
+        self.record_job( job, "failed" )
+
+    def publish_progress(self, render_slot):
+        """Publishes a render_progress event for the slot's current frame, at
+        most once per progress_interval seconds and only when it moved."""
+        progress = render_slot.progress()
+        if progress == None:
+            return
+        job, percent = progress
+        percent = round( percent, 1 )
+        now = time.time()
+        if percent == job.get( "progress" ) or now - job.get( "progress_time", 0 ) < self._progress_interval:
+            return
+        job["progress"] = percent
+        job["progress_time"] = now
+        self._events.publish( "render_progress",
+                              frame = job["frame"],
+                              scene = job["scene"],
+                              uuid = job["uuid"],
+                              type = job["type"],
+                              progress = percent )
+
+    def check_slot(self, render_slot):
+        if render_slot.rendering:
+            status = render_slot.status();
+            log_text = render_slot.last_log()
             for line in log_text.split("\n"):
                 if line:
                     NODE_LOGGER.debug( line )
 
-            if status == "SUCCESS":
-                LOGGER.info("Render complete.")
-                render_info = self._renderManager.last_render_info()
-                self.channel.basic_publish(exchange='', routing_key="log_queue",
-                                           body = json.dumps( {"event":"render_finish",
-                                                               "frame":render_info["frame"],
-                                                               "scene":render_info["scene"],
-                                                               "time":datetime.datetime.now(),
-                                                               "uuid":render_info["uuid"],
-                                                               "type":render_info["type"],
-                                                               } , cls=DateTimeEncoder),
-                                           properties=pika.BasicProperties(
-                                               delivery_mode = 2,
-                                               app_id = socket.gethostname(),
-                                           )                                           
-                                           )
-                
-                # Save off the render to disk somewhere
-                url = self._murl+"/upload_render?uuid="+render_info["uuid"]
-                LOGGER.info("Uploading completed render to %s" % url)
-                last_render = self._renderManager.last_render()
-
-                all_files_sent = True
-                for label in last_render.keys():
-                    file_list = {}
-                    file_list[label] = ( label+"."+self._renderManager.extension(), last_render[label] )
-                    print "Sending image {:s}".format( label+"."+self._renderManager.extension() ) 
-                    try:
-                        requests.post( url, files=file_list)
-                    except Exception, e:
-                        LOGGER.warning("Failed to upload the render %s: %s" % (label, str(e)) )
-                        all_files_sent = False
+            self.publish_progress( render_slot )
+
+            # Frames of a batch are spooled as soon as each one is done
+            for job, outputs in render_slot.finished_jobs():
+                self.finish_job( render_slot, job, outputs )
+
+            if status == "SUCCESS" or status == "FAILURE":
+                render_slot.rendering = False
+                render_slot.idle_since = time.time()
+                for job in render_slot.unfinished_jobs():
+                    self.fail_job( render_slot, job )
+
+    def dispatch_pending(self, ):
+        """Starts pending jobs on free slots, grouping up to batch_size
+        consecutive frames of the same scene into one renderer launch."""
+        while len(self._pending) > 0:
+            render_slot = self.free_slot()
+            if render_slot == None:
+                return
+            # An idle node always takes work, otherwise it could wait forever
+            # on load it did not cause
+            if len(self.busy_slots()) > 0 and self._resources.overloaded():
+                LOGGER.debug("Node is overloaded, holding back %d pending frames", len(self._pending))
+                return
+            batch = [ self.next_pending_job() ]
+            self._pending.remove( batch[0] )
+            while len(batch) < self._batch_size:
+                following = None
+                for job in self._pending:
+                    if ( job["scene"] == batch[0]["scene"] and job["type"] == batch[0]["type"] and
+                         job["region"] == batch[0]["region"] and job["frame"] == batch[-1]["frame"] + 1 ):
+                        following = job
+                        break
+                if following == None:
+                    break
+                self._pending.remove( following )
+                batch.append( following )
+
+            LOGGER.info("Rendering frames %s for scene %s of type %s on slot %d",
+                        ",".join( str(job["frame"]) for job in batch ),
+                        batch[0]["scene"], batch[0]["type"], render_slot.slot);
+            if render_slot.idle_since != None:
+                self._metrics.observe( "idle", batch[0]["type"], time.time() - render_slot.idle_since )
+            timeout = None
+            if self._adaptive_timeout:
+                timeout = self._history.timeout( history_scene( batch[0] ), batch[0]["type"] )
+            try:
+                self._renderers.prepare( render_slot, batch[0]["type"] )
+            except Exception, e:
+                LOGGER.error("Failed to load the %s renderer, no longer taking its jobs until a reload: %s",
+                             batch[0]["type"], str(e))
+                self.drop_render_type( batch[0]["type"], batch )
+                continue
+            render_slot.render_frames_of_type( batch[0]["scene"], batch, batch[0]["type"], timeout );
+            for job in batch:
+                self._events.publish( "render_start",
+                                      frame = job["frame"],
+                                      scene = job["scene"],
+                                      uuid = job["uuid"],
+                                      type = job["type"] )
+
+    def drop_render_type(self, render_type, batch):
+        """Hands batch and every pending frame of render_type back to the
+        broker and stops consuming its queues, once its renderer failed."""
+        jobs = batch + [ job for job in self._pending if job["type"] == render_type ]
+        for job in jobs:
+            if job in self._pending:
+                self._pending.remove( job )
+            job["released"] = True
+            self.settle_delivery( job["tag"], requeue=True )
+        self.update_queue( self._jobs )
+
+    def prefetch(self, job):
+        """Has the inputs of a pending job read in the background, using a
+        renderer of its type some slot already has."""
+        if self._prefetch_frames == 0:
+            return
+        for render_slot in self._slots:
+            renderer = render_slot.renderer( job["type"] )
+            if renderer != None:
+                self._prefetcher.submit( job, renderer )
+                return
+
+    def set_prefetching(self, prefetching):
+        """Takes prefetch_frames deliveries beyond what the slots hold, or
+        stops doing so while frames are being handed back. While
+        disconnected it is only recorded; a new channel applies it."""
+        if prefetching == self._prefetching:
+            return
+        self._prefetching = prefetching
+        if self.channel == None:
+            return
+        extra = self._prefetch_frames if prefetching else 0
+        # The prefetch limit is shared by every job queue consumer on the channel
+        self.channel.basic_qos(prefetch_count=self._slot_count * self._batch_size + extra, all_channels=True)
+
+    def expected_wait(self, ):
+        """Seconds until the first busy slot is expected to free up, from the
+        render history, or None when that cannot be judged."""
+        waits = []
+        for render_slot in self.busy_slots():
+            jobs = render_slot.unfinished_jobs()
+            if len(jobs) == 0:
+                return 0
+            expected = self._history.expected( history_scene( jobs[0] ), jobs[0]["type"] )
+            if expected == None:
+                return None
+            waits.append( max( 0, expected * len(jobs) - ( time.time() - render_slot.frame_started() ) ) )
+        return min( waits ) if len(waits) > 0 else 0
+
+    def release_waiting(self, ):
+        """Hands pending frames back to the broker, so another node can render
+        them, when this node cannot start them promptly: their job lost its
+        priority, or they waited prefetch_max_wait seconds while the node was
+        overloaded or every slot was expected to stay busy for that long
+        again. Without the render history to tell, a slot is taken to stay
+        busy. A delivery is only released once none of its frames started."""
+        if self.free_slot() != None and not self._resources.overloaded():
+            self.set_prefetching( True )
+            return
+        if len(self._pending) == 0:
+            return
+        now = time.time()
+        blocked = None
+        release = []
+        for job in self._pending:
+            if job["queue"] in self._queue_rank:
+                if now - job["times"]["received"] < self._prefetch_max_wait:
+                    continue
+                if blocked == None:
+                    wait = self.expected_wait()
+                    blocked = self._resources.overloaded() or wait == None or wait > self._prefetch_max_wait
+                if not blocked:
+                    continue
+            release.append( job )
+        for tag in set( job["tag"] for job in release ):
+            jobs = [ job for job in self._pending if job["tag"] == tag ]
+            if len(jobs) < self._deliveries[tag]["frames"]:
+                continue
+            LOGGER.info("Releasing frames %s of %s, which cannot start here soon",
+                        ",".join( str(job["frame"]) for job in jobs ), jobs[0]["scene"])
+            # Otherwise the broker would hand them straight back
+            if blocked:
+                self.set_prefetching( False )
+            for job in jobs:
+                job["released"] = True
+                self._pending.remove( job )
+                self.settle_delivery( tag, requeue=True )
+                self.record_job( job, "released" )
+
+    def busy_slots(self, ):
+        return [ render_slot for render_slot in self._slots if not render_slot.is_free() ]
+
+    def free_slot(self, ):
+        for render_slot in self._slots:
+            if render_slot.is_free():
+                return render_slot
+        return None
+
+    def schedule_queue_poll(self, ):
+        """Picks the next poll time: rare while job updates are pushed to us,
+        backing off after failures, and jittered so nodes do not poll in step."""
+        interval = self._queue_update_interval
+        if self._job_channel != None and self._job_channel.is_open and self._job_updates_received:
+            interval = self._queue_push_poll_interval
+        if self._jobs_failures > 0:
+            interval = min( interval * 2 ** self._jobs_failures, 60.0 )
+        self.next_queue_poll = time.time() + interval * random.uniform( 0.8, 1.2 )
 
-                if all_files_sent:
-                    self.channel.basic_ack(delivery_tag = self._renderManager.tag)
-                else:
-                    self.channel.basic_reject(delivery_tag=self._renderManager.tag, requeue=True);
-
-                        
-                self.render_started = False
-            elif status == "FAILURE":
-                LOGGER.info("Render failed.")
-                render_info = self._renderManager.last_render_info()
-                self.channel.basic_publish(exchange='', routing_key="log_queue",
-                                           body = json.dumps( {"event":"render_fail",
-                                                               "frame":render_info["frame"],
-                                                               "scene":render_info["scene"],
-                                                               "time":datetime.datetime.now(),
-                                                               "uuid":render_info["uuid"],
-                                                               "type":render_info["type"],
-                                                               } , cls=DateTimeEncoder),
-                                           properties=pika.BasicProperties(
-                                               delivery_mode = 2,
-                                               app_id = socket.gethostname(),
-                                           )
-                                           ) 
-                self.render_started = False
-                self.channel.basic_ack(delivery_tag = self._renderManager.tag)
-            else:
-                pass
-            
     def pull_and_update_queue(self,):       
         url = self._murl+"/available_jobs"
+        headers = {}
+        if self._jobs_etag != None:
+            headers['If-None-Match'] = self._jobs_etag
         try:
-            res = requests.get( url )
+            res = self._jobs_session.get( url, headers=headers, timeout=10 )
+            if res.status_code != 304:
+                res.raise_for_status()
+                self._jobs = res.json()
+                self._jobs_etag = res.headers.get( 'ETag' )
         except Exception, e:
             LOGGER.warning("Failed to retreieve job priority list from manager: %s", str(e))               
+            self._jobs_failures = self._jobs_failures + 1
         else:
-            if len(res.json()) == 0 and self.active_queue != "":
-                LOGGER.info("No jobs available. Disconnecting from the last queue.")
-                if self.active_queue_tag != None:			
-                    self.channel.basic_cancel( consumer_tag=self.active_queue_tag )
-                self.active_queue = ""
-                
-            for job in res.json():
-                if self._renderManager.can_handle_render( job[1] ):
-                    if self.active_queue != job[0]:
-                        LOGGER.info( "New job has priority. Switching to queue: render_%s" % job[0] )
-                        if self.active_queue_tag != None:
-                            self.channel.basic_cancel( consumer_tag=self.active_queue_tag )
-                        self.active_queue = job[0]
-                        self.active_queue_tag = self.channel.basic_consume(self.callback, queue='render_%s' % self.active_queue )
-                    break;
-                else:
-                    print "Can't handle render jobs of type '%s', skipping to next job in queue..." % job[1]
+            self._jobs_failures = 0
+            self.update_queue( self._jobs )
+        self.schedule_queue_poll()
 
-                
-        
-            
-    def callback(self, ch, method, properties, body):
+    def update_queue(self, jobs):
+        """Consumes from the consume_queues highest priority jobs this node
+        can render, ranked in the manager's order."""
+        wanted = []
+        for job in jobs:
+            if len(wanted) >= self._consume_queues:
+                break
+            if self._renderers.can_handle( job[1] ):
+                wanted.append( job[0] )
+            else:
+                print "Can't handle render jobs of type '%s', skipping to next job in queue..." % job[1]
+        self._queue_rank = dict( (queue, rank) for rank, queue in enumerate( wanted ) )
+        # Consumers are set up again once reconnected
+        if self.channel == None:
+            return
+
+        if len(wanted) == 0 and len(self.active_queues) > 0:
+            LOGGER.info("No jobs available. Disconnecting from the last queues.")
+        for queue in self.active_queues.keys():
+            if queue not in self._queue_rank:
+                LOGGER.info( "Job no longer has priority. Leaving queue: render_%s" % queue )
+                self.channel.basic_cancel( consumer_tag=self.active_queues.pop( queue ) )
+        for queue in wanted:
+            if queue not in self.active_queues:
+                LOGGER.info( "New job has priority. Consuming from queue: render_%s" % queue )
+                self.active_queues[queue] = self.channel.basic_consume( functools.partial( self.callback, job_queue=queue ),
+                                                                        queue='render_%s' % queue )
+
+    def next_pending_job(self, ):
+        """Picks the pending job to start next. 'strict' always takes the
+        highest ranked job; 'weighted' halves a job's chance per rank."""
+        ranked = sorted( self._pending, key=lambda job: self._queue_rank.get( job["queue"], len(self._queue_rank) ) )
+        if self._queue_policy != "weighted":
+            return ranked[0]
+        weights = [ 0.5 ** self._queue_rank.get( job["queue"], len(self._queue_rank) ) for job in ranked ]
+        pick = random.uniform( 0, sum( weights ) )
+        for job, weight in zip( ranked, weights ):
+            pick = pick - weight
+            if pick <= 0:
+                return job
+        return ranked[-1]
+
+    def callback(self, ch, method, properties, body, job_queue=None):
         response_message = {}
         response_message["status"] = ""
 
@@ -214,79 +867,148 @@ class RenderWorker(object):
             return;       
 
         if body_config["command"] == "render":
-            self.check_render();
-
-            if self._renderManager.status() != "RUNNING":
-                LOGGER.info("Caught a render job...")
-                try:
-                    frame = body_config["frame"]
-                    scene_file = body_config["scene"]
-                    rendertype = body_config["type"]
-                    uuid = body_config["uuid"]
-                except:
-                    LOGGER.error("Render command was malformed. Discarding...")
-                    ch.basic_ack(delivery_tag = method.delivery_tag)                
+            LOGGER.info("Caught a render job...")
+            try:
+                scene_file = body_config["scene"]
+                rendertype = body_config["type"]
+                # A message carries either one frame or a batch of frames,
+                # each optionally limited to a region (a tile) of the frame
+                region = body_config.get( "region" )
+                if "frames" in body_config:
+                    frames = [ ( entry["frame"], entry["uuid"], read_region( entry.get( "region", region ) ) )
+                               for entry in body_config["frames"] ]
                 else:
-                    if not self._renderManager.can_handle_render(rendertype):
-                        ch.basic_reject(delivery_tag = method.delivery_tag, requeue=True);
-                    else:
-                        #ch.basic_ack(delivery_tag = method.delivery_tag)
-                        LOGGER.info("Rendering frame %s for scene %s of type %s", str(frame), scene_file, rendertype);
-                        self._renderManager.render_single_frame_of_type( scene_file, frame, uuid, rendertype );
-                        self._renderManager.tag = method.delivery_tag
-                        self.render_started = True
-                        self.channel.basic_publish(exchange='', routing_key="log_queue",
-                                                   body = json.dumps( {"event":"render_start",
-                                                                       "frame":frame,
-                                                                       "scene":scene_file,
-                                                                       "time":datetime.datetime.now(),
-                                                                       "uuid":uuid,
-                                                                       "type":rendertype,
-                                                                       } , cls=DateTimeEncoder),
-                                                   properties=pika.BasicProperties(
-                                                       delivery_mode = 2,
-                                                       app_id = socket.gethostname(),
-                                                   )
-                                                   )                                           
+                    frames = [ ( body_config["frame"], body_config["uuid"], read_region( region ) ) ]
+            except:
+                LOGGER.error("Render command was malformed. Discarding...")
+                ch.basic_ack(delivery_tag = method.delivery_tag)                
             else:
-                ch.basic_reject(delivery_tag = method.delivery_tag, requeue=True);
+                if len(frames) == 0:
+                    ch.basic_ack(delivery_tag = method.delivery_tag)
+                elif not self._renderers.can_handle(rendertype):
+                    ch.basic_reject(delivery_tag = method.delivery_tag, requeue=True);
+                else:
+                    # Jobs are started from dispatch_pending once every
+                    # prefetched delivery has been seen, so they can batch
+                    key = ( self._connection_id, method.delivery_tag )
+                    self._deliveries[key] = { "frames": len(frames), "requeue": False }
+                    for frame, uuid, region in frames:
+                        # Finished or failed here while the broker was away
+                        if uuid in self._reported:
+                            LOGGER.info("Frame %s was already reported, acking its redelivery", str(frame))
+                            del self._reported[uuid]
+                            self.settle_delivery( key )
+                            continue
+                        # Still being written to the spool: the new delivery
+                        # is settled in place of the stale one
+                        if uuid in self._spooling:
+                            LOGGER.info("Frame %s is already rendered, acking it once spooled", str(frame))
+                            spooling = self._spooling[uuid][0]
+                            stale = spooling["tag"]
+                            spooling["tag"] = key
+                            self.settle_delivery( stale )
+                            continue
+                        # Rendered before a restart or reconnect and still
+                        # waiting in the spool
+                        if self._spool.contains( uuid ):
+                            LOGGER.info("Frame %s is already rendered, uploading it from the spool", str(frame))
+                            self._spool.retry_now( uuid )
+                            self.settle_delivery( key )
+                            continue
+                        # Redelivered after a reconnect while it kept rendering
+                        # here: the running frame takes over the new delivery
+                        running = self.running_job( uuid )
+                        if running != None:
+                            LOGGER.info("Frame %s is still rendering since the broker reconnect", str(frame))
+                            stale = running["tag"]
+                            running["tag"] = key
+                            self.settle_delivery( stale )
+                            continue
+                        job = { "frame": frame,
+                                "uuid": uuid,
+                                "region": region,
+                                "scene": scene_file,
+                                "type": rendertype,
+                                "queue": job_queue,
+                                "tag": key,
+                                "times": { "received": time.time() } }
+                        job["cache_key"] = self.cache_key( job )
+                        if job["cache_key"] != None:
+                            self._cache_lookups.append( job )
+                            self._results.fetch( job, job["cache_key"] )
+                            continue
+                        self._pending.append( job )
+                        self.prefetch( job )
 
             
     def run(self, ):
 
+        self._events.start()
+        self._spool.start()
+        self._prefetcher.start()
+        if self._scene_cache != None:
+            self._scene_cache.start()
+        if self._results != None:
+            self._results.start()
+        signal.signal( signal.SIGHUP, self.request_reload )
         self.initiate_broker_communications()
         self.send_status_update();
 
         while True:
             try:
-                self._connection.process_data_events();
+                # Block until a broker message or a wake up arrives, at most
+                # until the next fallback check is due
+                self._connection.process_data_events( time_limit=self._render_check_interval );
+                if not self.channel.is_open:
+                    # A channel the broker closed only fails when next used
+                    raise pika.exceptions.ChannelClosed( 0, "closed by the broker" )
+                self.dispatch_pending()
+                self.check_pid_status();
+
+                now = datetime.datetime.now()
+                if (now - self.last_render_check).total_seconds() >= self._render_check_interval:
+                    self.check_render()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+
+                if time.time() >= self.next_queue_poll:
+                    if self.free_slot() != None:
+                        self.pull_and_update_queue()
+            except pika.exceptions.ChannelClosed, e:
+                # The connection may have outlived the channel, so only the
+                # closed channel is replaced
+                LOGGER.warning("Channel closed (%s). Reopening...", str(e))
+                try:
+                    if self.channel == None or not self.channel.is_open:
+                        self.release_deliveries()
+                        self.reopen_channel()
+                    if self._job_channel != None and not self._job_channel.is_open:
+                        self.subscribe_job_updates()
+                except Exception, e:
+                    LOGGER.warning("Failed to reopen the channel (%s). Reconnecting...", str(e))
+                    self.release_deliveries()
+                    self.initiate_broker_communications()
             except pika.exceptions.ConnectionClosed, e:
-                LOGGER.warning("Lost connection to management, killing any active processes")
-                self.kill_pid()
-                LOGGER.warning("Connection lost. Reconnecting...")
+                # Running renders carry on; the broker requeues their messages
+                # and their results are reported by uuid
+                LOGGER.warning("Connection lost (%s). Reconnecting...", str(e))
+                self.release_deliveries()
                 self.initiate_broker_communications()
             except KeyboardInterrupt:
                 LOGGER.info("Recieved kill command from terminal, shutting down.")
                 self.check_render()
                 self.kill_pid()
+                self._events.stop()
+                self._spool.stop()
+                self._prefetcher.stop()
+                if self._scene_cache != None:
+                    self._scene_cache.stop()
+                if self._results != None:
+                    self._results.stop()
+                if self._postprocess != None:
+                    self._postprocess.close()
                 break;
 
-            self.check_pid_status();
-                
-            #if (datetime.now() - self.last_update).seconds >= 120:
-            #    self.send_status_update();
-
-            
-            if (datetime.datetime.now() - self.last_render_check).seconds >= 5:
-                self.check_render()
-                sys.stdout.flush()
-                sys.stderr.flush()
-                if not self.render_started:
-                    self.pull_and_update_queue()
-
-                
-            time.sleep(.5);
-
 
 
 def valid_path(path):
@@ -310,6 +1032,7 @@ if __name__ == "__main__":
                         help="Specify config file", metavar="FILE")
     
     args, remaining_argv = parser.parse_known_args()
+    conf_file = args.conf_file
     defaults = {
         "ampq_server" : "http://localhost:5672",
         "ampq_user" : "guest",
@@ -317,6 +1040,7 @@ if __name__ == "__main__":
         "save_cache_path":"/tmp",
         "manager_url":"http://localhost:8888",
         "scene_path":"/tmp",
+        "slots":1,
     }
     
     config = ConfigParser.SafeConfigParser()
@@ -331,6 +1055,8 @@ if __name__ == "__main__":
     parser.add_argument('-S','--save_cache_path', type=valid_path)
     parser.add_argument('-m','--manager_url', type=str)
     parser.add_argument('-s','--scene_path', type=valid_path )
+    parser.add_argument('-n','--slots', type=int, default=1,
+                        help="Number of frames to render concurrently on this node")
 
     args = parser.parse_args(remaining_argv)
    
@@ -346,5 +1072,5 @@ if __name__ == "__main__":
     
     print "AMPQ:", ampq_url
     
-    worker = RenderWorker( ampq_url, config )
+    worker = RenderWorker( ampq_url, config, conf_file )
     worker.run();
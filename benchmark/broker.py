@@ -0,0 +1,263 @@
+"""An in-process stand-in for RabbitMQ, installed in place of pika.
+
+It implements just the part of pika's BlockingConnection API the worker
+uses: queues, consumers with a shared prefetch limit, acks and rejects,
+fanout exchanges and add_callback_threadsafe. drop() simulates losing the
+broker the way RabbitMQ would, requeueing every unacked message. Once every render message has
+been acked and the optional until() holds, process_data_events raises
+KeyboardInterrupt on the consuming connection, which shuts the worker down
+cleanly."""
+import json
+import time
+import types
+from collections import deque, defaultdict
+from threading import Condition
+
+BROKER = None
+
+
+class Method:
+    def __init__(self, delivery_tag=None, routing_key=None, queue=None):
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+        self.queue = queue
+
+
+class Frame:
+    def __init__(self, method):
+        self.method = method
+
+
+class FakeBroker:
+    """Holds the queues and records when each render frame was acked."""
+
+    def __init__(self, ):
+        self.condition = Condition()
+        self.queues = defaultdict( deque )
+        self.exchanges = defaultdict( set )
+        self.acks = {}
+        self.events = []
+        self.total_frames = 0
+        self.until = None
+        self.finished_at = None
+        self.started = time.time()
+        self.connections = []
+        self._next_tag = 0
+        self._next_queue = 0
+
+    def add_render_jobs(self, job, scene, render_type, frames):
+        for frame in frames:
+            self.queues["render_" + job].append( json.dumps( { "command": "render",
+                                                               "frame": frame,
+                                                               "scene": scene,
+                                                               "type": render_type,
+                                                               "uuid": "{:s}-{:d}".format( job, frame ) } ) )
+        self.total_frames = self.total_frames + len(frames)
+
+    def next_tag(self, ):
+        self._next_tag = self._next_tag + 1
+        return self._next_tag
+
+    def new_queue_name(self, ):
+        self._next_queue = self._next_queue + 1
+        return "amq.gen-{:d}".format( self._next_queue )
+
+    def drop(self, channels_only=False):
+        """Closes every connection, or only their channels, and requeues
+        their unacked messages."""
+        with self.condition:
+            for connection in self.connections:
+                if not channels_only:
+                    connection.is_open = False
+                for channel in connection._channels:
+                    for tag in sorted( channel._unacked.keys(), reverse=True ):
+                        queue, body = channel._unacked.pop( tag )
+                        self.queues[queue].appendleft( body )
+                    channel._consumers = {}
+                    channel.is_open = False
+            if not channels_only:
+                self.connections = []
+            self.condition.notify_all()
+
+    def finished(self, ):
+        if self.finished_at == None:
+            if self.total_frames == 0 or len(self.acks) < self.total_frames:
+                return False
+            if self.until != None and not self.until():
+                return False
+            self.finished_at = time.time()
+        return True
+
+
+class FakeChannel:
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._broker = connection.broker
+        self._consumers = {}
+        self._unacked = {}
+        self._prefetch = 0
+        self.is_open = True
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self.check_open()
+        self._prefetch = prefetch_count
+
+    def queue_declare(self, queue='', **kwargs):
+        if not queue:
+            queue = self._broker.new_queue_name()
+        self._broker.queues[queue]
+        return Frame( Method( queue=queue ) )
+
+    def exchange_declare(self, exchange, passive=False, **kwargs):
+        if passive and exchange not in self._broker.exchanges:
+            raise ChannelClosed( 404, "NOT_FOUND - no exchange '{:s}'".format( exchange ) )
+        self._broker.exchanges[exchange]
+
+    def queue_bind(self, exchange, queue, **kwargs):
+        self._broker.exchanges[exchange].add( queue )
+
+    def confirm_delivery(self, ):
+        pass
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False, **kwargs):
+        self.check_open()
+        tag = "ctag-{:d}".format( self._broker.next_tag() )
+        self._consumers[tag] = ( consumer_callback, queue, no_ack )
+        return tag
+
+    def basic_cancel(self, consumer_tag=None):
+        self._consumers.pop( consumer_tag, None )
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        self.check_open()
+        self.route( exchange, routing_key, body )
+        return True
+
+    def route(self, exchange, routing_key, body):
+        with self._broker.condition:
+            if exchange:
+                for queue in self._broker.exchanges[exchange]:
+                    self._broker.queues[queue].append( body )
+            elif routing_key == "log_queue":
+                self._broker.events.append( ( time.time(), body ) )
+            else:
+                self._broker.queues[routing_key].append( body )
+            self._broker.condition.notify_all()
+
+    def check_open(self, ):
+        if not self._connection.is_open:
+            raise ConnectionClosed( 320, "CONNECTION_FORCED" )
+        if not self.is_open:
+            raise ChannelClosed( 406, "PRECONDITION_FAILED" )
+
+    def basic_ack(self, delivery_tag=None):
+        self.check_open()
+        with self._broker.condition:
+            queue, body = self._unacked.pop( delivery_tag )
+            if queue.startswith( "render_" ):
+                self._broker.acks[ json.loads( body )["frame"] ] = time.time()
+            self._broker.condition.notify_all()
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.check_open()
+        with self._broker.condition:
+            queue, body = self._unacked.pop( delivery_tag )
+            if requeue:
+                self._broker.queues[queue].appendleft( body )
+            self._broker.condition.notify_all()
+
+    def deliver(self, ):
+        delivered = 0
+        for tag, ( callback, queue, no_ack ) in self._consumers.items():
+            while len(self._broker.queues[queue]) > 0:
+                if not no_ack and self._prefetch > 0 and len(self._unacked) >= self._prefetch:
+                    break
+                with self._broker.condition:
+                    body = self._broker.queues[queue].popleft()
+                    delivery_tag = self._broker.next_tag()
+                    if not no_ack:
+                        self._unacked[delivery_tag] = ( queue, body )
+                callback( self, Method( delivery_tag, queue ), None, body )
+                delivered = delivered + 1
+        return delivered
+
+
+class FakeConnection:
+
+    def __init__(self, parameters=None):
+        self.broker = BROKER
+        self._channels = []
+        self._callbacks = deque()
+        self.is_open = True
+        with self.broker.condition:
+            self.broker.connections.append( self )
+
+    def channel(self, ):
+        channel = FakeChannel( self )
+        self._channels.append( channel )
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        if not self.is_open:
+            raise ConnectionClosed( 320, "CONNECTION_FORCED" )
+        with self.broker.condition:
+            self._callbacks.append( callback )
+            self.broker.condition.notify_all()
+
+    def consuming(self, ):
+        return any( len(channel._consumers) > 0 for channel in self._channels )
+
+    def process_data_events(self, time_limit=0):
+        if not self.is_open:
+            raise ConnectionClosed( 320, "CONNECTION_FORCED" )
+        if self.consuming() and self.broker.finished():
+            raise KeyboardInterrupt()
+        deadline = time.time() + (time_limit or 0)
+        while True:
+            handled = 0
+            while len(self._callbacks) > 0:
+                self._callbacks.popleft()()
+                handled = handled + 1
+            if not self.is_open:
+                raise ConnectionClosed( 320, "CONNECTION_FORCED" )
+            for channel in list(self._channels):
+                handled = handled + channel.deliver()
+            remaining = deadline - time.time()
+            if handled > 0 or remaining <= 0:
+                return
+            with self.broker.condition:
+                self.broker.condition.wait( min( remaining, 0.05 ) )
+
+    def close(self, ):
+        self.is_open = False
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class ChannelClosed(Exception):
+    pass
+
+
+def BasicProperties(**kwargs):
+    return kwargs
+
+
+def URLParameters(url):
+    return url
+
+
+def install(broker):
+    """Returns a module that can stand in for pika, backed by broker."""
+    global BROKER
+    BROKER = broker
+    module = types.ModuleType( "pika" )
+    module.BlockingConnection = FakeConnection
+    module.BasicProperties = BasicProperties
+    module.URLParameters = URLParameters
+    module.exceptions = types.ModuleType( "pika.exceptions" )
+    module.exceptions.ConnectionClosed = ConnectionClosed
+    module.exceptions.ChannelClosed = ChannelClosed
+    return module
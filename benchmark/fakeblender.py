@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""A stand-in for the Blender binary, for exercising renderers/Blender.py
+without Blender.
+
+It accepts the command lines the Blender renderers build, runs their -P
+script against a minimal bpy module and renders by writing a small JSON
+file where the image would go. Both the per-launch mode (-b scene.blend
+... -a) and the resident server (-b -P blender_server.py -- socket) work.
+
+The scene file is read as JSON:
+
+  content       copied into every output, so renders of different scene
+                files can be told apart
+  render_time   seconds per frame, 0.05 by default
+  crash_once    a path; while it exists the next render removes it and
+                kills the process, as a crashing Blender would
+
+Each output records its frame, seed and render border, the process id and
+how many scene files that process loaded.
+"""
+import json
+import os
+import sys
+import time
+import types
+
+
+class Struct(object):
+
+    def __init__(self, **fields):
+        self.__dict__.update( fields )
+
+
+class Scene(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.frame_current = 1
+        self.cycles = Struct( seed=0 )
+        self.render = Struct( resolution_x=64, resolution_y=48, resolution_percentage=100,
+                              use_border=False, use_crop_to_border=False,
+                              border_min_x=0.0, border_max_x=1.0, border_min_y=0.0, border_max_y=1.0,
+                              threads_mode="AUTO", threads=0, filepath="", use_file_extension=True,
+                              image_settings=Struct( file_format="PNG" ) )
+
+    def frame_set(self, frame):
+        self.frame_current = frame
+        for handler in bpy.app.handlers.frame_change_pre:
+            handler( self )
+
+
+STATE = { "settings": {}, "loads": 0 }
+
+def open_mainfile(filepath):
+    with open( filepath ) as f:
+        STATE["settings"] = json.load( f )
+    STATE["loads"] = STATE["loads"] + 1
+    bpy.data.scenes = [ Scene( "Scene" ) ]
+    bpy.context.scene = bpy.data.scenes[0]
+    sys.stdout.write( "Read blend: {0}\n".format( filepath ) )
+    sys.stdout.flush()
+
+def render(write_still=False):
+    scene = bpy.context.scene
+    settings = STATE["settings"]
+    crash = settings.get( "crash_once" )
+    for sample in range( 1, 5 ):
+        time.sleep( settings.get( "render_time", 0.05 ) / 4 )
+        sys.stdout.write( "Fra:{0} Mem:1.00M | Sample {1}/4\n".format( scene.frame_current, sample ) )
+        sys.stdout.flush()
+        if crash and os.path.exists( crash ):
+            os.remove( crash )
+            os._exit( 1 )
+    path = scene.render.filepath
+    if "#" in path:
+        path = path.replace( "########", "%08d" % scene.frame_current )
+    if scene.render.use_file_extension:
+        path = path + ".png"
+    border = scene.render
+    output = { "content": settings.get( "content" ),
+               "frame": scene.frame_current,
+               "seed": scene.cycles.seed,
+               "border": [ border.use_border, border.border_min_x, border.border_max_x,
+                           border.border_min_y, border.border_max_y ],
+               "pid": os.getpid(),
+               "loads": STATE["loads"] }
+    with open( path + ".partial", "w" ) as f:
+        json.dump( output, f )
+    os.rename( path + ".partial", path )
+    sys.stdout.write( "Saved: '{0}'\n Time: 00:00.05 (Saving: 00:00.00)\n".format( path ) )
+    sys.stdout.flush()
+
+bpy = types.ModuleType( "bpy" )
+bpy.ops = Struct( wm=Struct( open_mainfile=open_mainfile ), render=Struct( render=render ) )
+bpy.data = Struct( scenes=[] )
+bpy.context = Struct( scene=None )
+bpy.app = Struct( handlers=Struct( frame_change_pre=[] ) )
+
+def option(args, name, default=None):
+    if name in args:
+        return args[ args.index( name ) + 1 ]
+    return default
+
+
+if __name__ == "__main__":
+    sys.modules["bpy"] = bpy
+    args = sys.argv[1:]
+    if "--" in args:
+        args = args[:args.index( "--" )]
+    scene_file = option( args, "-b" )
+    if scene_file != None and not scene_file.startswith( "-" ):
+        open_mainfile( scene_file )
+    script = option( args, "-P" )
+    if script != None:
+        with open( script ) as f:
+            code = compile( f.read(), script, "exec" )
+        exec( code, { "__name__": "__main__" } )
+    if "-a" in args:
+        scene = bpy.context.scene
+        scene.render.filepath = option( args, "-o", "/tmp/render_########" )
+        for frame in range( int( option( args, "-s", 1 ) ), int( option( args, "-e", 1 ) ) + 1 ):
+            scene.frame_set( frame )
+            render( write_still=True )
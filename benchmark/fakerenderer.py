@@ -0,0 +1,188 @@
+"""A stand-in renderer for benchmarking the worker without Blender or prman.
+
+It follows the same contract as the modules in renderers/ (BuildRenderer,
+NodeType, Status, ...). Each launch runs a small child process that sleeps
+render_time seconds per frame, reports progress, and writes one output of
+output_size bytes for every label in outputs."""
+import os.path as osp
+import sys
+import time
+from subprocess import PIPE, Popen
+
+from renderers.logpipe import LogPipe
+
+# ("start", render_path, frames, time) for every launch and ("done",
+# render_path, frame, time) for every finished frame, read by the benchmark
+TIMELINE = []
+
+CHILD_SCRIPT = """
+import os, sys, time
+render_time = float(sys.argv[1])
+size = int(sys.argv[2])
+pattern = sys.argv[3]
+labels = sys.argv[4].split(",")
+frames = [int(frame) for frame in sys.argv[5:]]
+chunk = b"\\0" * 65536
+for frame in frames:
+    for step in range(10):
+        time.sleep(render_time / 10)
+        sys.stdout.write("Progress %d%%\\n" % ((step + 1) * 10))
+        sys.stdout.flush()
+    for label in labels:
+        path = pattern % (frame, label)
+        with open(path + ".partial", "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(chunk[:min(remaining, len(chunk))])
+                remaining -= len(chunk)
+        os.rename(path + ".partial", path)
+    sys.stdout.write("DONE %d %.6f\\n" % (frame, time.time()))
+    sys.stdout.flush()
+"""
+
+
+class FakeRenderNode:
+    """A container for a single fake rendering process."""
+
+    def __init__(self, **kwargs):
+        self._render_time = float(kwargs.get('render_time', 1.0))
+        self._output_size = int(kwargs.get('output_size', 1024 * 1024))
+        self._labels = kwargs.get('outputs', 'render').split(',')
+        self._render_path = kwargs.get('render_path', '/tmp')
+        self._scene = None
+        self._frame = None
+        self._frames = []
+        self._region = None
+        self._pending = []
+        self._finished = {}
+        self._process = None
+        self._logpipe = None
+        self._exit_callback = None
+        self._lastrt = -1
+        self._lastrender = {}
+        self._timeout = None
+
+    def NodeType(self, ):
+        return "FAKE"
+
+    def Extension(self, ):
+        return "exr"
+
+    def OutputFile(self, frame, label):
+        return osp.join( self._render_path, "fake_{:08d}.{:s}.exr".format( frame, label ) )
+
+    def SetExitCallback(self, callback):
+        self._exit_callback = callback
+
+    def SetScene(self, scene):
+        self._scene = scene
+
+    def SetFrame(self, frame):
+        self.SetFrames( [frame] )
+
+    def SetRegion(self, region):
+        self._region = region
+
+    def PrepareInputs(self, scene, frames):
+        TIMELINE.append( ( "prepare", self._render_path, list(frames), time.time() ) )
+
+    def SetTimeout(self, timeout):
+        self._timeout = timeout
+
+    def SetFrames(self, frames):
+        self._frames = sorted( frames )
+        self._frame = self._frames[0]
+        self._pending = list( self._frames )
+        self._finished = {}
+
+    def Status(self, ):
+        self.CheckStatus();
+        if self._process == None and self._lastrt == -1:
+            return "STOPPED"
+        if self._process == None and self._lastrt == 0:
+            return "SUCCESS"
+        if self._process == None and self._lastrt != 0:
+            return "FAILURE"
+        return "RUNNING"
+
+    def Log(self, ):
+        if self._logpipe != None:
+            return self._logpipe.read()
+        return ""
+
+    def parse_progress(self, line):
+        if line.startswith( "DONE " ):
+            parts = line.split()
+            TIMELINE.append( ( "done", self._render_path, int(parts[1]), float(parts[2]) ) )
+            return None
+        if line.startswith( "Progress " ):
+            return ( None, float( line.split()[1].rstrip('%') ) )
+        return None
+
+    def BeginRender(self, ):
+        self.StopRender()
+        TIMELINE.append( ( "start", self._render_path, list(self._pending), time.time() ) )
+        self._process = Popen( [ sys.executable, "-c", CHILD_SCRIPT,
+                                 str(self._render_time),
+                                 str(self._output_size),
+                                 osp.join( self._render_path, "fake_%08d.%s.exr" ),
+                                 ",".join( self._labels ) ] + [ str(frame) for frame in self._pending ],
+                               stdout=PIPE,
+                               stderr=PIPE )
+        self._logpipe = LogPipe( [ self._process.stdout, self._process.stderr ],
+                                 self.parse_progress, 1000, self._exit_callback )
+
+    def StopRender(self, ):
+        if self._process != None:
+            self._process.kill()
+            self._process.wait()
+            self._lastrt = self._process.returncode
+            self._logpipe.join()
+            self._process = None
+
+    def Shutdown(self, ):
+        self.StopRender()
+
+    def CollectFinishedFrames(self, ):
+        for frame in list(self._pending):
+            outputs = dict( (label, self.OutputFile( frame, label )) for label in self._labels )
+            if all( osp.exists( path ) for path in outputs.values() ):
+                self._finished[frame] = outputs
+                self._lastrender = outputs
+                self._pending.remove( frame )
+
+    def CheckStatus(self, ):
+        if self._process != None:
+            self._process.poll()
+            if self._process.returncode != None:
+                self._logpipe.join()
+                self._lastrt = self._process.returncode
+                self._process = None
+            self.CollectFinishedFrames()
+
+    def Progress(self, ):
+        if self._logpipe == None or len(self._pending) == 0:
+            return None
+        progress = self._logpipe.progress()
+        if progress == None:
+            return None
+        return ( self._pending[0], progress[1] )
+
+    def LoadedAt(self, ):
+        """When the current launch first reported progress, that is when it
+        had loaded the scene, or None."""
+        if self._logpipe == None:
+            return None
+        return self._logpipe.first_progress()
+
+    def TakeFinishedFrames(self, ):
+        finished = self._finished
+        self._finished = {}
+        return finished
+
+    def LastRender(self, ):
+        return dict( (label, open(path, 'rb')) for label, path in self._lastrender.items() )
+
+
+def BuildRenderer(kwargs):
+    return FakeRenderNode(**kwargs)
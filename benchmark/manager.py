@@ -0,0 +1,86 @@
+"""A stub of the Plumage manager's HTTP API for benchmarking.
+
+Serves /available_jobs (with ETags) and accepts /upload_render, draining
+each upload and recording when it arrived and how large it was."""
+import json
+import time
+import hashlib
+from threading import Thread, Lock
+from urlparse import urlparse, parse_qs
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class ManagerHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self, ):
+        url = urlparse( self.path )
+        if url.path != "/available_jobs":
+            self.send_error( 404 )
+            return
+        body = json.dumps( self.server.jobs )
+        etag = '"%s"' % hashlib.md5( body ).hexdigest()
+        if self.headers.get( 'If-None-Match' ) == etag:
+            self.send_response( 304 )
+            self.end_headers()
+            return
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str(len(body)) )
+        self.send_header( 'ETag', etag )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def do_POST(self, ):
+        url = urlparse( self.path )
+        if url.path != "/upload_render":
+            self.send_error( 404 )
+            return
+        uuid = parse_qs( url.query ).get( 'uuid', [''] )[0]
+        remaining = int( self.headers.get( 'Content-Length', 0 ) )
+        received = 0
+        while remaining > 0:
+            chunk = self.rfile.read( min( remaining, 65536 ) )
+            if not chunk:
+                break
+            received = received + len(chunk)
+            remaining = remaining - len(chunk)
+        self.server.record_upload( uuid, received )
+        self.send_response( 200 )
+        self.send_header( 'Content-Length', '0' )
+        self.end_headers()
+
+
+class StubManager(ThreadingMixIn, HTTPServer):
+    """Runs the stub manager on a background thread. jobs is the
+    /available_jobs list, [[job_id, render_type], ...]."""
+
+    daemon_threads = True
+
+    def __init__(self, jobs, port=0):
+        HTTPServer.__init__( self, ('127.0.0.1', port), ManagerHandler )
+        self.jobs = jobs
+        self.uploads = {}
+        self._lock = Lock()
+        self._thread = Thread( target=self.serve_forever )
+        self._thread.daemon = True
+
+    def url(self, ):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def record_upload(self, uuid, size):
+        with self._lock:
+            upload = self.uploads.setdefault( uuid, { "bytes": 0, "files": 0 } )
+            upload["bytes"] = upload["bytes"] + size
+            upload["files"] = upload["files"] + 1
+            upload["time"] = time.time()
+
+    def start(self, ):
+        self._thread.start()
+
+    def stop(self, ):
+        self.shutdown()
+        self.server_close()
@@ -1 +1,12 @@
 from rendernode import RenderNode
+from uploader import RenderUploader
+from events import EventPublisher, DateTimeEncoder
+from scenecache import SceneCache
+from resources import ResourceMonitor
+from metrics import PhaseMetrics, MetricsServer, job_phases
+from spool import RenderSpool
+from postprocess import PostProcessor
+from history import RenderHistory
+from loader import RendererLoader
+from resultcache import ResultCache, link_or_copy
+from prefetch import InputPrefetcher
@@ -0,0 +1,131 @@
+import logging
+import datetime
+import json
+import socket
+import time
+from collections import deque
+from threading import Thread, Condition
+
+import pika
+
+LOGGER = logging.getLogger("Events")
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            encoded_object = list(obj.timetuple())[0:6]
+        else:
+            encoded_object =json.JSONEncoder.default(self, obj)
+        return encoded_object
+
+
+class EventPublisher(Thread):
+    """Publishes render lifecycle events to the log queue.
+
+    Events are serialized and buffered in memory by the caller, then sent in
+    batches from this thread over its own broker connection, with publisher
+    confirms. An event only leaves the buffer once the broker confirmed it,
+    so events lost to a reconnect are sent again. The blocking channel waits
+    for each confirm before the next publish, so a batch costs a round trip
+    per event; that wait is on this thread, never on the render loop. The
+    buffer is bounded; when it is full the oldest events are dropped."""
+
+    def __init__(self, comm_host, queue="log_queue", buffer_size=10000,
+                 batch_size=100, flush_interval=0.5):
+        Thread.__init__(self)
+        self.daemon = True
+        self._comm_host = comm_host
+        self._queue = queue
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = deque( maxlen=buffer_size )
+        self._condition = Condition()
+        self._running = True
+        self._connection = None
+        self._channel = None
+        self._properties = pika.BasicProperties(
+            delivery_mode = 2,
+            app_id = socket.gethostname(),
+            content_type = "application/json",
+        )
+
+    def publish(self, event, **fields):
+        """Queues an event for publishing. Never blocks on the broker."""
+        fields["event"] = event
+        if "time" not in fields:
+            fields["time"] = datetime.datetime.now()
+        body = json.dumps( fields, cls=DateTimeEncoder )
+        with self._condition:
+            if len(self._buffer) == self._buffer.maxlen:
+                LOGGER.warning("Event buffer is full, dropping the oldest event.")
+            self._buffer.append( body )
+            if len(self._buffer) >= self._batch_size:
+                self._condition.notify()
+
+    def pending(self, ):
+        with self._condition:
+            return len(self._buffer)
+
+    def stop(self, timeout=5):
+        """Stops the publisher, giving it up to timeout seconds to flush."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self.join( timeout )
+
+    def _connect(self, ):
+        parameters = pika.URLParameters( self._comm_host )
+        self._connection = pika.BlockingConnection( parameters )
+        self._channel = self._connection.channel()
+        self._channel.queue_declare(queue=self._queue,
+                                    durable=True,
+                                    exclusive=False,
+                                    auto_delete=False)
+        self._channel.confirm_delivery()
+
+    def _disconnect(self, ):
+        try:
+            if self._connection != None:
+                self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+        self._channel = None
+
+    def _flush(self, ):
+        with self._condition:
+            batch = [ self._buffer[i] for i in range( min( self._batch_size, len(self._buffer) ) ) ]
+        for body in batch:
+            # Returns once the broker confirmed the event, False if it nacked it
+            if not self._channel.basic_publish( exchange='', routing_key=self._queue,
+                                                body=body, properties=self._properties ):
+                raise RuntimeError( "the broker refused an event" )
+            with self._condition:
+                # Only drop what we sent; the buffer may have rotated while unlocked
+                if len(self._buffer) > 0 and self._buffer[0] is body:
+                    self._buffer.popleft()
+        return len(batch)
+
+    def run(self, ):
+        backoff = 1
+        while True:
+            with self._condition:
+                if self._running and len(self._buffer) < self._batch_size:
+                    self._condition.wait( self._flush_interval )
+                if not self._running and len(self._buffer) == 0:
+                    break
+            try:
+                if self._connection == None:
+                    self._connect()
+                    backoff = 1
+                if self._flush() == 0:
+                    self._connection.process_data_events()
+            except Exception, e:
+                LOGGER.warning("Failed to publish events (%d pending): %s", self.pending(), str(e))
+                self._disconnect()
+                if not self._running:
+                    break
+                time.sleep( backoff )
+                backoff = min( backoff * 2, 30 )
+        self._disconnect()
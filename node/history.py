@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import logging
+
+LOGGER = logging.getLogger("History")
+
+
+def percentile(values, fraction):
+    values = sorted( values )
+    return values[ min( len(values) - 1, int( fraction * len(values) ) ) ]
+
+
+class RenderHistory:
+    """A compact local record of how long frames of each (scene, renderer)
+    take, used to derive per-scene render timeouts.
+
+    The newest max_samples durations of each pair are kept in a JSON file,
+    for at most max_entries pairs (the least recently rendered are dropped).
+    Once a pair has min_samples durations its timeout is the chosen
+    percentile times factor, clamped between min_timeout and max_timeout."""
+
+    def __init__(self, path, max_samples=50, max_entries=1000, min_samples=3,
+                 percentile=0.95, factor=3.0, min_timeout=300, max_timeout=86400):
+        self._path = path
+        self._max_samples = max_samples
+        self._max_entries = max_entries
+        self._min_samples = min_samples
+        self._percentile = percentile
+        self._factor = factor
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._entries = {}
+        try:
+            with open( path ) as f:
+                self._entries = json.load( f )
+        except (IOError, OSError, ValueError):
+            pass
+
+    def key(self, scene, render_type):
+        return "{:s}|{:s}".format( render_type, scene )
+
+    def record(self, scene, render_type, seconds):
+        entry = self._entries.setdefault( self.key( scene, render_type ), { "samples": [] } )
+        entry["samples"] = ( entry["samples"] + [ round( seconds, 1 ) ] )[-self._max_samples:]
+        entry["updated"] = int( time.time() )
+        if len(self._entries) > self._max_entries:
+            oldest = sorted( self._entries.keys(), key=lambda key: self._entries[key].get( "updated", 0 ) )
+            for key in oldest[:len(self._entries) - self._max_entries]:
+                del self._entries[key]
+        self.save()
+
+    def save(self, ):
+        partial = self._path + ".partial"
+        try:
+            with open( partial, 'w' ) as f:
+                json.dump( self._entries, f )
+            os.rename( partial, self._path )
+        except (IOError, OSError), e:
+            LOGGER.warning("Failed to save the render history: %s", str(e))
+
+    def timeout(self, scene, render_type):
+        """The timeout in seconds for a frame of scene, or None while there
+        is too little history to judge."""
+        entry = self._entries.get( self.key( scene, render_type ) )
+        if entry == None or len(entry["samples"]) < self._min_samples:
+            return None
+        timeout = percentile( entry["samples"], self._percentile ) * self._factor
+        return min( self._max_timeout, max( self._min_timeout, timeout ) )
+
+    def expected(self, scene, render_type):
+        """The median frame time of scene, or None while there is too
+        little history to judge."""
+        entry = self._entries.get( self.key( scene, render_type ) )
+        if entry == None or len(entry["samples"]) < self._min_samples:
+            return None
+        return percentile( entry["samples"], 0.5 )
+
+    def stats(self, scenes=None):
+        """Per (scene, renderer) frame counts and times, for status updates;
+        only for the (scene, renderer) pairs in scenes if given."""
+        stats = []
+        for key, entry in self._entries.items():
+            render_type, scene = key.split( "|", 1 )
+            if scenes != None and ( scene, render_type ) not in scenes:
+                continue
+            samples = entry["samples"]
+            if len(samples) == 0:
+                continue
+            stats.append( { "scene": scene,
+                            "type": render_type,
+                            "count": len(samples),
+                            "median": percentile( samples, 0.5 ),
+                            "p95": percentile( samples, 0.95 ),
+                            "max": max( samples ),
+                            "timeout": self.timeout( scene, render_type ) } )
+        return stats
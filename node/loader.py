@@ -0,0 +1,131 @@
+import os
+import logging
+import importlib
+import ConfigParser
+
+LOGGER = logging.getLogger("Renderers")
+
+
+def read_specs(config):
+    """Returns job type -> renderer section options for every module enabled
+    in [modules]. A section may set its job type with type=, which defaults
+    to the section name in upper case."""
+    specs = {}
+    for section in config.options('modules'):
+        if not config.getboolean( 'modules', section ):
+            continue
+        options = dict( config.items( section ) )
+        specs[ options.pop( 'type', section.upper() ) ] = options
+    return specs
+
+
+class RendererLoader:
+    """Builds the renderers enabled in [modules] when they are first needed.
+
+    A renderer is imported and built for a slot the first time that slot is
+    handed a job of its type. reload() re-reads the config file; renderers
+    whose section changed are rebuilt the next time their slot is between
+    frames, so a running render is never interrupted. A type whose renderer
+    fails to import or build is no longer handled until the next reload."""
+
+    def __init__(self, config, config_path=None, scene_path="/tmp", scene_cache=None,
+                 threads=0, exit_callback=None, save_path="/tmp"):
+        self._config_path = config_path
+        self._scene_path = scene_path
+        self._save_path = save_path
+        self._scene_cache = scene_cache
+        self._threads = threads
+        self._exit_callback = exit_callback
+        self._specs = read_specs( config )
+        self._built = {}
+        self._failed = {}
+        self._mtime = self.config_mtime()
+
+    def types(self, ):
+        return [ render_type for render_type in self._specs.keys() if render_type not in self._failed ]
+
+    def can_handle(self, render_type):
+        return render_type in self._specs and render_type not in self._failed
+
+    def failures(self, ):
+        """job type -> error of every renderer that failed to build."""
+        return dict( self._failed )
+
+    def settings(self, render_type):
+        return dict( self._specs[render_type] )
+
+    def deterministic(self, render_type):
+        """Whether renders of render_type are reproducible, set per section
+        with deterministic=, so their results may be reused."""
+        value = self._specs.get( render_type, {} ).get( 'deterministic', 'off' )
+        return str(value).lower() in ( 'on', 'true', 'yes', '1' )
+
+    def config_mtime(self, ):
+        if self._config_path == None:
+            return None
+        try:
+            return os.path.getmtime( self._config_path )
+        except OSError:
+            return None
+
+    def config_changed(self, ):
+        mtime = self.config_mtime()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        return True
+
+    def reload(self, ):
+        """Re-reads the renderer sections of the config file. Returns the job
+        types whose renderers changed."""
+        if self._config_path == None:
+            return []
+        try:
+            config = ConfigParser.SafeConfigParser()
+            if len( config.read( [ self._config_path ] ) ) == 0:
+                raise IOError( "cannot read the file" )
+            specs = read_specs( config )
+        except Exception, e:
+            LOGGER.warning("Failed to reload %s, keeping the current renderers: %s", self._config_path, str(e))
+            return []
+        changed = sorted( render_type for render_type in set( specs.keys() + self._specs.keys() )
+                          if specs.get( render_type ) != self._specs.get( render_type ) )
+        self._specs = specs
+        if len(self._failed) > 0:
+            LOGGER.info("Retrying the %s renderers", ", ".join( sorted( self._failed.keys() ) ))
+            self._failed = {}
+        if len(changed) > 0:
+            LOGGER.info("Renderer config changed for %s", ", ".join( changed ))
+        return changed
+
+    def prepare(self, render_slot, render_type):
+        """Makes sure render_slot has a renderer for render_type built from
+        the current config. Only call this while the slot is between frames."""
+        options = self._specs[render_type]
+        key = ( render_slot.slot, render_type )
+        if self._built.get( key ) == options:
+            return
+        old = render_slot.renderer( render_type )
+        if old != None:
+            LOGGER.info("Rebuilding the %s renderer of slot %d", render_type, render_slot.slot)
+            old.Shutdown()
+        else:
+            LOGGER.info("Loading the %s renderer for slot %d", render_type, render_slot.slot)
+        try:
+            module = importlib.import_module( options['module'] )
+            renderer_args = dict( options )
+            renderer_args["scene_path"] = self._scene_path
+            renderer_args["render_path"] = render_slot.render_path
+            renderer_args["save_path"] = self._save_path
+            renderer_args["scene_cache"] = self._scene_cache
+            renderer_args.setdefault( "threads", self._threads )
+            renderer = module.BuildRenderer( renderer_args )
+        except Exception, e:
+            self._failed[render_type] = str(e)
+            raise
+        if renderer.NodeType() != render_type:
+            LOGGER.warning("Renderer for %s jobs reports its type as %s", render_type, renderer.NodeType())
+        if self._exit_callback != None:
+            renderer.SetExitCallback( self._exit_callback )
+        render_slot.register_renderer( render_type, renderer )
+        self._built[key] = options
@@ -0,0 +1,141 @@
+import os
+import logging
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+LOGGER = logging.getLogger("Metrics")
+
+# Upper bounds in seconds, from upload-sized phases up to hero frames
+PHASE_BUCKETS = [ 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400 ]
+
+# (phase, start, end) over the timestamps kept in a job's "times"
+PHASES = [ ( "queue_wait", "received", "launched" ),
+           ( "scene_load", "launched", "loaded" ),
+           ( "render", "started", "rendered" ),
+           ( "spool", "rendered", "spooled" ) ]
+
+
+def job_phases(times):
+    """Returns phase -> seconds for every phase whose start and end are both
+    in times."""
+    return dict( ( phase, times[end] - times[start] ) for phase, start, end in PHASES
+                 if start in times and end in times )
+
+def label_value(value):
+    return str(value).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count = self.count + 1
+        self.sum = self.sum + value
+        for index, bound in enumerate( self.buckets ):
+            if value <= bound:
+                self.counts[index] = self.counts[index] + 1
+
+
+class PhaseMetrics:
+    """Histograms of the wall time jobs spend in each phase, per renderer
+    type, counts of frames by result and counts of frames whose upload was
+    given up. Safe to use from any thread."""
+
+    def __init__(self, buckets=PHASE_BUCKETS):
+        self._buckets = buckets
+        self._histograms = {}
+        self._frames = {}
+        self._upload_failures = {}
+        self._lock = Lock()
+
+    def observe(self, phase, render_type, seconds):
+        with self._lock:
+            key = ( phase, render_type )
+            if key not in self._histograms:
+                self._histograms[key] = Histogram( self._buckets )
+            self._histograms[key].observe( max( 0.0, seconds ) )
+
+    def observe_job(self, job, result):
+        """Records every phase of a settled job and counts it under result."""
+        for phase, seconds in job_phases( job.get( "times", {} ) ).items():
+            self.observe( phase, job["type"], seconds )
+        with self._lock:
+            key = ( result, job["type"] )
+            self._frames[key] = self._frames.get( key, 0 ) + 1
+
+    def upload_failed(self, render_type):
+        with self._lock:
+            self._upload_failures[render_type] = self._upload_failures.get( render_type, 0 ) + 1
+
+    def render(self, ):
+        """The metrics in the Prometheus text exposition format."""
+        lines = [ "# HELP plumage_job_phase_seconds Wall time spent by render jobs in each phase.",
+                  "# TYPE plumage_job_phase_seconds histogram" ]
+        with self._lock:
+            for ( phase, render_type ), histogram in sorted( self._histograms.items() ):
+                labels = 'phase="{:s}",type="{:s}"'.format( label_value( phase ), label_value( render_type ) )
+                for bound, count in zip( histogram.buckets, histogram.counts ):
+                    lines.append( 'plumage_job_phase_seconds_bucket{%s,le="%s"} %d' % ( labels, repr(float(bound)), count ) )
+                lines.append( 'plumage_job_phase_seconds_bucket{%s,le="+Inf"} %d' % ( labels, histogram.count ) )
+                lines.append( 'plumage_job_phase_seconds_sum{%s} %s' % ( labels, repr(histogram.sum) ) )
+                lines.append( 'plumage_job_phase_seconds_count{%s} %d' % ( labels, histogram.count ) )
+            lines.append( "# HELP plumage_frames_total Render frames settled by this node, by result." )
+            lines.append( "# TYPE plumage_frames_total counter" )
+            for ( result, render_type ), count in sorted( self._frames.items() ):
+                lines.append( 'plumage_frames_total{result="%s",type="%s"} %d' % ( label_value( result ), label_value( render_type ), count ) )
+            lines.append( "# HELP plumage_upload_failures_total Rendered frames whose upload was given up." )
+            lines.append( "# TYPE plumage_upload_failures_total counter" )
+            for render_type, count in sorted( self._upload_failures.items() ):
+                lines.append( 'plumage_upload_failures_total{type="%s"} %d' % ( label_value( render_type ), count ) )
+        return "\n".join( lines ) + "\n"
+
+    def write_textfile(self, path):
+        """Writes the metrics for node_exporter's textfile collector. The file
+        is replaced atomically so a scrape never sees half of it."""
+        partial = path + ".tmp"
+        with open( partial, 'w' ) as textfile:
+            textfile.write( self.render() )
+        os.rename( partial, path )
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self, ):
+        if self.path.split('?')[0] not in [ "/", "/metrics" ]:
+            self.send_error( 404 )
+            return
+        body = self.server.metrics.render()
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'text/plain; version=0.0.4' )
+        self.send_header( 'Content-Length', str(len(body)) )
+        self.end_headers()
+        self.wfile.write( body )
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """Serves a PhaseMetrics at /metrics from a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, metrics, port, host=''):
+        HTTPServer.__init__( self, (host, port), MetricsHandler )
+        self.metrics = metrics
+        self._thread = Thread( target=self.serve_forever )
+        self._thread.daemon = True
+
+    def start(self, ):
+        self._thread.start()
+        LOGGER.info("Serving metrics on port %d", self.server_address[1])
+
+    def stop(self, ):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,147 @@
+import os
+import os.path as osp
+import re
+import time
+import signal
+import logging
+import tempfile
+import subprocess
+from multiprocessing import Pool
+
+LOGGER = logging.getLogger("PostProcess")
+
+STATS_PATTERN = re.compile( r'^\s*Stats (Min|Max|Avg|StdDev|NanCount|InfCount|FiniteCount): (.*)$' )
+
+
+def run_tool(command, deadline):
+    """Runs command and returns its output, killing it once deadline
+    passes. Raises like subprocess.check_output."""
+    with tempfile.TemporaryFile() as output:
+        if time.time() >= deadline:
+            raise RuntimeError( "out of time before running {:s}".format( command[0] ) )
+        # In a session of its own, so whatever it started is killed with it
+        process = subprocess.Popen( command, stdout=output, preexec_fn=os.setsid )
+        while process.poll() == None:
+            if time.time() >= deadline:
+                os.killpg( process.pid, signal.SIGKILL )
+                process.wait()
+                raise RuntimeError( "{:s} ran out of time".format( command[0] ) )
+            time.sleep( 0.05 )
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError( process.returncode, command )
+        output.seek( 0 )
+        return output.read()
+
+def recompress(tool, path, compression, deadline):
+    """Rewrites an EXR with another compression codec, in place."""
+    partial = path + ".partial.exr"
+    run_tool( [ tool, path, "--compression", compression, "-o", partial ], deadline )
+    os.rename( partial, path )
+
+def make_preview(tool, path, preview, size, deadline):
+    command = [ tool, path, "--ch", "R,G,B", "--fit", "{:d}x{:d}".format( size, size ) ]
+    if path.endswith( ".exr" ):
+        command = command + [ "--colorconvert", "linear", "sRGB" ]
+    run_tool( command + [ "-o", preview ], deadline )
+
+def image_stats(tool, path, deadline):
+    """Per channel statistics as reported by oiiotool --stats."""
+    stats = {}
+    output = run_tool( [ tool, "--stats", path ], deadline )
+    for line in output.splitlines():
+        match = STATS_PATTERN.match( line )
+        if match == None:
+            continue
+        values = []
+        for value in match.group(2).split():
+            try:
+                values.append( float( value ) )
+            except ValueError:
+                pass
+        stats[match.group(1)] = values
+    return stats
+
+def process_outputs(outputs, options, deadline):
+    """Post-processes the outputs (label -> path) of one frame. Runs in a pool
+    process, so it only takes and returns plain data. Nothing is started
+    past deadline, as by then the outputs may be uploading as rendered.
+
+    Returns the new outputs it created (label -> path), the statistics of
+    every label and the bytes before and after recompression, or the error
+    that stopped it."""
+    result = { "outputs": {}, "stats": {}, "bytes_before": 0, "bytes_after": 0 }
+    tool = options["tool"]
+    try:
+        for label, path in sorted( outputs.items() ):
+            if options["exr_compression"] and path.endswith( ".exr" ):
+                result["bytes_before"] = result["bytes_before"] + osp.getsize( path )
+                recompress( tool, path, options["exr_compression"], deadline )
+                result["bytes_after"] = result["bytes_after"] + osp.getsize( path )
+            if options["stats"]:
+                result["stats"][label] = image_stats( tool, path, deadline )
+        if options["preview_size"] > 0 and len(outputs) > 0:
+            label = options["preview_label"]
+            if label not in outputs:
+                label = sorted( outputs.keys() )[0]
+            preview = osp.join( osp.dirname( outputs[label] ), "preview.jpg" )
+            make_preview( tool, outputs[label], preview, options["preview_size"], deadline )
+            result["outputs"]["preview"] = preview
+    except Exception, e:
+        result["error"] = str(e)
+    return result
+
+
+class PostProcessor:
+    """Runs the optional post-render stage (EXR recompression, a preview
+    thumbnail and image statistics, all through oiiotool) in a pool of
+    worker processes, so it overlaps with the next render.
+
+    Each job gets timeout seconds for every turn it waits behind the jobs
+    already queued. Past that deadline it is reported as failed, whether
+    its tool hung or the pool lost it with a dead worker, so its outputs
+    are uploaded as rendered."""
+
+    def __init__(self, workers=2, notify=None, timeout=600, **options):
+        self._options = { "tool": options.get( "tool", "oiiotool" ),
+                          "exr_compression": options.get( "exr_compression", "" ),
+                          "preview_size": int( options.get( "preview_size", 256 ) ),
+                          "preview_label": options.get( "preview_label", "beauty" ),
+                          "stats": options.get( "stats", True ) }
+        self._notify = notify
+        self._workers = max( 1, workers )
+        self._timeout = timeout
+        self._pool = Pool( self._workers )
+        self._running = []
+
+    def submit(self, job, outputs):
+        deadline = time.time() + self._timeout * ( 1 + len(self._running) // self._workers )
+        result = self._pool.apply_async( process_outputs, ( outputs, self._options, deadline ),
+                                         callback=self._processed )
+        self._running.append( ( job, result, deadline ) )
+
+    def _processed(self, result):
+        if self._notify != None:
+            self._notify()
+
+    def pending(self, ):
+        return len(self._running)
+
+    def finished(self, ):
+        """Returns (job, result) for every job whose processing is done or
+        past its deadline."""
+        finished = []
+        running = []
+        now = time.time()
+        for job, result, deadline in self._running:
+            if result.ready():
+                finished.append( ( job, result.get() ) )
+            elif now >= deadline:
+                finished.append( ( job, { "error": "no result within its deadline" } ) )
+            else:
+                running.append( ( job, result, deadline ) )
+        self._running = running
+        return finished
+
+    def close(self, ):
+        self._pool.close()
+        self._pool.join()
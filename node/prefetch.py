@@ -0,0 +1,42 @@
+import time
+import logging
+from threading import Thread
+from Queue import Queue
+
+LOGGER = logging.getLogger("Prefetch")
+
+
+class InputPrefetcher(Thread):
+    """Reads the inputs of frames waiting for a slot, one at a time in the
+    background, so their renders start on warm caches."""
+
+    def __init__(self, metrics=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self._metrics = metrics
+        self._queue = Queue()
+
+    def submit(self, job, renderer):
+        self._queue.put( ( job, renderer ) )
+
+    def stop(self, ):
+        self._queue.put( None )
+
+    def run(self, ):
+        while True:
+            item = self._queue.get()
+            if item == None:
+                return
+            job, renderer = item
+            # Already running, or handed back to the broker
+            if "launched" in job["times"] or job.get( "released" ):
+                continue
+            start = time.time()
+            try:
+                renderer.PrepareInputs( job["scene"], [ job["frame"] ] )
+            except Exception, e:
+                LOGGER.warning("Failed to prepare frame %s of %s: %s", str(job["frame"]), job["scene"], str(e))
+                continue
+            job["times"]["prepared"] = time.time()
+            if self._metrics != None:
+                self._metrics.observe( "prepare", job["type"], time.time() - start )
@@ -1,21 +1,40 @@
+import os
 import os.path as osp
 import uuid
+import time
 
 class RenderNode:
-    """A generic container for managing a single instance of a renderer."""
+    """A generic container for managing a single render slot and its renderers.
 
-    _current_engine = ""
-    _render_engines = dict()
-    _last_render_info = dict()
-    _active_engine = ""
+    A slot runs one renderer launch at a time, which may cover a batch of
+    consecutive frames. Each frame is tracked as a job (a dict holding its
+    frame, uuid, scene, type and broker delivery tag) until its outputs
+    have been handed to the spool or the render has failed. Its "times" record when it
+    was launched, loaded, started and rendered."""
 
-    def __init__(self):
-        pass
+    def __init__(self, slot=0, render_path="/tmp"):
+        self.slot = slot
+        self.render_path = render_path
+        self.jobs = dict()
+        self.rendering = False
+        self.idle_since = None
+        self._frame_start = None
+        self._current_engine = ""
+        self._render_engines = dict()
+        self._last_render_info = dict()
+        self._active_engine = ""
 
     def register_renderer(self, key, engine):
         self._render_engines[key] = engine
         self._active_engine = key
-        
+
+    def renderer(self, key):
+        return self._render_engines.get( key )
+
+    def set_exit_callback(self, callback):
+        for engine in self._render_engines.values():
+            engine.SetExitCallback( callback )
+
     def set_active_engine(self, key ):
         self._active_engine = key
 
@@ -25,35 +44,128 @@ class RenderNode:
         else:
             return False
 
+    def is_free(self, ):
+        return len(self.jobs) == 0 and not self.rendering
+
     def render_single_frame( self, scene_file, frame_number, uuid ):
         self.render_single_frame_of_type( scene_file, frame_number, uuid, self._active_engine)
-        
+
     def render_single_frame_of_type(self, scene_file, frame_number, uuid, render_type ):
+        self.render_frames_of_type( scene_file,
+                                    [ { "frame": frame_number, "uuid": uuid, "tag": None } ],
+                                    render_type )
+
+    def render_frames_of_type(self, scene_file, jobs, render_type, timeout=None ):
+        """Starts a single renderer launch covering every job in jobs, which
+        must be consecutive frames of scene_file with the same region. timeout
+        overrides the renderer's configured per-frame timeout."""
         self.set_active_engine( render_type )
+        now = time.time()
+        for job in jobs:
+            job.setdefault( "times", {} )["launched"] = now
+            job["scene"] = scene_file
+            job["type"] = render_type
+            job["slot"] = self.slot
+        self.jobs = dict( (job["frame"], job) for job in jobs )
+        self._render_engines[render_type].SetTimeout( timeout )
+        self._render_engines[render_type].SetRegion( jobs[0].get( "region" ) )
         self._render_engines[render_type].SetScene( scene_file )
-        self._render_engines[render_type].SetFrame( frame_number )
+        self._render_engines[render_type].SetFrames( [ job["frame"] for job in jobs ] )
         self._render_engines[render_type].BeginRender();
-        
-        self._last_render_info["frame"] = frame_number
-        self._last_render_info["scene"] = scene_file
-        self._last_render_info["uuid"] = uuid
-        self._last_render_info["type"] = render_type
-        
+        self.rendering = True
+        self.idle_since = None
+        self._frame_start = None
+        self._last_render_info = jobs[0]
+
+    def finished_jobs(self, ):
+        """Returns (job, outputs) for every frame the renderer completed since
+        the last call, where outputs maps label -> path."""
+        finished = []
+        engine = self._render_engines[self._active_engine]
+        frames = engine.TakeFinishedFrames()
+        now = time.time()
+        for frame in sorted( frames.keys() ):
+            if frame in self.jobs:
+                job = self.jobs[frame]
+                # The first frame of a launch starts once the scene is loaded,
+                # the others when the frame before them finished
+                if self._frame_start == None:
+                    self._frame_start = job["times"]["launched"]
+                    loaded = engine.LoadedAt()
+                    if loaded != None and loaded < now:
+                        job["times"]["loaded"] = loaded
+                        self._frame_start = loaded
+                job["times"]["started"] = self._frame_start
+                job["times"]["rendered"] = now
+                self._frame_start = now
+                self._last_render_info = job
+                finished.append( ( job, frames[frame] ) )
+        return finished
+
+    def progress(self, ):
+        """Returns (job, percent) for the frame being rendered, or None."""
+        progress = self._render_engines[self._active_engine].Progress()
+        if progress == None or progress[0] not in self.jobs:
+            return None
+        return ( self.jobs[progress[0]], progress[1] )
+
+    def describe(self, ):
+        """A summary of the slot for status updates: idle, loading its scene
+        or rendering, with the frames it holds and the renderers it has."""
+        description = { "slot": self.slot,
+                        "state": "idle",
+                        "renderers": sorted( self._render_engines.keys() ) }
+        if not self.rendering:
+            return description
+        engine = self._render_engines[self._active_engine]
+        description["state"] = "rendering" if engine.LoadedAt() != None else "loading"
+        description["type"] = self._active_engine
+        description["scene"] = self._last_render_info.get( "scene" )
+        description["frames"] = sorted( self.jobs.keys() )
+        if self._last_render_info.get( "region" ) != None:
+            description["region"] = self._last_render_info["region"]
+        progress = self.progress()
+        if progress != None:
+            description["frame"] = progress[0]["frame"]
+            description["uuid"] = progress[0]["uuid"]
+            description["progress"] = round( progress[1], 1 )
+        return description
+
+    def frame_started(self, ):
+        """When the frame being rendered started, as far as is known yet."""
+        if self._frame_start != None:
+            return self._frame_start
+        return min( [ job["times"]["launched"] for job in self.jobs.values() ] or [ time.time() ] )
+
+    def unfinished_jobs(self, ):
+        """Jobs still waiting on the renderer; finished ones leave the slot."""
+        return list( self.jobs.values() )
+
+    def remove_job(self, job):
+        self.jobs.pop( job["frame"], None )
+
     def status(self, ):
         s = self._render_engines[self._active_engine].Status();
         return s;
-    
+
     def last_log(self, ):
         log = self._render_engines[self._active_engine].Log();
         return log
 
     def extension(self, ):
         return self._render_engines[self._active_engine].Extension();
-    
+
     def last_render(self, ):
         return self._render_engines[self._active_engine].LastRender()
-                                                                          
+
+    def clear_outputs(self, outputs):
+        for path in outputs.values():
+            try:
+                os.remove( path );
+            except OSError:
+                pass
+
     def last_render_info(self):
         return self._last_render_info
 
-    
+
@@ -0,0 +1,129 @@
+import os
+import logging
+import multiprocessing
+import time
+
+LOGGER = logging.getLogger("Resources")
+
+
+def read_first_line(path):
+    try:
+        with open( path, 'r' ) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+def parse_cpu_list(text):
+    """Counts the cpus in a list such as '0-3,8,10-11'."""
+    count = 0
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            low, high = part.split('-')
+            count = count + int(high) - int(low) + 1
+        elif part:
+            count = count + 1
+    return count
+
+
+class ResourceMonitor:
+    """Reads the cores, memory and load available to this node from /proc
+    and the cgroup (v1 or v2) it runs in.
+
+    Samples are cached for sample_interval seconds, since admission checks
+    run on every dispatch."""
+
+    def __init__(self, max_load=2.0, min_free_memory=1024, sample_interval=1.0):
+        self._max_load = max_load
+        self._min_free_memory = min_free_memory
+        self._sample_interval = sample_interval
+        self._sample = None
+        self._sample_time = 0
+        self._cores = self.detect_cores()
+        self._memory_limit = self.detect_memory_limit()
+        LOGGER.info("Node has %d cores and %d MB of memory available", self._cores, self._memory_limit / (1024 * 1024))
+
+    def cores(self, ):
+        return self._cores
+
+    def memory_limit(self, ):
+        return self._memory_limit
+
+    def detect_cores(self, ):
+        cores = multiprocessing.cpu_count()
+        try:
+            with open( "/proc/self/status" ) as status:
+                for line in status:
+                    if line.startswith( "Cpus_allowed_list:" ):
+                        cores = min( cores, parse_cpu_list( line.split(':', 1)[1] ) )
+        except (IOError, OSError):
+            pass
+        # cgroup v2
+        quota = read_first_line( "/sys/fs/cgroup/cpu.max" )
+        if quota != None and not quota.startswith( "max" ):
+            limit, period = quota.split()
+            cores = min( cores, max( 1, int( float(limit) / float(period) + 0.5 ) ) )
+        # cgroup v1
+        limit = read_first_line( "/sys/fs/cgroup/cpu/cpu.cfs_quota_us" )
+        period = read_first_line( "/sys/fs/cgroup/cpu/cpu.cfs_period_us" )
+        if limit != None and period != None and int(limit) > 0:
+            cores = min( cores, max( 1, int( float(limit) / float(period) + 0.5 ) ) )
+        return max( 1, cores )
+
+    def detect_memory_limit(self, ):
+        limit = self.meminfo().get( "MemTotal", 0 )
+        for path in [ "/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes" ]:
+            value = read_first_line( path )
+            if value != None and value.isdigit() and int(value) > 0:
+                limit = min( limit, int(value) )
+        return limit
+
+    def meminfo(self, ):
+        """Returns /proc/meminfo in bytes."""
+        info = {}
+        try:
+            with open( "/proc/meminfo" ) as meminfo:
+                for line in meminfo:
+                    parts = line.split()
+                    info[parts[0].rstrip(':')] = int( parts[1] ) * 1024
+        except (IOError, OSError):
+            pass
+        return info
+
+    def free_memory(self, ):
+        """Bytes of memory still available to this node."""
+        info = self.meminfo()
+        free = info.get( "MemAvailable", info.get( "MemFree", 0 ) )
+        for path in [ "/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory/memory.usage_in_bytes" ]:
+            value = read_first_line( path )
+            if value != None and value.isdigit():
+                free = min( free, self._memory_limit - int(value) )
+                break
+        return max( 0, free )
+
+    def load(self, ):
+        """One minute load average per available core."""
+        return os.getloadavg()[0] / self._cores
+
+    def sample(self, ):
+        now = time.time()
+        if self._sample == None or now - self._sample_time >= self._sample_interval:
+            self._sample = { "cores": self._cores,
+                             "memory": self._memory_limit,
+                             "free_memory": self.free_memory(),
+                             "load": self.load() }
+            self._sample_time = now
+        return self._sample
+
+    def threads_per_slot(self, slots):
+        return max( 1, self._cores // max( 1, slots ) )
+
+    def overloaded(self, ):
+        """True while load or memory use is past the configured thresholds.
+        A threshold of 0 disables that check."""
+        sample = self.sample()
+        if self._max_load > 0 and sample["load"] > self._max_load:
+            return True
+        if self._min_free_memory > 0 and sample["free_memory"] < self._min_free_memory * 1024 * 1024:
+            return True
+        return False
@@ -0,0 +1,345 @@
+import os
+import os.path as osp
+import json
+import shutil
+import hashlib
+import logging
+import time
+import tempfile
+from threading import Thread, Lock
+from Queue import Queue, Empty
+
+LOGGER = logging.getLogger("ResultCache")
+
+# Renderer options that change how a render is run but not its image
+VOLATILE_OPTIONS = [ "timeout", "attempts", "log_lines", "warm", "recycle_frames",
+                     "recycle_memory", "server_start_timeout", "checkpoint_interval", "checkpoint_max_age" ]
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open( path, 'rb' ) as f:
+        while True:
+            chunk = f.read( chunk_size )
+            if not chunk:
+                break
+            digest.update( chunk )
+    return digest.hexdigest()
+
+def link_or_copy(src, dst):
+    """Hard links src to dst where possible, so caching a render costs no
+    copy when the cache shares the render's filesystem."""
+    try:
+        os.link( src, dst )
+    except OSError:
+        shutil.copy2( src, dst )
+
+
+class ResultCache(Thread):
+    """Finished render outputs keyed by what produced them: the content of
+    the scene directory, the frame and region, the renderer type and its
+    settings. Only renderers that render deterministically may use it.
+
+    Each entry is a directory of outputs with a manifest.json, named after
+    its key, so the cache can live in a directory shared by several nodes.
+    Once it grows past max_size bytes the least recently used entries are
+    removed. The index keeps a running total of its size and is rescanned
+    every rescan_interval seconds for the entries other nodes added. File
+    digests are remembered by size and mtime, so a scene's files are only
+    read again when they change.
+
+    The cache's files are only read and written by this thread. A scene's
+    digest is used for revalidate_interval seconds after its files were
+    checked and is re-checked in the background as it ages, so a scene
+    whose frames keep coming stays known; until it is known, key() returns
+    None and the frame is rendered as a cache miss. fetch() looks a render
+    up and copies it out into staging_path, and notify is called once the
+    result can be taken from fetched(). store() hard links the outputs into
+    staging_path and has them added from there."""
+
+    def __init__(self, path, max_size, scene_path, staging_path, revalidate_interval=30,
+                 rescan_interval=600, notify=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self._root = path
+        self._max_size = max_size
+        self._scene_path = scene_path
+        self._staging = staging_path
+        self._revalidate_interval = revalidate_interval
+        self._rescan_interval = rescan_interval
+        self._notify = notify
+        self._digests_file = osp.join( self._root, "digests.json" )
+        # File digests belong to this thread; the lock guards the scene
+        # digests, the index and the finished lookups the caller reads
+        self._digests = {}
+        self._lock = Lock()
+        self._requests = Queue()
+        self._scenes = {}
+        self._queued = set()
+        self._fetched = []
+        self._entries = {}
+        self._size = 0
+        self._scanned = 0
+        for directory in [ self._root, self._staging ]:
+            if not osp.isdir( directory ):
+                os.makedirs( directory )
+        # Whatever an earlier run left half staged is of no use
+        for name in os.listdir( self._staging ):
+            shutil.rmtree( osp.join( self._staging, name ), ignore_errors=True )
+        try:
+            with open( self._digests_file, 'r' ) as f:
+                self._digests = json.load( f )
+        except (IOError, OSError, ValueError):
+            self._digests = {}
+
+    def entry_path(self, key):
+        return osp.join( self._root, key[:2], key )
+
+    def scan(self, ):
+        """key -> [size, last used] of every entry, including those other
+        nodes sharing the directory added."""
+        entries = {}
+        for prefix in os.listdir( self._root ):
+            prefix_path = osp.join( self._root, prefix )
+            if len(prefix) != 2 or not osp.isdir( prefix_path ):
+                continue
+            for key in os.listdir( prefix_path ):
+                manifest = osp.join( prefix_path, key, "manifest.json" )
+                try:
+                    with open( manifest, 'r' ) as f:
+                        size = json.load( f )["size"]
+                    entries[key] = [ size, osp.getmtime( manifest ) ]
+                except (IOError, OSError, ValueError, KeyError):
+                    continue
+        return entries
+
+    def rescan(self, ):
+        entries = self.scan()
+        with self._lock:
+            self._entries = entries
+            self._size = sum( size for size, used in entries.values() )
+        self._scanned = time.time()
+
+    def size(self, ):
+        with self._lock:
+            return self._size
+
+    def scene_digest(self, scene):
+        """A digest of every file in the scene's directory, or None while it
+        is not known. Never touches the scene's files."""
+        now = time.time()
+        with self._lock:
+            known = self._scenes.get( scene )
+            if ( known == None or now - known[1] > self._revalidate_interval / 2.0 ) and scene not in self._queued:
+                self._queued.add( scene )
+                self._requests.put( ( "digest", scene ) )
+            if known == None or now - known[1] > self._revalidate_interval:
+                return None
+            return known[0]
+
+    def hash_scene(self, scene):
+        """Reads the files of scene that changed since they were last hashed
+        and returns the digest of its directory."""
+        root = osp.join( self._scene_path, scene )
+        digest = hashlib.sha1()
+        changed = False
+        for directory, subdirectories, filenames in os.walk( root ):
+            subdirectories.sort()
+            for filename in sorted( filenames ):
+                path = osp.join( directory, filename )
+                stat = os.stat( path )
+                known = self._digests.get( path )
+                if known == None or known[0] != stat.st_size or known[1] != stat.st_mtime:
+                    known = [ stat.st_size, stat.st_mtime, file_digest( path ) ]
+                    self._digests[path] = known
+                    changed = True
+                digest.update( osp.relpath( path, root ) + "\0" + str( known[2] ) )
+        if changed:
+            self.save_digests()
+        return digest.hexdigest()
+
+    def save_digests(self, ):
+        partial = self._digests_file + ".partial.{:d}".format( os.getpid() )
+        try:
+            with open( partial, 'w' ) as f:
+                json.dump( self._digests, f )
+            os.rename( partial, self._digests_file )
+        except (IOError, OSError), e:
+            LOGGER.warning("Failed to save the scene digests: %s", str(e))
+
+    def key(self, scene, frame, render_type, settings, region=None):
+        """The key of a render, or None while its scene's digest is not known."""
+        scene_digest = self.scene_digest( scene )
+        if scene_digest == None:
+            return None
+        settings = dict( ( option, value ) for option, value in settings.items()
+                         if option not in VOLATILE_OPTIONS )
+        description = [ scene_digest, frame, render_type, settings, region ]
+        return hashlib.sha1( json.dumps( description, sort_keys=True ) ).hexdigest()
+
+    def fetch(self, job, key):
+        """Has the cached render of job looked up and copied out."""
+        self._requests.put( ( "fetch", job, key ) )
+
+    def fetched(self, ):
+        """Returns (job, outputs, extension, staging) for every lookup that
+        finished since the last call. outputs maps each label to its copy
+        under the staging directory, which the caller removes once done
+        with it, or is None when the render is not cached."""
+        with self._lock:
+            fetched = self._fetched
+            self._fetched = []
+        return fetched
+
+    def store(self, key, outputs, extension):
+        """Has the outputs (label -> path) of a finished render added. They
+        are hard linked aside first, so the caller may move its files
+        straight away; outputs on another filesystem are not cached."""
+        with self._lock:
+            if key in self._entries:
+                return
+        staging = tempfile.mkdtemp( prefix="store-", dir=self._staging )
+        staged = {}
+        try:
+            for label, path in outputs.items():
+                staged[label] = osp.join( staging, label + "." + extension )
+                os.link( path, staged[label] )
+        except OSError, e:
+            LOGGER.warning("Failed to stage the render %s for the result cache: %s", key, str(e))
+            shutil.rmtree( staging, ignore_errors=True )
+            return
+        self._requests.put( ( "store", key, staged, extension, staging ) )
+
+    def lookup(self, key):
+        """Returns (outputs, extension) for a cached render, outputs mapping
+        each label to its file, or None."""
+        directory = self.entry_path( key )
+        manifest_file = osp.join( directory, "manifest.json" )
+        try:
+            with open( manifest_file, 'r' ) as f:
+                manifest = json.load( f )
+            outputs = dict( ( label, osp.join( directory, filename ) )
+                            for label, filename in manifest["outputs"].items() )
+            if not all( osp.exists( path ) for path in outputs.values() ):
+                return None
+            # Marks the entry as recently used for every node
+            os.utime( manifest_file, None )
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        with self._lock:
+            if key not in self._entries:
+                self._size = self._size + manifest["size"]
+            self._entries[key] = [ manifest["size"], time.time() ]
+        return ( outputs, manifest["extension"] )
+
+    def copy_out(self, job, key):
+        """Copies the cached render of job into a staging directory and
+        queues the result for fetched()."""
+        outputs = None
+        extension = None
+        staging = osp.join( self._staging, job["uuid"] )
+        try:
+            hit = self.lookup( key )
+            if hit != None:
+                cached, extension = hit
+                if osp.isdir( staging ):
+                    shutil.rmtree( staging )
+                os.makedirs( staging )
+                copies = {}
+                for label, path in cached.items():
+                    copies[label] = osp.join( staging, osp.basename( path ) )
+                    link_or_copy( path, copies[label] )
+                outputs = copies
+        except Exception, e:
+            LOGGER.warning("Failed to take frame %s from the result cache: %s", str(job["frame"]), str(e))
+            shutil.rmtree( staging, ignore_errors=True )
+        with self._lock:
+            self._fetched.append( ( job, outputs, extension, staging ) )
+        if self._notify != None:
+            self._notify()
+
+    def add(self, key, outputs, extension):
+        """Moves staged outputs into the cache as the entry for key."""
+        directory = self.entry_path( key )
+        if osp.isdir( directory ):
+            return
+        partial = directory + ".partial.{:d}".format( os.getpid() )
+        try:
+            os.makedirs( partial )
+            files = {}
+            size = 0
+            for label, path in outputs.items():
+                filename = label + "." + extension
+                link_or_copy( path, osp.join( partial, filename ) )
+                files[label] = filename
+                size = size + osp.getsize( path )
+            with open( osp.join( partial, "manifest.json" ), 'w' ) as f:
+                json.dump( { "key": key, "extension": extension, "outputs": files, "size": size,
+                             "created": time.time() }, f )
+            # Another node may have stored the same render meanwhile
+            os.rename( partial, directory )
+        except (IOError, OSError), e:
+            shutil.rmtree( partial, ignore_errors=True )
+            if not osp.isdir( directory ):
+                LOGGER.warning("Failed to cache the render %s: %s", key, str(e))
+            return
+        with self._lock:
+            if key not in self._entries:
+                self._size = self._size + size
+            self._entries[key] = [ size, time.time() ]
+        self.evict()
+
+    def evict(self, ):
+        with self._lock:
+            evicted = []
+            for key in sorted( self._entries.keys(), key=lambda key: self._entries[key][1] ):
+                if self._size <= self._max_size:
+                    break
+                self._size = self._size - self._entries.pop( key )[0]
+                evicted.append( key )
+        for key in evicted:
+            LOGGER.info("Evicting render %s from the result cache", key)
+            shutil.rmtree( self.entry_path( key ), ignore_errors=True )
+
+    def stop(self, ):
+        self._requests.put( None )
+
+    def run(self, ):
+        while True:
+            if time.time() - self._scanned > self._rescan_interval:
+                try:
+                    self.rescan()
+                    self.evict()
+                except (IOError, OSError), e:
+                    LOGGER.warning("Failed to scan the result cache: %s", str(e))
+            try:
+                request = self._requests.get( timeout=self._rescan_interval )
+            except Empty:
+                continue
+            if request == None:
+                return
+            try:
+                if request[0] == "digest":
+                    self.update_digest( request[1] )
+                elif request[0] == "fetch":
+                    self.copy_out( request[1], request[2] )
+                elif request[0] == "store":
+                    key, outputs, extension, staging = request[1:]
+                    try:
+                        self.add( key, outputs, extension )
+                    finally:
+                        shutil.rmtree( staging, ignore_errors=True )
+            except Exception, e:
+                LOGGER.error("Result cache request %s failed: %s", request[0], str(e))
+
+    def update_digest(self, scene):
+        checked = time.time()
+        digest = None
+        try:
+            digest = self.hash_scene( scene )
+        except Exception, e:
+            LOGGER.warning("Failed to hash scene %s for the result cache: %s", scene, str(e))
+        with self._lock:
+            self._queued.discard( scene )
+            if digest != None:
+                self._scenes[scene] = ( digest, checked )
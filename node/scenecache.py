@@ -0,0 +1,196 @@
+import os
+import os.path as osp
+import json
+import shutil
+import logging
+import time
+from threading import Thread, Condition
+from Queue import Queue, Empty
+
+LOGGER = logging.getLogger("SceneCache")
+
+
+class SceneCache(Thread):
+    """A node-local copy of scene directories, kept under a size limit.
+
+    Each scene directory under scene_path is mirrored into cache_path on
+    first use. A cached file is fresh while its size and mtime match the
+    source. The source is re-checked at most once per revalidate_interval
+    seconds. When the cache grows past max_size bytes, the least recently
+    used scenes that no renderer holds are evicted.
+
+    Copying never happens on the caller of acquire(): a scene that is
+    missing is synced by this thread meanwhile, and the caller reads the
+    source. A scene due for a check is checked by this thread too, while
+    callers keep getting the local copy it last validated; only once the
+    check finds the source changed do they read the source until the copy
+    is refreshed. sync() does the same on the calling thread, for callers
+    that may block. The scenes renderers hold are re-checked as they age."""
+
+    def __init__(self, scene_path, cache_path, max_size, revalidate_interval=30):
+        Thread.__init__(self)
+        self.daemon = True
+        self._scene_path = scene_path
+        self._root = cache_path
+        self._max_size = max_size
+        self._revalidate_interval = revalidate_interval
+        # Guards the index only; files are walked and copied without it
+        self._lock = Condition()
+        self._requests = Queue()
+        self._syncing = set()
+        # Scenes whose local copy is known to differ from the source
+        self._stale = set()
+        self._pins = {}
+        self._checked = {}
+        self._manifest_file = osp.join( self._root, "manifest.json" )
+        self._entries = {}
+        if not osp.isdir( self._root ):
+            os.makedirs( self._root )
+        try:
+            with open( self._manifest_file, 'r' ) as f:
+                self._entries = json.load( f )
+        except Exception:
+            self._entries = {}
+
+    def local_path(self, scene):
+        return osp.join( self._root, "scenes", scene )
+
+    def due(self, scene):
+        return time.time() - self._checked.get( scene, 0 ) > self._revalidate_interval
+
+    def acquire(self, scene):
+        """Returns the last validated local directory for scene and holds it
+        against eviction until it is released. Returns None without
+        blocking when the local copy is missing or out of date, and has it
+        synced in the background; a copy due for a check is still returned
+        while it is checked."""
+        with self._lock:
+            if scene not in self._entries or scene in self._stale:
+                self._requests.put( scene )
+                return None
+            if self.due( scene ) and scene not in self._syncing:
+                self._requests.put( scene )
+            self._entries[scene]["last_used"] = time.time()
+            self._pins[scene] = self._pins.get( scene, 0 ) + 1
+            self._save()
+            return self.local_path( scene )
+
+    def sync(self, scene):
+        """Brings the local copy of scene up to date unless it was checked
+        within revalidate_interval. Blocks while it copies."""
+        with self._lock:
+            while scene in self._syncing:
+                self._lock.wait()
+            if scene in self._entries and not self.due( scene ):
+                return
+            self._syncing.add( scene )
+            files = dict( self._entries.get( scene, {} ).get( "files", {} ) )
+        seen = None
+        try:
+            seen = self._sync( scene, files )
+        finally:
+            with self._lock:
+                self._syncing.discard( scene )
+                if seen != None:
+                    self._stale.discard( scene )
+                    self._entries[scene] = { "files": seen,
+                                             "size": sum( stamp[0] for stamp in seen.values() ),
+                                             "last_used": time.time() }
+                    self._checked[scene] = time.time()
+                    self._evict()
+                    self._save()
+                self._lock.notify_all()
+
+    def stop(self, ):
+        self._requests.put( None )
+
+    def run(self, ):
+        while True:
+            try:
+                scenes = [ self._requests.get( timeout=self._revalidate_interval / 2.0 ) ]
+            except Empty:
+                scenes = []
+            if None in scenes:
+                return
+            with self._lock:
+                scenes = scenes + [ scene for scene in self._pins if self.due( scene ) ]
+            for scene in scenes:
+                try:
+                    self.sync( scene )
+                except Exception, e:
+                    LOGGER.warning("Failed to cache scene %s: %s", scene, str(e))
+
+    def release(self, scene):
+        with self._lock:
+            if self._pins.get( scene, 0 ) > 1:
+                self._pins[scene] -= 1
+            else:
+                self._pins.pop( scene, None )
+
+    def size(self, ):
+        return sum( entry["size"] for entry in self._entries.values() )
+
+    def scenes(self, ):
+        return self._entries.keys()
+
+    def _sync(self, scene, files):
+        """Copies the files of scene that changed since files, its last
+        index, and returns its new index."""
+        source = osp.join( self._scene_path, scene )
+        local = self.local_path( scene )
+        seen = {}
+        changed = []
+        for dirpath, dirnames, filenames in os.walk( source ):
+            for name in filenames:
+                src = osp.join( dirpath, name )
+                rel = osp.relpath( src, source )
+                st = os.stat( src )
+                stamp = [ st.st_size, st.st_mtime ]
+                dst = osp.join( local, rel )
+                if files.get( rel ) != stamp or not osp.exists( dst ):
+                    changed.append( ( src, dst ) )
+                seen[rel] = stamp
+        removed = set( files ) - set( seen )
+        if len(changed) == 0 and len(removed) == 0:
+            return seen
+        # Callers read the source until the copy matches it again
+        with self._lock:
+            self._stale.add( scene )
+        for src, dst in changed:
+            self._copy( src, dst )
+        for rel in removed:
+            try:
+                os.remove( osp.join( local, rel ) )
+            except OSError:
+                pass
+        LOGGER.info("Refreshed %d files of scene %s in the local cache", len(changed), scene)
+        return seen
+
+    def _copy(self, src, dst):
+        if not osp.isdir( osp.dirname( dst ) ):
+            os.makedirs( osp.dirname( dst ) )
+        # Copy next to the destination and rename so readers never see a partial file
+        partial = dst + ".partial"
+        shutil.copy2( src, partial )
+        os.rename( partial, dst )
+
+    def _evict(self, ):
+        total = self.size()
+        by_age = sorted( self._entries.keys(), key=lambda s: self._entries[s]["last_used"] )
+        for scene in by_age:
+            if total <= self._max_size:
+                break
+            if scene in self._pins or scene in self._syncing:
+                continue
+            LOGGER.info("Evicting scene %s from the local cache", scene)
+            shutil.rmtree( self.local_path( scene ), ignore_errors=True )
+            total = total - self._entries[scene]["size"]
+            del self._entries[scene]
+            self._checked.pop( scene, None )
+            self._stale.discard( scene )
+
+    def _save(self, ):
+        partial = self._manifest_file + ".partial"
+        with open( partial, 'w' ) as f:
+            json.dump( self._entries, f )
+        os.rename( partial, self._manifest_file )
@@ -0,0 +1,361 @@
+import os
+import os.path as osp
+import copy
+import json
+import time
+import random
+import shutil
+import logging
+from threading import Thread, Condition
+from Queue import Queue
+
+LOGGER = logging.getLogger("Spool")
+
+MANIFEST = "manifest.json"
+
+
+def sync_file(path):
+    fd = os.open( path, os.O_RDONLY )
+    try:
+        os.fsync( fd )
+    finally:
+        os.close( fd )
+
+def write_manifest(directory, manifest):
+    """Replaces the manifest atomically and durably."""
+    partial = osp.join( directory, MANIFEST + ".partial" )
+    with open( partial, 'w' ) as f:
+        json.dump( manifest, f )
+        f.flush()
+        os.fsync( f.fileno() )
+    os.rename( partial, osp.join( directory, MANIFEST ) )
+
+
+class RenderSpool(Thread):
+    """A durable local spool of finished render outputs awaiting upload.
+
+    Outputs are moved into their own directory under spool_path together
+    with a manifest of the uuid, extension and the upload state of every
+    label, so they survive upload failures and worker restarts. submit
+    only moves the files; a syncing thread of the spool writes them and the
+    manifest to disk and reports the entry through durable() and notify,
+    and later manifest updates are written there too. This thread then
+    starts the upload, or waits for release if the entry was held back for
+    post-processing. Failed uploads are retried with jittered exponential
+    backoff until the manager takes them. Entries left by an earlier run
+    are picked up at startup.
+
+    An entry is given up once the manager rejects it outright (a client
+    error other than a timeout or rate limit), after max_attempts uploads
+    or once it is max_age seconds old (0 disables either limit). It is then
+    moved to the failed directory of the spool for inspection, and
+    on_failed is called with its manifest and the reason."""
+
+    def __init__(self, spool_path, uploader, retry_interval=30, max_retry_interval=600,
+                 poll_interval=1.0, metrics=None, max_attempts=0, max_age=172800, on_failed=None,
+                 notify=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self._spool_path = spool_path
+        self._failed_path = osp.join( spool_path, "failed" )
+        self._uploader = uploader
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+        self._poll_interval = poll_interval
+        self._metrics = metrics
+        self._max_attempts = max_attempts
+        self._max_age = max_age
+        self._on_failed = on_failed
+        self._notify = notify
+        self._condition = Condition()
+        self._running = True
+        # Set when there is work for the next poll, so it is not missed
+        # while a poll is running
+        self._woken = False
+        self._sync_requests = Queue()
+        self._syncer = Thread( target=self.sync_forever )
+        self._syncer.daemon = True
+        self._entries = {}
+        # (uuid, error) of submitted entries, once on disk or failed to be
+        self._durable = []
+        if not osp.isdir( spool_path ):
+            os.makedirs( spool_path )
+        self.recover()
+
+    def recover(self, ):
+        for name in os.listdir( self._spool_path ):
+            directory = osp.join( self._spool_path, name )
+            if not osp.isdir( directory ) or directory == self._failed_path:
+                continue
+            try:
+                with open( osp.join( directory, MANIFEST ) ) as f:
+                    manifest = json.load( f )
+            except (IOError, OSError, ValueError):
+                # Never completed, so the frame was not acked and the broker
+                # has handed it out again
+                LOGGER.warning("Removing incomplete spool entry %s", name)
+                shutil.rmtree( directory, ignore_errors=True )
+                continue
+            # Whatever post-processing did not finish is skipped
+            manifest["held"] = False
+            manifest["next_attempt"] = 0
+            self._entries[manifest["uuid"]] = { "directory": directory, "manifest": manifest, "upload": None,
+                                                "durable": True, "dirty": False, "syncing": False,
+                                                "unsynced": [], "version": 0 }
+        if len(self._entries) > 0:
+            LOGGER.info("Recovered %d spooled renders awaiting upload", len(self._entries))
+
+    def contains(self, uuid):
+        with self._condition:
+            return uuid in self._entries
+
+    def pending(self, ):
+        with self._condition:
+            return len(self._entries)
+
+    def submit(self, uuid, outputs, extension, render_type=None, hold=False):
+        """Moves outputs (label -> path) into the spool and has this thread
+        make them durable and, unless hold is set, upload them."""
+        directory = osp.join( self._spool_path, uuid )
+        if osp.isdir( directory ):
+            shutil.rmtree( directory )
+        os.makedirs( directory )
+        labels = {}
+        try:
+            for label, path in outputs.items():
+                filename = label + "." + extension
+                shutil.move( path, osp.join( directory, filename ) )
+                labels[label] = { "file": filename, "state": "pending" }
+        except:
+            shutil.rmtree( directory, ignore_errors=True )
+            raise
+        manifest = { "uuid": uuid,
+                     "type": render_type,
+                     "extension": extension,
+                     "labels": labels,
+                     "held": hold,
+                     "created": time.time(),
+                     "attempts": 0,
+                     "next_attempt": 0 }
+        with self._condition:
+            self._entries[uuid] = { "directory": directory, "manifest": manifest, "upload": None,
+                                    "durable": False, "dirty": False, "syncing": False,
+                                    "unsynced": [ output["file"] for output in labels.values() ], "version": 0 }
+            self.changed( self._entries[uuid] )
+
+    def durable(self, ):
+        """The (uuid, error) of the entries submitted since the last call
+        that are now on disk (error None), or were dropped because they
+        could not be written."""
+        with self._condition:
+            durable = self._durable
+            self._durable = []
+            return durable
+
+    def outputs(self, uuid):
+        """The spooled outputs of uuid that are still to be uploaded."""
+        with self._condition:
+            entry = self._entries[uuid]
+            return dict( ( label, osp.join( entry["directory"], output["file"] ) )
+                         for label, output in entry["manifest"]["labels"].items()
+                         if output["state"] == "pending" )
+
+    def add_output(self, uuid, label, path):
+        """Adds another output to a held entry, keeping its file extension."""
+        with self._condition:
+            entry = self._entries[uuid]
+            filename = label + osp.splitext( path )[1]
+            shutil.move( path, osp.join( entry["directory"], filename ) )
+            entry["manifest"]["labels"][label] = { "file": filename, "state": "pending" }
+            entry["unsynced"].append( filename )
+            self.changed( entry )
+
+    def release(self, uuid):
+        """Starts uploading an entry that was held back."""
+        with self._condition:
+            entry = self._entries.get( uuid )
+            if entry == None:
+                return
+            entry["manifest"]["held"] = False
+            entry["manifest"]["next_attempt"] = 0
+            self.changed( entry )
+
+    def changed(self, entry):
+        """Has the syncing thread write the manifest of entry. Called with
+        the condition held."""
+        entry["version"] = entry["version"] + 1
+        entry["dirty"] = True
+        self._sync_requests.put( True )
+
+    def retry_now(self, uuid):
+        with self._condition:
+            if uuid in self._entries:
+                self._entries[uuid]["manifest"]["next_attempt"] = 0
+                self._woken = True
+                self._condition.notify()
+
+    def start_upload(self, entry):
+        manifest = entry["manifest"]
+        handles = {}
+        filenames = {}
+        try:
+            for label, output in manifest["labels"].items():
+                if output["state"] == "pending":
+                    handles[label] = open( osp.join( entry["directory"], output["file"] ), 'rb' )
+                    filenames[label] = output["file"]
+        except (IOError, OSError), e:
+            for handle in handles.values():
+                handle.close()
+            LOGGER.error("Spooled render %s is unreadable, dropping it: %s", manifest["uuid"], str(e))
+            self.remove( entry )
+            raise
+        manifest["attempts"] = manifest["attempts"] + 1
+        entry["started"] = time.time()
+        entry["upload"] = self._uploader.upload_render( manifest["uuid"], handles, manifest["extension"], filenames )
+
+    def upload_finished(self, entry):
+        manifest = entry["manifest"]
+        upload = entry["upload"]
+        entry["upload"] = None
+        for label in upload.uploaded_labels():
+            output = manifest["labels"][label]
+            output["state"] = "uploaded"
+            try:
+                os.remove( osp.join( entry["directory"], output["file"] ) )
+            except OSError:
+                pass
+        if all( output["state"] == "uploaded" for output in manifest["labels"].values() ):
+            if self._metrics != None:
+                self._metrics.observe( "upload", manifest.get( "type" ), time.time() - entry["started"] )
+            self.remove( entry )
+            return
+        reason = None
+        if len( upload.rejected_labels() ) > 0:
+            reason = "the manager rejected {:s}".format( ", ".join( sorted( upload.rejected_labels() ) ) )
+        elif self._max_attempts > 0 and manifest["attempts"] >= self._max_attempts:
+            reason = "{:d} failed attempts".format( manifest["attempts"] )
+        elif self._max_age > 0 and time.time() - manifest["created"] > self._max_age:
+            reason = "retrying for {:d} seconds".format( int( time.time() - manifest["created"] ) )
+        if reason != None:
+            self.give_up( entry, reason )
+            return
+        delay = min( self._max_retry_interval, self._retry_interval * 2 ** ( manifest["attempts"] - 1 ) )
+        manifest["next_attempt"] = time.time() + delay * random.uniform( 0.8, 1.2 )
+        LOGGER.warning("Upload of %s failed %d times, retrying in %d seconds",
+                       manifest["uuid"], manifest["attempts"], delay)
+        self.changed( entry )
+
+    def give_up(self, entry, reason):
+        """Stops retrying an entry and moves it out of the way."""
+        manifest = entry["manifest"]
+        self._entries.pop( manifest["uuid"], None )
+        failed = osp.join( self._failed_path, manifest["uuid"] )
+        LOGGER.error("Giving up on uploading %s after %s, keeping it in %s", manifest["uuid"], reason, failed)
+        manifest["failed"] = reason
+        try:
+            write_manifest( entry["directory"], manifest )
+            if not osp.isdir( self._failed_path ):
+                os.makedirs( self._failed_path )
+            if osp.isdir( failed ):
+                shutil.rmtree( failed )
+            os.rename( entry["directory"], failed )
+        except (IOError, OSError), e:
+            LOGGER.warning("Failed to keep the outputs of %s, removing them: %s", manifest["uuid"], str(e))
+            shutil.rmtree( entry["directory"], ignore_errors=True )
+        if self._metrics != None:
+            self._metrics.upload_failed( manifest.get( "type" ) )
+        if self._on_failed != None:
+            self._on_failed( manifest, reason )
+
+    def remove(self, entry):
+        self._entries.pop( entry["manifest"]["uuid"], None )
+        shutil.rmtree( entry["directory"], ignore_errors=True )
+
+    def sync(self, ):
+        """Writes the files and manifests of new and changed entries to
+        disk. The condition is not held while they are written, so callers
+        never wait on the disk; polls leave the entries alone meanwhile."""
+        with self._condition:
+            dirty = [ ( entry, entry["version"], entry["unsynced"], copy.deepcopy( entry["manifest"] ) )
+                      for entry in self._entries.values() if entry["dirty"] ]
+            for entry, version, unsynced, manifest in dirty:
+                entry["unsynced"] = []
+                entry["syncing"] = True
+        reported = False
+        for entry, version, unsynced, manifest in dirty:
+            error = None
+            try:
+                for filename in unsynced:
+                    sync_file( osp.join( entry["directory"], filename ) )
+                write_manifest( entry["directory"], manifest )
+            except (IOError, OSError), e:
+                error = e
+            with self._condition:
+                entry["syncing"] = False
+                if entry["version"] == version:
+                    entry["dirty"] = False
+                if entry["durable"]:
+                    if error != None:
+                        LOGGER.warning("Failed to update the spool manifest of %s: %s", manifest["uuid"], str(error))
+                    continue
+                if error != None:
+                    LOGGER.warning("Failed to spool the render outputs of %s: %s", manifest["uuid"], str(error))
+                    self.remove( entry )
+                    self._durable.append( ( manifest["uuid"], str(error) ) )
+                else:
+                    entry["durable"] = True
+                    self._durable.append( ( manifest["uuid"], None ) )
+                reported = True
+        if len(dirty) > 0:
+            with self._condition:
+                # Uploads of new and released entries can start
+                self._woken = True
+                self._condition.notify()
+        if reported and self._notify != None:
+            self._notify()
+
+    def sync_forever(self, ):
+        while self._sync_requests.get() != None:
+            try:
+                self.sync()
+            except Exception, e:
+                LOGGER.error("Spool sync failed: %s", str(e))
+
+    def poll(self, ):
+        """Settles finished uploads and starts the uploads that are due."""
+        now = time.time()
+        with self._condition:
+            for entry in list( self._entries.values() ):
+                if not entry["durable"] or entry["syncing"]:
+                    continue
+                if entry["upload"] != None:
+                    if entry["upload"].done():
+                        self.upload_finished( entry )
+                elif not entry["manifest"]["held"] and entry["manifest"]["next_attempt"] <= now:
+                    try:
+                        self.start_upload( entry )
+                    except (IOError, OSError):
+                        pass
+
+    def stop(self, timeout=5):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self.join( timeout )
+        self._sync_requests.put( None )
+        if self._syncer.is_alive():
+            self._syncer.join( timeout )
+
+    def run(self, ):
+        self._syncer.start()
+        while True:
+            with self._condition:
+                if not self._running:
+                    break
+                if not self._woken:
+                    self._condition.wait( self._poll_interval )
+                self._woken = False
+            try:
+                self.poll()
+            except Exception, e:
+                LOGGER.error("Spool poll failed: %s", str(e))
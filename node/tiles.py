@@ -0,0 +1,224 @@
+"""Splitting a frame into regions rendered on separate nodes, and stitching
+the rendered tiles back together.
+
+A region is [xmin, xmax, ymin, ymax] in fractions of the frame, measured
+from the top left corner like a RenderMan CropWindow. Renderers render a
+few pixels past their region (tile_overlap) so rounding never leaves a
+seam; the stitcher takes exactly the region's pixels from each tile.
+
+PNG tiles, as Blender writes them, are stitched with NumPy alone. EXR
+tiles, as prman writes them cropped to their region's data window, are
+stitched with oiiotool and need the frame size:
+
+    python node/tiles.py frame.png 0,0.5,0,1=left.png 0.5,1,0,1=right.png
+    python node/tiles.py --size 1920x1080 frame.exr 0,0.5,0,1=left.exr 0.5,1,0,1=right.exr
+"""
+import os
+import struct
+import subprocess
+import zlib
+
+import numpy
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+# PNG color type -> channels
+PNG_CHANNELS = { 0: 1, 2: 3, 4: 2, 6: 4 }
+
+
+def split_frame(columns, rows):
+    """Regions of a grid of columns x rows tiles, row by row from the top."""
+    return [ [ float(column) / columns, float(column + 1) / columns,
+               float(row) / rows, float(row + 1) / rows ]
+             for row in range(rows) for column in range(columns) ]
+
+def region_pixels(region, width, height):
+    """The pixel rectangle (x0, x1, y0, y1), end exclusive, that a region
+    covers in a width x height frame. Neighbouring regions share their
+    edges, so every pixel belongs to exactly one of them."""
+    xmin, xmax, ymin, ymax = region
+    return ( int( round( xmin * width ) ), int( round( xmax * width ) ),
+             int( round( ymin * height ) ), int( round( ymax * height ) ) )
+
+def check_coverage(width, height, regions):
+    """Raises ValueError unless the regions cover every pixel of the frame."""
+    covered = numpy.zeros( ( height, width ), dtype=bool )
+    for region in regions:
+        x0, x1, y0, y1 = region_pixels( region, width, height )
+        covered[y0:y1, x0:x1] = True
+    if len(regions) == 0 or not covered.all():
+        raise ValueError( "The tiles leave {:d} pixels of the frame uncovered".format(
+            int( covered.size - covered.sum() ) ) )
+
+def stitch(width, height, tiles):
+    """Assembles tiles, a list of (region, pixels) with pixels a height x
+    width x channels array, into one frame. A tile is either the whole frame
+    with its region rendered or exactly the region's pixels."""
+    check_coverage( width, height, [ region for region, pixels in tiles ] )
+    frame = None
+    for region, pixels in tiles:
+        x0, x1, y0, y1 = region_pixels( region, width, height )
+        if pixels.shape[:2] == ( height, width ):
+            pixels = pixels[y0:y1, x0:x1]
+        elif pixels.shape[:2] != ( y1 - y0, x1 - x0 ):
+            raise ValueError( "Tile {:s} is {:d}x{:d}, neither the frame nor its region".format( str(region),
+                pixels.shape[1], pixels.shape[0] ) )
+        if frame is None:
+            frame = numpy.zeros( ( height, width ) + pixels.shape[2:], dtype=pixels.dtype )
+        frame[y0:y1, x0:x1] = pixels
+    return frame
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa = abs( p - a )
+    pb = abs( p - b )
+    pc = abs( p - c )
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+def unfilter_row(kind, row, previous, stride):
+    """Reverses the filter of one PNG scanline."""
+    if kind == 0:
+        return row
+    if kind == 1:
+        # Sub: a running sum per channel, which uint8 arithmetic wraps
+        pixels = row.reshape( -1, stride )
+        return numpy.cumsum( pixels, axis=0, dtype=numpy.uint8 ).reshape( -1 )
+    if kind == 2:
+        return row + previous
+    # Average and Paeth depend on the reconstructed byte to their left
+    out = bytearray( row.tostring() )
+    above = bytearray( previous.tostring() )
+    for i in range( len(out) ):
+        left = out[i - stride] if i >= stride else 0
+        if kind == 3:
+            out[i] = ( out[i] + ( ( left + above[i] ) >> 1 ) ) & 0xff
+        elif kind == 4:
+            upper_left = above[i - stride] if i >= stride else 0
+            out[i] = ( out[i] + paeth( left, above[i], upper_left ) ) & 0xff
+        else:
+            raise ValueError( "Unknown PNG filter {:d}".format( kind ) )
+    return numpy.frombuffer( bytes( out ), dtype=numpy.uint8 )
+
+def read_png(path):
+    """Reads a non-interlaced 8 or 16 bit grey, RGB or RGBA PNG, such as
+    Blender writes, into a height x width x channels array."""
+    with open( path, 'rb' ) as f:
+        data = f.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError( "{:s} is not a PNG file".format( path ) )
+    offset = 8
+    header = None
+    compressed = []
+    while offset < len(data):
+        length, kind = struct.unpack( ">I4s", data[offset:offset + 8] )
+        chunk = data[offset + 8:offset + 8 + length]
+        offset = offset + 12 + length
+        if kind == "IHDR":
+            header = struct.unpack( ">IIBBBBB", chunk )
+        elif kind == "IDAT":
+            compressed.append( chunk )
+        elif kind == "IEND":
+            break
+    width, height, depth, color, compression, filtering, interlace = header
+    if color not in PNG_CHANNELS or depth not in ( 8, 16 ) or interlace != 0:
+        raise ValueError( "{:s}: unsupported PNG layout (color type {:d}, {:d} bit, interlace {:d})".format(
+            path, color, depth, interlace ) )
+    stride = PNG_CHANNELS[color] * depth // 8
+    row_bytes = width * stride
+    raw = numpy.frombuffer( zlib.decompress( "".join( compressed ) ), dtype=numpy.uint8 )
+    rows = raw[:height * ( row_bytes + 1 )].reshape( height, row_bytes + 1 )
+    pixels = numpy.empty( ( height, row_bytes ), dtype=numpy.uint8 )
+    previous = numpy.zeros( row_bytes, dtype=numpy.uint8 )
+    for y in range(height):
+        previous = unfilter_row( rows[y, 0], rows[y, 1:], previous, stride )
+        pixels[y] = previous
+    if depth == 16:
+        pixels = pixels.view( ">u2" ).astype( numpy.uint16 )
+    return pixels.reshape( height, width, PNG_CHANNELS[color] )
+
+def write_png(path, pixels):
+    """Writes a height x width x channels uint8 or uint16 array as a PNG."""
+    height, width, channels = pixels.shape
+    color = dict( ( count, kind ) for kind, count in PNG_CHANNELS.items() )[channels]
+    if pixels.dtype == numpy.uint16:
+        depth = 16
+        raw = pixels.astype( ">u2" ).view( numpy.uint8 ).reshape( height, -1 )
+    else:
+        depth = 8
+        raw = pixels.astype( numpy.uint8 ).reshape( height, -1 )
+    # Every row unfiltered
+    raw = numpy.hstack( [ numpy.zeros( ( height, 1 ), dtype=numpy.uint8 ), raw ] )
+
+    def chunk(kind, body):
+        return ( struct.pack( ">I", len(body) ) + kind + body +
+                 struct.pack( ">I", zlib.crc32( kind + body ) & 0xffffffff ) )
+
+    partial = path + ".partial"
+    with open( partial, 'wb' ) as f:
+        f.write( PNG_SIGNATURE )
+        f.write( chunk( "IHDR", struct.pack( ">IIBBBBB", width, height, depth, color, 0, 0, 0 ) ) )
+        f.write( chunk( "IDAT", zlib.compress( raw.tostring(), 6 ) ) )
+        f.write( chunk( "IEND", "" ) )
+    os.rename( partial, path )
+
+def exr_command(tool, output, width, height, tiles):
+    """The oiiotool command that stitches tiles, a list of (region, EXR
+    path), into output. Each tile's region is cut out of its data window and
+    pasted into the first tile padded to the full frame, so tiles may be
+    cropped to their region, overlap included, or cover the whole frame.
+    --paste takes the foreground below the background on the stack, hence
+    the --swap."""
+    command = [ tool, tiles[0][1], "--croptofull" ]
+    for region, path in tiles:
+        x0, x1, y0, y1 = region_pixels( region, width, height )
+        command = command + [ path, "--crop", "{:d}x{:d}+{:d}+{:d}".format( x1 - x0, y1 - y0, x0, y0 ),
+                              "--origin", "+0+0", "--swap",
+                              "--paste", "+{:d}+{:d}".format( x0, y0 ) ]
+    return command + [ "-o", output ]
+
+def assemble_exr(output, tiles, width, height, tool="oiiotool"):
+    """Stitches tiles, a list of (region, EXR path), into the EXR output
+    of a width x height frame."""
+    check_coverage( width, height, [ region for region, path in tiles ] )
+    partial = output + ".partial.exr"
+    subprocess.check_call( exr_command( tool, partial, width, height, tiles ) )
+    os.rename( partial, output )
+
+def assemble(output, tiles, width=None, height=None, tool="oiiotool"):
+    """Stitches tiles, a list of (region, path), into output, by the format
+    its name gives. For PNG the frame size defaults to that of the first
+    tile, which is right for uncropped tiles such as Blender's; cropped EXR
+    tiles do not give it, so it must be passed."""
+    if output.lower().endswith( ".exr" ):
+        if width == None or height == None:
+            raise ValueError( "Stitching EXR tiles needs the frame size" )
+        assemble_exr( output, tiles, width, height, tool )
+        return
+    loaded = [ ( region, read_png( path ) ) for region, path in tiles ]
+    if width == None or height == None:
+        height, width = loaded[0][1].shape[:2]
+    write_png( output, stitch( width, height, loaded ) )
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Stitch rendered tiles into one frame")
+    parser.add_argument('output', help="PNG or EXR file to write")
+    parser.add_argument('tiles', nargs='+', metavar='XMIN,XMAX,YMIN,YMAX=PATH',
+                        help="A tile's region and its image")
+    parser.add_argument('--size', type=str, default=None,
+                        help="WIDTHxHEIGHT of the frame, needed when the tiles are cropped")
+    parser.add_argument('--tool', type=str, default="oiiotool", help="oiiotool, used for EXR tiles")
+    args = parser.parse_args()
+    tiles = []
+    for tile in args.tiles:
+        region, path = tile.split( '=', 1 )
+        tiles.append( ( [ float(value) for value in region.split(',') ], path ) )
+    width = height = None
+    if args.size != None:
+        width, height = [ int(value) for value in args.size.lower().split('x') ]
+    assemble( args.output, tiles, width, height, args.tool )
@@ -0,0 +1,116 @@
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+
+LOGGER = logging.getLogger("Uploader")
+
+# What became of the upload of one output
+UPLOADED = "uploaded"
+FAILED = "failed"
+REJECTED = "rejected"
+
+
+def rejected(error):
+    """Whether an upload error means the manager will never take the
+    output: a client error other than a timeout or rate limit, as for the
+    uuid of a job that no longer exists."""
+    response = getattr( error, 'response', None )
+    if response == None:
+        return False
+    return 400 <= response.status_code < 500 and response.status_code not in ( 408, 429 )
+
+
+class RenderUpload:
+    """Tracks the in-flight uploads for every output of a single render."""
+
+    def __init__(self, uuid, results):
+        self.uuid = uuid
+        self._results = results
+
+    def done(self, ):
+        for result in self._results.values():
+            if not result.ready():
+                return False
+        return True
+
+    def succeeded(self, ):
+        for result in self._results.values():
+            if not result.ready() or result.get() != UPLOADED:
+                return False
+        return True
+
+    def uploaded_labels(self, ):
+        return [ label for label, result in self._results.items() if result.ready() and result.get() == UPLOADED ]
+
+    def rejected_labels(self, ):
+        return [ label for label, result in self._results.items() if result.ready() and result.get() == REJECTED ]
+
+
+class RenderUploader:
+    """Uploads completed renders to the manager from a bounded thread pool
+    sharing one pooled HTTP session."""
+
+    def __init__(self, manager_url, workers=4, retries=3, timeout=300, notify=None):
+        self._murl = manager_url
+        self._notify = notify
+        self._retries = max( 1, retries )
+        self._timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter( pool_connections=1, pool_maxsize=workers )
+        self._session.mount( 'http://', adapter )
+        self._session.mount( 'https://', adapter )
+        self._pool = ThreadPool( workers )
+
+    def upload_render(self, uuid, files, extension, filenames=None):
+        """Queues every output in files (label -> open file handle) for upload
+        and returns a RenderUpload tracking them. Each is sent as label.extension
+        unless filenames (label -> name) says otherwise. The handles are closed
+        once their upload settles."""
+        url = self._murl+"/upload_render?uuid="+uuid
+        LOGGER.info("Uploading completed render to %s" % url)
+        results = {}
+        for label, handle in files.items():
+            filename = label+"."+extension
+            if filenames != None and label in filenames:
+                filename = filenames[label]
+            results[label] = self._pool.apply_async( self.upload_file,
+                                                     (url, label, filename, handle),
+                                                     callback=self._upload_finished )
+        return RenderUpload( uuid, results )
+
+    def _upload_finished(self, result):
+        if self._notify != None:
+            self._notify()
+
+    def upload_file(self, url, label, filename, handle):
+        try:
+            for attempt in range(self._retries):
+                try:
+                    LOGGER.info("Sending image {:s}".format( filename ))
+                    # Stream the file from disk in chunks rather than loading it into memory
+                    handle.seek(0)
+                    encoder = MultipartEncoder( fields={ label: ( filename, handle ) } )
+                    res = self._session.post( url, data=encoder,
+                                              headers={ 'Content-Type': encoder.content_type },
+                                              timeout=self._timeout )
+                    res.raise_for_status()
+                    return UPLOADED
+                except Exception, e:
+                    LOGGER.warning("Failed to upload the render %s (attempt %d of %d): %s" %
+                                   (label, attempt+1, self._retries, str(e)) )
+                    if rejected( e ):
+                        return REJECTED
+                    if attempt+1 < self._retries:
+                        time.sleep( 2**attempt )
+            return FAILED
+        finally:
+            handle.close()
+
+    def close(self, ):
+        self._pool.close()
+        self._pool.join()
+        self._session.close()
@@ -10,18 +10,77 @@ import time
 
 import glob
 import shutil
+import re
+import json
+import socket
+import zlib
 
 try:
     from Queue import Queue, Empty
 except ImportError:
     from queue import Queue, Empty  # python 3.x
 
+from logpipe import LogPipe
+from inputs import read_through
+from options import seconds, enabled
+
 ON_POSIX = 'posix' in sys.builtin_module_names
 
-def enqueue_output(out, queue):
-    for line in iter(out.readline, b''):
-        queue.put(line)
-    out.close()
+FRAME_PATTERN = re.compile( r'Fra:(\d+)' )
+TILES_PATTERN = re.compile( r'(?:Rendered|Path Tracing Tile) (\d+)/(\d+)' )
+SAMPLE_PATTERN = re.compile( r'Sample (\d+)/(\d+)' )
+SAVED_PATTERN = re.compile( r"Saved: '(.*)'" )
+
+def parse_progress(line):
+    """Reads (frame, percent) from a Blender status line such as
+    'Fra:12 ... | Rendered 40/64 Tiles, Sample 32/128'."""
+    match = TILES_PATTERN.search( line ) or SAMPLE_PATTERN.search( line )
+    if match == None:
+        return None
+    done, total = float( match.group(1) ), float( match.group(2) )
+    if total <= 0:
+        return None
+    frame = None
+    frame_match = FRAME_PATTERN.search( line )
+    if frame_match != None:
+        frame = int( frame_match.group(1) )
+    return ( frame, 100.0 * done / total )
+
+def parse_saved(line):
+    """Reads the path from the line Blender prints once it has written an
+    image, such as "Saved: '/tmp/render_00000012.png'"."""
+    match = SAVED_PATTERN.search( line )
+    if match == None:
+        return None
+    return osp.normpath( match.group(1) )
+
+
+# Renders a region of the frame for tiled jobs. Regions are measured from
+# the top left like a RenderMan CropWindow, Blender's border from the bottom
+# left. The border reaches overlap pixels past the region so rounding never
+# leaves a seam, and is not cropped so the tile keeps the frame's size.
+REGION_SCRIPT = """
+BORDER_FIELDS = ("use_border", "use_crop_to_border", "border_min_x", "border_max_x", "border_min_y", "border_max_y")
+
+def get_border(scene):
+    return dict((field, getattr(scene.render, field)) for field in BORDER_FIELDS)
+
+def set_border(scene, border):
+    for field, value in border.items():
+        setattr(scene.render, field, value)
+
+def set_region(scene, region, overlap):
+    render = scene.render
+    scale = render.resolution_percentage / 100.0
+    pad_x = overlap / max(1.0, render.resolution_x * scale)
+    pad_y = overlap / max(1.0, render.resolution_y * scale)
+    set_border(scene, { "use_border": True,
+                        "use_crop_to_border": False,
+                        "border_min_x": max(0.0, region[0] - pad_x),
+                        "border_max_x": min(1.0, region[1] + pad_x),
+                        "border_min_y": max(0.0, 1.0 - region[3] - pad_y),
+                        "border_max_y": min(1.0, 1.0 - region[2] + pad_y) })
+"""
 
 
 class BlenderNode:
@@ -31,16 +90,30 @@ class BlenderNode:
         self._exec_binary = kwargs['exec']
         self._config_path = kwargs['config_path']
         self._scene_path = kwargs['scene_path']
-        self._timeout = kwargs['timeout']
+        self._timeout = seconds(kwargs['timeout'])
+        self._frame_timeout = None
         self._attempts = int(kwargs['attempts'])
+        self._threads = int(kwargs.get('threads', 0))
+        self._render_path = kwargs.get('render_path', '/tmp')
+        self._scene_cache = kwargs.get('scene_cache')
+        self._cached_scene = None
         self._scene = None
         self._frame = None
+        self._frames = []
+        self._region = None
+        self._tile_overlap = int(kwargs.get('tile_overlap', 2))
+        # Seeds derived from the scene and frame instead of the clock, so a
+        # frame rendered twice comes out the same and can be cached
+        self._deterministic = enabled(kwargs.get('deterministic', 'off'))
+        self._pending = []
+        self._finished = {}
         self._process = None
-        self._logqueue = None 
-        self._logthread = None
+        self._logpipe = None
+        self._log_lines = int(kwargs.get('log_lines', 1000))
+        self._exit_callback = None
         self._lastrt = -1
         self._current_log = ""
-        self._lastrender = {"render": bytes([])}
+        self._lastrender = {}
 
         self._timeoutthread = None
         self._timeoutlock = None
@@ -54,11 +127,74 @@ class BlenderNode:
     def Extension(self, ):
         return "png"
 
+    def SeedScript(self, ):
+        return osp.join( self._render_path, "seed_script.py" )
+
+    def OutputFile(self, frame=None):
+        if frame == None:
+            frame = self._frame
+        return osp.join( self._render_path, "Renders", "render_{:08d}.png".format(frame) )
+
+    def SetExitCallback(self, callback):
+        self._exit_callback = callback
+
+    def SceneDirectory(self, ):
+        """Where to read the current scene from; a local copy when caching."""
+        if self._cached_scene != None:
+            self._scene_cache.release( self._cached_scene )
+            self._cached_scene = None
+        if self._scene_cache != None:
+            try:
+                local_scene = self._scene_cache.acquire( self._scene )
+            except Exception, e:
+                self._logger.warning( "Failed to cache scene {:s}, reading it from the source: {:s}".format( self._scene, str(e) ) )
+            else:
+                # Until its local copy is ready the scene is read from the source
+                if local_scene != None:
+                    self._cached_scene = self._scene
+                    return local_scene
+        return osp.join( self._scene_path, self._scene )
+
     def SetScene(self, scene):
         self._scene = scene
 
+    def PrepareInputs(self, scene, frames):
+        """Reads the inputs of a later render of scene ahead of time, into
+        the scene cache or the page cache. Safe to call from another thread
+        while this renderer renders."""
+        if self._scene_cache != None:
+            self._scene_cache.sync( scene )
+            return
+        read_through( osp.join( self._scene_path, scene, 'scene.blend' ) )
+
     def SetFrame(self, frame):
-        self._frame = frame
+        self.SetFrames( [frame] )
+
+    def SetTimeout(self, timeout):
+        """Overrides the configured per-frame timeout for the next renders;
+        None restores it."""
+        self._frame_timeout = timeout
+
+    def Timeout(self, ):
+        if self._frame_timeout != None:
+            return self._frame_timeout
+        return self._timeout
+
+    def SeedBase(self, ):
+        """The deterministic seed of frame 0; each frame adds its number."""
+        return zlib.crc32( self._scene ) & 0x3fffffff
+
+    def SetRegion(self, region):
+        """Limits the next renders to region, [xmin, xmax, ymin, ymax] in
+        fractions of the frame from its top left; None renders all of it."""
+        self._region = region
+
+    def SetFrames(self, frames):
+        """Sets a run of consecutive frames to render in a single launch."""
+        self._frames = sorted( frames )
+        self._frame = self._frames[0]
+        self._pending = list( self._frames )
+        self._finished = {}
 
     def Status(self, ):
         self.CheckStatus();
@@ -74,16 +210,8 @@ class BlenderNode:
         return "UNKNOWN"
 
     def Log(self, ):
-        if self._logqueue != None:
-            lines = []
-            while True:
-                line = ""
-                try: line = self._logqueue.get_nowait()
-                except Empty:
-                    break
-                else:
-                    lines.append( line )
-            return "\n".join( lines )
+        if self._logpipe != None:
+            return self._logpipe.read()
         else:
             return ""
                 
@@ -91,40 +219,62 @@ class BlenderNode:
     def BeginRender(self, ):
         self.StopRender();        
         self._current_log = ""      
-	with open("/tmp/seed_script.py",'w') as seedscript:
-	    seedscript.writelines(["import bpy\n",
-                                   "import time\n",
-                                   "seed = int(time.time())\n",
-                                   "for scene in bpy.data.scenes:\n",
-                                   "    scene.cycles.seed = seed\n" ])
-
-        # Remove the image file that we will be producing to eliminate false positives
-        try:
-            os.remove( "/tmp/Renders/render_{:08d}.png".format(self._frame) );
-        except: 
-            pass
+        scene_dir = self.SceneDirectory()
+        with open(self.SeedScript(),'w') as seedscript:
+            if self._deterministic:
+                # Seeded as each frame is set, so a frame's seed does not
+                # depend on the batch it is rendered in
+                seedscript.writelines(["import bpy\n",
+                                       "def set_seed(*args):\n",
+                                       "    for scene in bpy.data.scenes:\n",
+                                       "        scene.cycles.seed = {:d} + bpy.context.scene.frame_current\n".format( self.SeedBase() ),
+                                       "bpy.app.handlers.frame_change_pre.append(set_seed)\n",
+                                       "set_seed()\n" ])
+            else:
+                seedscript.writelines(["import bpy\n",
+                                       "import time\n",
+                                       "seed = int(time.time())\n",
+                                       "for scene in bpy.data.scenes:\n",
+                                       "    scene.cycles.seed = seed\n" ])
+            if self._region != None:
+                seedscript.write( REGION_SCRIPT )
+                seedscript.writelines(["for scene in bpy.data.scenes:\n",
+                                       "    set_region(scene, {:s}, {:d})\n".format( repr( [ float(value) for value in self._region ] ),
+                                                                                     self._tile_overlap ) ])
+
+        # Remove the image files that we will be producing to eliminate false positives
+        for frame in self._pending:
+            try:
+                os.remove( self.OutputFile(frame) );
+            except: 
+                pass
 
         self._process = Popen( [self._exec_binary,
                                 "-b",
-                                osp.join( self._scene_path, self._scene, 'scene.blend' ),
-                                "-y", "-P", "/tmp/seed_script.py",
+                                osp.join( scene_dir, 'scene.blend' ),
+                                "-y", "-P", self.SeedScript(),
                                 "-noaudio",
-                                "-o", "/tmp/Renders/render_########",
+                                "-o", osp.join( self._render_path, "Renders", "render_########" ),
                                 "-F", "PNG",
-                                "-f", str(self._frame) ],
+                                "-t", str(self._threads),
+                                "-s", str(self._pending[0]),
+                                "-e", str(self._pending[-1]),
+                                "-a" ],
                                stdout=PIPE, 
                                stderr=PIPE,
                                env = dict( os.environ,
                                            BLENDER_USER_CONFIG=self._config_path,
-                                           TMP = "/tmp" ),
+                                           TMP = self._render_path ),
                                );
-        self._logqueue = Queue()
-        self._logthread = Thread( target=enqueue_output, args=(self._process.stdout, self._logqueue ) )
-        self._logthread.daemon = True
-        self._logthread.start()
+        self._logpipe = LogPipe( [ self._process.stdout, self._process.stderr ], parse_progress,
+                                 self._log_lines, self._exit_callback, parse_saved )
         self._jobstart = datetime.now()
         self._currentattempt = self._currentattempt + 1
         
+    def Shutdown(self, ):
+        """Releases everything the renderer holds before it is discarded."""
+        self.StopRender()
+
     def RestartRender(self, ):
         self.StopRender();
         self.BeginRender();
@@ -134,8 +284,7 @@ class BlenderNode:
             self._process.kill()
             self._process.wait()            
             self._lastrt = self._process.returncode
-            self._logthread.join()
-            self._logthread = None
+            self._logpipe.join()
             self._process = None
             try:
                 cache_files = glob.glob("/cache/*")
@@ -146,7 +295,7 @@ class BlenderNode:
 
     def job_failed(self, ):
         if self._currentattempt < self._attempts:
-            self._logger.info(  "Restarting job for attempt", str(self._currentattempt + 1) );
+            self._logger.info(  "Restarting job for attempt %s", str(self._currentattempt + 1) );
             self.RestartRender();
         else:
             self._logger.info("Terminating job due to excessive failures." )
@@ -155,31 +304,77 @@ class BlenderNode:
             self._lastrt = 1
 
     def job_success(self, ):
-        with open( "/tmp/Renders/render_{:08d}.png".format(self._frame), 'rb' ) as f:
-            self._lastrender["render"] = f.read()
-        try:
-            os.remove( "/tmp/Renders/render_{:08d}.png".format(self._frame) );
-        except: 
-            self._logger.warning( "Failed to remove temporary render result." )
+        self.CollectFinishedFrames( True )
         self._currentattempt = 0
         self._lastrt = 0
         self.StopRender()
         
     def check_file_for_success(self,):
-        if osp.exists( "/tmp/Renders/render_{:08d}.png".format(self._frame) ) :
-            self._logger.info(  "Found rendered image despite blender failure. Considering job successful." )
+        self.CollectFinishedFrames( True )
+        if len(self._pending) == 0:
+            self._logger.info(  "Found rendered images despite blender failure. Considering job successful." )
             self.job_success();
         else:
             self.job_failed();                    
 
+    def CollectFinishedFrames(self, process_done):
+        """Moves frames whose output is complete from pending to finished.
+
+        Blender prints a Saved line once it has written a frame's image;
+        after the process is done every output on disk is complete."""
+        saved = []
+        if self._logpipe != None:
+            saved = self._logpipe.take_outputs()
+        for frame in list(self._pending):
+            path = self.OutputFile(frame)
+            if osp.normpath( path ) in saved or ( process_done and osp.exists( path ) ):
+                self.FinishFrame( frame )
+
+    def FinishFrame(self, frame):
+        # Keep only the location of the result; it is streamed from disk on upload
+        self._finished[frame] = {"render": self.OutputFile(frame)}
+        self._lastrender = self._finished[frame]
+        self._pending.remove( frame )
+        if self._logpipe != None:
+            self._logpipe.reset_progress()
+        # Each frame of a batch gets the full timeout
+        self._jobstart = datetime.now()
+
+    def Progress(self, ):
+        """Returns (frame, percent) for the frame being rendered, or None."""
+        if self._logpipe == None or len(self._pending) == 0:
+            return None
+        progress = self._logpipe.progress()
+        if progress == None:
+            return None
+        frame, percent = progress
+        if frame == None:
+            frame = self._pending[0]
+        if frame not in self._pending:
+            return None
+        return ( frame, percent )
+
+    def LoadedAt(self, ):
+        """When the current launch first reported progress, that is when it
+        had loaded the scene, or None."""
+        if self._logpipe == None:
+            return None
+        return self._logpipe.first_progress()
+
+    def TakeFinishedFrames(self, ):
+        """Returns the outputs (frame -> label -> path) of every frame that
+        finished since the last call."""
+        finished = self._finished
+        self._finished = {}
+        return finished
+
 
     def CheckStatus(self, ):
         if self._process != None:
             self._process.poll()
             self._lastrt = self._process.returncode
             if self._lastrt != None:
-                self._logthread.join()
-                self._logthread = None
+                self._logpipe.join()
                 self._process = None
                 if self._lastrt == 0:
                     self.job_success();
@@ -187,19 +382,311 @@ class BlenderNode:
                     self._logger.info(  "Render job failed with code {:d}".format(self._lastrt) )
                     self.check_file_for_success();
             else:
-                if self._timeout >= 0:
+                self.CollectFinishedFrames( False )
+                if self.Timeout() >= 0:
                     # Check the timeout
                     time_now = datetime.now()
                     time_running = (time_now - self._jobstart).total_seconds();
-                    if time_running > self._timeout: # We have exceeded timeout
+                    if time_running > self.Timeout(): # We have exceeded timeout
                         self._logger.info(  "Render job timeout exceeded," );
                         self.check_file_for_success();                           
 
             
     def LastRender(self, ):
-        return self._lastrender
+        """Opens the outputs of the last successful render for reading.
+
+        The caller owns the returned file handles and must close them."""
+        return dict( (label, open(path, 'rb')) for label, path in self._lastrender.items() )
+
+# Control script run inside the resident Blender process. It listens on a
+# unix socket for one JSON request per line and answers with one JSON line
+# per finished frame, then a final "finished" line for the request.
+BLENDER_SERVER_SCRIPT = """
+import bpy
+import json
+import os
+import socket
+import sys
+import traceback
+""" + REGION_SCRIPT + """
+
+socket_path = sys.argv[sys.argv.index("--") + 1]
+if os.path.exists(socket_path):
+    os.remove(socket_path)
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(socket_path)
+server.listen(1)
+
+loaded_scene = None
+borders = {}
+while True:
+    connection, address = server.accept()
+    stream = connection.makefile("rw")
+    for line in stream:
+        request = json.loads(line)
+        if request["command"] == "quit":
+            sys.exit(0)
+        ok = True
+        try:
+            # A scene file replaced on disk under the same path is reloaded
+            stat = os.stat(request["scene_file"])
+            stamp = [request["scene_file"], stat.st_size, stat.st_mtime]
+            if stamp != loaded_scene:
+                bpy.ops.wm.open_mainfile(filepath=request["scene_file"])
+                loaded_scene = stamp
+                borders = dict((scene.name, get_border(scene)) for scene in bpy.data.scenes)
+            for scene in bpy.data.scenes:
+                scene.cycles.seed = request["seed"]
+                # The scene stays loaded, so a tile's border must not leak
+                # into the next request
+                if request.get("region"):
+                    set_region(scene, request["region"], request["overlap"])
+                elif scene.name in borders:
+                    set_border(scene, borders[scene.name])
+            scene = bpy.context.scene
+            if request["threads"] > 0:
+                scene.render.threads_mode = "FIXED"
+                scene.render.threads = request["threads"]
+            else:
+                scene.render.threads_mode = "AUTO"
+            scene.render.image_settings.file_format = "PNG"
+            scene.render.use_file_extension = True
+            for frame in request["frames"]:
+                if request.get("seed_base") is not None:
+                    for each in bpy.data.scenes:
+                        each.cycles.seed = request["seed_base"] + frame
+                scene.frame_set(frame)
+                scene.render.filepath = request["output"].replace("########", "%08d" % frame)
+                bpy.ops.render.render(write_still=True)
+                stream.write(json.dumps({"status": "frame", "frame": frame}) + "\\n")
+                stream.flush()
+        except Exception:
+            traceback.print_exc()
+            sys.stdout.flush()
+            ok = False
+        stream.write(json.dumps({"status": "finished", "ok": ok}) + "\\n")
+        stream.flush()
+"""
+
+def enqueue_replies(stream, queue, on_reply=None):
+    for line in iter(stream.readline, b''):
+        try:
+            queue.put( json.loads( line ) )
+        except ValueError:
+            continue
+        if on_reply != None:
+            on_reply()
+    stream.close()
+
+
+class BlenderServerNode(BlenderNode):
+    """A Blender node that keeps a resident Blender process between frames.
+
+    The resident process runs a small control script and renders frames on
+    request over a unix socket, keeping the loaded scene until a frame of a
+    different scene arrives or the scene file changes on disk. It is recycled after recycle_frames frames or
+    once it grows past recycle_memory MB."""
+
+    def __init__(self, **kwargs ):
+        BlenderNode.__init__(self, **kwargs)
+        self._server = None
+        self._connection = None
+        self._stream = None
+        self._replies = None
+        self._replythread = None
+        self._request_running = False
+        self._request_failed = False
+        self._server_frames = 0
+        self._recycle_frames = int(kwargs.get('recycle_frames', 100))
+        self._recycle_memory = int(kwargs.get('recycle_memory', 0))
+        self._server_start_timeout = seconds(kwargs.get('server_start_timeout', 60))
+        self._logger = logging.getLogger("blender-server")
+
+    def ServerScript(self, ):
+        return osp.join( self._render_path, "blender_server.py" )
+
+    def ServerSocket(self, ):
+        return osp.join( self._render_path, "blender_server.sock" )
+
+    def ServerMemory(self, ):
+        """Resident memory of the server process in MB, 0 when unknown."""
+        try:
+            with open( "/proc/{:d}/status".format( self._server.pid ) ) as status:
+                for line in status:
+                    if line.startswith( "VmRSS:" ):
+                        return int( line.split()[1] ) / 1024
+        except Exception:
+            pass
+        return 0
+
+    def StartServer(self, ):
+        with open( self.ServerScript(), 'w' ) as script:
+            script.write( BLENDER_SERVER_SCRIPT )
+        self._server = Popen( [self._exec_binary,
+                               "-b", "-y", "-noaudio",
+                               "-P", self.ServerScript(),
+                               "--", self.ServerSocket() ],
+                              stdout=PIPE, 
+                              stderr=PIPE,
+                              env = dict( os.environ,
+                                          BLENDER_USER_CONFIG=self._config_path,
+                                          TMP = self._render_path ),
+                              );
+        self._logpipe = LogPipe( [ self._server.stdout, self._server.stderr ], parse_progress,
+                                 self._log_lines, self._exit_callback )
+        self._server_frames = 0
+
+        # Wait for the control script to start listening
+        start = time.time()
+        while True:
+            if self._server.poll() != None:
+                raise RuntimeError( "Blender server exited with code {:d} during startup".format( self._server.returncode ) )
+            try:
+                self._connection = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+                self._connection.connect( self.ServerSocket() )
+                break
+            except socket.error:
+                self._connection.close()
+                self._connection = None
+                if time.time() - start > self._server_start_timeout:
+                    raise RuntimeError( "Timed out waiting for the Blender server to start" )
+                time.sleep( 0.1 )
+
+        self._stream = self._connection.makefile( 'rw' )
+        self._replies = Queue()
+        self._replythread = Thread( target=enqueue_replies, args=(self._connection.makefile( 'r' ), self._replies, self._exit_callback ) )
+        self._replythread.daemon = True
+        self._replythread.start()
+        self._logger.info( "Started resident Blender server (pid {:d})".format( self._server.pid ) )
+
+    def StopServer(self, ):
+        if self._server == None:
+            return
+        if self._server.poll() == None:
+            self._server.kill()
+        self._server.wait()
+        for stream in [ self._stream, self._connection ]:
+            try:
+                if stream != None:
+                    stream.close()
+            except Exception:
+                pass
+        self._logpipe.join()
+        if self._replythread != None:
+            self._replythread.join()
+            self._replythread = None
+        self._stream = None
+        self._connection = None
+        self._server = None
+
+    def Shutdown(self, ):
+        self.StopRender()
+        self.StopServer()
+
+    def NeedsRecycle(self, ):
+        if self._server == None:
+            return False
+        if self._server.poll() != None:
+            return True
+        if self._server_frames >= self._recycle_frames:
+            return True
+        if self._recycle_memory > 0 and self.ServerMemory() > self._recycle_memory:
+            return True
+        return False
+
+    def Status(self, ):
+        self.CheckStatus();
+        if self._request_running:
+            return "RUNNING"
+        if self._lastrt == -1:
+            return "STOPPED"
+        if self._lastrt == 0:
+            return "SUCCESS"
+        return "FAILURE"
+
+    def BeginRender(self, ):
+        self.StopRender();
+        self._current_log = ""
+        scene_dir = self.SceneDirectory()
+
+        # Remove the image files that we will be producing to eliminate false positives
+        for frame in self._pending:
+            try:
+                os.remove( self.OutputFile(frame) );
+            except: 
+                pass
+
+        self._request_running = True
+        self._request_failed = False
+        self._jobstart = datetime.now()
+        self._currentattempt = self._currentattempt + 1
+        try:
+            if self.NeedsRecycle():
+                self._logger.info( "Recycling resident Blender server" )
+                self.StopServer()
+            if self._server == None:
+                self.StartServer()
+            self._logpipe.restart_progress()
+            self._stream.write( json.dumps( { "command": "render",
+                                              "scene_file": osp.join( scene_dir, 'scene.blend' ),
+                                              "frames": list(self._pending),
+                                              "seed": int(time.time()),
+                                              "seed_base": self.SeedBase() if self._deterministic else None,
+                                              "region": self._region,
+                                              "overlap": self._tile_overlap,
+                                              "threads": self._threads,
+                                              "output": osp.join( self._render_path, "Renders", "render_########" ) } ) + "\n" )
+            self._stream.flush()
+            self._server_frames = self._server_frames + len(self._pending)
+        except Exception, e:
+            self._logger.warning( "Failed to send render request to the Blender server: {:s}".format( str(e) ) )
+            self.StopServer()
+            self._request_failed = True
+
+    def StopRender(self, ):
+        # A render in progress cannot be cancelled, only the server killed
+        if self._request_running:
+            self._request_running = False
+            self.StopServer()
+
+    def CheckStatus(self, ):
+        if not self._request_running:
+            return
+        finished = None
+        if self._request_failed:
+            finished = False
+        else:
+            while True:
+                try: reply = self._replies.get_nowait()
+                except Empty:
+                    break
+                if reply.get( "status" ) == "frame" and reply.get( "frame" ) in self._pending:
+                    self.FinishFrame( reply["frame"] )
+                elif reply.get( "status" ) == "finished":
+                    finished = reply.get( "ok", False )
+        if finished == None and self._server.poll() != None:
+            self._logger.info( "Blender server exited with code {:d}".format( self._server.returncode ) )
+            self.StopServer()
+            finished = False
+
+        if finished == None:
+            if self.Timeout() >= 0:
+                time_running = (datetime.now() - self._jobstart).total_seconds();
+                if time_running > self.Timeout(): # We have exceeded timeout
+                    self._logger.info(  "Render job timeout exceeded," );
+                    self.check_file_for_success();
+        else:
+            self._request_running = False
+            if finished:
+                self._lastrt = 0
+                self.job_success()
+            else:
+                self._lastrt = 1
+                self.check_file_for_success()
 
 def BuildRenderer(kwargs):
+    if enabled(kwargs.get('warm', 'off')):
+        return BlenderServerNode(**kwargs)
     return BlenderNode(**kwargs)
 
 
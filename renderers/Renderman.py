@@ -10,18 +10,55 @@ import time
 
 import glob
 import shutil
+import re
+import gzip
+import json
+import hashlib
 
 try:
     from Queue import Queue, Empty
 except ImportError:
     from queue import Queue, Empty  # python 3.x
 
+from logpipe import LogPipe
+from inputs import read_through
+from options import seconds
+
 ON_POSIX = 'posix' in sys.builtin_module_names
 
-def enqueue_output(out, queue):
-    for line in iter(out.readline, b''):
-        queue.put(line)
-    out.close()
+PROGRESS_PATTERN = re.compile( r'R90000\s+(\d+(?:\.\d+)?)%' )
+FORMAT_PATTERN = re.compile( r'^Format\s+(\d+)\s+(\d+)' )
+
+def parse_progress(line):
+    """Reads the percentage done from a prman -Progress line such as
+    'R90000  35%'. prman does not say which frame it is on."""
+    match = PROGRESS_PATTERN.search( line )
+    if match == None:
+        return None
+    return ( None, float( match.group(1) ) )
+
+
+def feed_input(lines, stdin, chunk_size=65536):
+    """Writes lines into a renderer's stdin in chunks as they are produced."""
+    try:
+        chunk = []
+        chunk_len = 0
+        for line in lines:
+            chunk.append( line )
+            chunk_len = chunk_len + len(line)
+            if chunk_len >= chunk_size:
+                stdin.write( "".join( chunk ) )
+                chunk = []
+                chunk_len = 0
+        stdin.write( "".join( chunk ) )
+    except IOError:
+        # The renderer went away before reading everything
+        pass
+    finally:
+        try:
+            stdin.close()
+        except IOError:
+            pass
 
 
 class RenderManNode:
@@ -31,18 +68,40 @@ class RenderManNode:
         self._exec_binary = kwargs['exec']
         self._config_path = kwargs['config_path']
         self._scene_path = kwargs['scene_path']
-        self._timeout = kwargs['timeout']
+        self._timeout = seconds(kwargs['timeout'])
+        self._frame_timeout = None
         self._attempts = int(kwargs['attempts'])
         self._rmantree = kwargs['rmantree']
+        self._threads = int(kwargs.get('threads', 0))
+        self._render_path = kwargs.get('render_path', '/tmp')
+        self._scene_cache = kwargs.get('scene_cache')
+        self._cached_scene = None
         self._scene = None
         self._frame = None
+        self._frames = []
+        self._region = None
+        self._tile_overlap = int(kwargs.get('tile_overlap', 2))
+        self._pending = []
+        self._finished = {}
         self._process = None
-        self._logqueue = None 
-        self._logthread = None
+        self._logpipe = None
+        self._log_lines = int(kwargs.get('log_lines', 1000))
+        self._feedthread = None
+        self._exit_callback = None
         self._lastrt = -1
         self._current_log = ""
         self._lastrender = {}
-        self._lastrender_files = []
+        self._frame_outputs = {}
+
+        # With a checkpoint interval, each frame renders into its own scratch
+        # directory and checkpoints there, so a retry or a restarted worker
+        # resumes it with -recover instead of starting over
+        self._checkpoint_interval = int(kwargs.get('checkpoint_interval', 0))
+        self._checkpoint_path = osp.join( kwargs.get('save_path', self._render_path), "checkpoints" )
+        self._checkpoint_max_age = seconds(kwargs.get('checkpoint_max_age', 172800))
+        self._scratch = {}
+        self._rib_stamps = {}
+        self._launch_time = 0
         
         self._timeoutthread = None
         self._timeoutlock = None
@@ -56,11 +115,65 @@ class RenderManNode:
     def Extension(self, ):
         return "exr"
 
+    def SetExitCallback(self, callback):
+        self._exit_callback = callback
+
+    def SceneDirectory(self, ):
+        """Where to read the current scene from; a local copy when caching."""
+        if self._cached_scene != None:
+            self._scene_cache.release( self._cached_scene )
+            self._cached_scene = None
+        if self._scene_cache != None:
+            try:
+                local_scene = self._scene_cache.acquire( self._scene )
+            except Exception, e:
+                self._logger.warning( "Failed to cache scene {:s}, reading it from the source: {:s}".format( self._scene, str(e) ) )
+            else:
+                # Until its local copy is ready the scene is read from the source
+                if local_scene != None:
+                    self._cached_scene = self._scene
+                    return local_scene
+        return osp.join( self._scene_path, self._scene )
+
     def SetScene(self, scene):
         self._scene = scene
 
+    def PrepareInputs(self, scene, frames):
+        """Reads the RIBs of a later render of scene ahead of time, into the
+        scene cache or the page cache. Safe to call from another thread
+        while this renderer renders."""
+        if self._scene_cache != None:
+            self._scene_cache.sync( scene )
+            return
+        for frame in frames:
+            rib_path = self.RIBPath( osp.join( self._scene_path, scene ), frame )
+            if osp.exists( rib_path ):
+                read_through( rib_path )
+
     def SetFrame(self, frame):
-        self._frame = frame
+        self.SetFrames( [frame] )
+
+    def SetTimeout(self, timeout):
+        """Overrides the configured per-frame timeout for the next renders;
+        None restores it."""
+        self._frame_timeout = timeout
+
+    def Timeout(self, ):
+        if self._frame_timeout != None:
+            return self._frame_timeout
+        return self._timeout
+
+    def SetRegion(self, region):
+        """Limits the next renders to region, [xmin, xmax, ymin, ymax] in
+        fractions of the frame from its top left; None renders all of it."""
+        self._region = region
+
+    def SetFrames(self, frames):
+        """Sets a run of consecutive frames to render in a single launch."""
+        self._frames = sorted( frames )
+        self._frame = self._frames[0]
+        self._pending = list( self._frames )
+        self._finished = {}
 
     def Status(self, ):
         self.CheckStatus();
@@ -76,82 +189,201 @@ class RenderManNode:
         return "UNKNOWN"
 
     def Log(self, ):
-        if self._logqueue != None:
-            lines = []
-            while True:
-                line = ""
-                try: line = self._logqueue.get_nowait()
-                except Empty:
-                    break
-                else:
-                    lines.append( line )
-            return "\n".join( lines )
+        if self._logpipe != None:
+            return self._logpipe.read()
         else:
             return ""
-                
 
-    def SanitizeRIB( self, rib_file ):        
-        rib_data = []
-        renders = []
+    def CropWindow( self, width, height ):
+        """The CropWindow line for the current region, reaching tile_overlap
+        pixels past it so rounding never leaves a seam between tiles."""
+        xmin, xmax, ymin, ymax = [ float(value) for value in self._region ]
+        pad_x = self._tile_overlap / float( max( 1, width ) )
+        pad_y = self._tile_overlap / float( max( 1, height ) )
+        return "CropWindow {:.6f} {:.6f} {:.6f} {:.6f}\n".format( max( 0.0, xmin - pad_x ), min( 1.0, xmax + pad_x ),
+                                                                   max( 0.0, ymin - pad_y ), min( 1.0, ymax + pad_y ) )
+
+    def OutputDirectory( self, frame ):
+        """Where a frame's displays are written: the render path, or with
+        checkpoints a scratch directory named after the scene, frame, region
+        and the frame's RIB, so every attempt at the frame finds the same one
+        and a re-exported RIB never resumes from an old checkpoint."""
+        if self._checkpoint_interval <= 0:
+            return self._render_path
+        key = hashlib.sha1( json.dumps( [ self._scene, frame, self._region,
+                                          self._rib_stamps.get( frame ) ] ) ).hexdigest()[:16]
+        return osp.join( self._checkpoint_path, key )
+
+    def PrepareScratch( self, ):
+        """Creates the scratch directories of the pending frames and clears
+        out those no longer needed. Returns whether any pending frame has
+        checkpoints to recover from."""
+        for directory, frame in self._scratch.items():
+            # Finished outputs stay until the worker has taken them
+            if frame not in self._pending and frame not in self._finished:
+                shutil.rmtree( directory, ignore_errors=True )
+                del self._scratch[directory]
+        recover = False
+        for frame in self._pending:
+            directory = self.OutputDirectory( frame )
+            if osp.isdir( directory ):
+                recover = recover or len( os.listdir( directory ) ) > 0
+            else:
+                os.makedirs( directory )
+            self._scratch[directory] = frame
+        self.PruneCheckpoints()
+        return recover
+
+    def PruneCheckpoints( self, ):
+        """Removes the checkpoints of frames no attempt has touched for
+        checkpoint_max_age seconds, such as those rendered by another node
+        after this one restarted."""
+        try:
+            directories = os.listdir( self._checkpoint_path )
+        except OSError:
+            return
+        cutoff = time.time() - self._checkpoint_max_age
+        for name in directories:
+            directory = osp.join( self._checkpoint_path, name )
+            try:
+                touched = max( [ osp.getmtime( directory ) ] +
+                               [ osp.getmtime( osp.join( directory, filename ) ) for filename in os.listdir( directory ) ] )
+            except OSError:
+                continue
+            if touched < cutoff and directory not in self._scratch:
+                self._logger.info( "Removing stale checkpoints in {:s}".format( directory ) )
+                shutil.rmtree( directory, ignore_errors=True )
+
+    def SanitizeRIB( self, rib_file, renders, output_path=None ):        
+        """Yields the lines of rib_file with every Display redirected into
+        output_path (the render path by default), appending each image name
+        to renders as it is seen. With a region set, the RIB's own CropWindow
+        is replaced by one for the region."""
+        if output_path == None:
+            output_path = self._render_path
         extra_display = False;
+        # prman's default resolution, until a Format line says otherwise
+        width, height = 640, 480
         for line in rib_file:
             line = line.strip()
+            if self._region != None:
+                match = FORMAT_PATTERN.match( line )
+                if match != None:
+                    width, height = int( match.group(1) ), int( match.group(2) )
+                if line.startswith( "CropWindow" ):
+                    continue
+                # Options must come before the world block
+                if line.startswith( "WorldBegin" ):
+                    yield self.CropWindow( width, height )
             if line.startswith( "Display " ):
                 parts = line.strip().split()
                 image_filename = osp.basename( parts[1].strip('"') )
                 renders.append( image_filename )
+                # Remove stale output so its presence means this render made
+                # it; a checkpointed image is what -recover resumes from
+                if self._checkpoint_interval <= 0:
+                    try:
+                        os.remove( osp.join( output_path, image_filename ) )
+                    except OSError:
+                        pass
                 if extra_display:
-                    parts[1] = '"+{:s}"'.format( osp.join( "/tmp", image_filename ) )
+                    parts[1] = '"+{:s}"'.format( osp.join( output_path, image_filename ) )
                 else:
-                    parts[1] = '"{:s}"'.format( osp.join( "/tmp", image_filename ) )
+                    parts[1] = '"{:s}"'.format( osp.join( output_path, image_filename ) )
                     extra_display = True
                 new_line = " ".join( parts )
-                rib_data.append( new_line )
+                yield new_line + "\n"
             else:
-                rib_data.append( line )
-        return ["\n".join( rib_data ), renders]
+                yield line + "\n"
+
+    def RIBStamp( self, scene_dir, frame ):
+        """The size and mtime of a frame's RIB, which the scene cache keeps
+        on its copies, or None when it is missing."""
+        try:
+            stat = os.stat( self.RIBPath( scene_dir, frame ) )
+        except OSError:
+            return None
+        return [ stat.st_size, int( stat.st_mtime ) ]
+
+    def RIBPath( self, scene_dir, frame ):
+        rib_path = osp.join( scene_dir, 'Scene.{:04d}.rib'.format(frame))
+        if not osp.exists( rib_path ) and osp.exists( rib_path + ".gz" ):
+            rib_path = rib_path + ".gz"
+        return rib_path
+
+    def OpenRIB( self, scene_dir, frame ):
+        """Opens a frame's RIB, transparently decompressing gzipped RIBs."""
+        rib_path = self.RIBPath( scene_dir, frame )
+        with open( rib_path, 'rb' ) as f:
+            magic = f.read(2)
+        if magic == "\x1f\x8b":
+            return gzip.open( rib_path, 'rb' )
+        return open( rib_path, 'r' )
+
+    def StreamRIBs( self, scene_dir, frames ):
+        """Yields the sanitized RIBs of frames back to back as one stream."""
+        for frame in frames:
+            try:
+                rib_file = self.OpenRIB( scene_dir, frame )
+            except Exception, e:
+                self._logger.warning( "Failed to open RIB for frame {:s}: {:s}".format( str(frame), str(e) ) )
+                continue
+            try:
+                for line in self.SanitizeRIB( rib_file, self._frame_outputs[frame], self.OutputDirectory( frame ) ):
+                    yield line
+            finally:
+                rib_file.close()
                 
     def BeginRender(self, ):
         self.StopRender();        
         self._current_log = ""      
+        scene_dir = self.SceneDirectory()
 
-        rib_data = ""
-        renders = []
-        try:
-            rib_file = open( osp.join( self._scene_path, self._scene, 'Scene.{:04d}.rib'.format(self._frame)), 'r' )
-            rib_data, renders = self.SanitizeRIB( rib_file )
-        except:
-            pass
-        
-        self._lastrender_files = renders
-        read, write = os.pipe()
-        os.write(write, rib_data)
-        os.close(write)
+        # Filled in by the feeder as Display lines stream past
+        self._frame_outputs = dict( (frame, []) for frame in self._pending )
+
+        options = []
+        if self._checkpoint_interval > 0:
+            self._rib_stamps = dict( ( frame, self.RIBStamp( scene_dir, frame ) ) for frame in self._pending )
+            options = [ "-checkpoint", "{:d}s".format( self._checkpoint_interval ) ]
+            if self.PrepareScratch():
+                self._logger.info( "Resuming frames {:s} from their checkpoints".format( str(self._pending) ) )
+                options = options + [ "-recover", "1" ]
 
         # Remove the image file that we will be producing to eliminate false positives
+        self._launch_time = time.time()
         self._process = Popen( [self._exec_binary,
-                                "-cwd", osp.join( self._scene_path, self._scene),
+                                "-cwd", scene_dir,
                                 "-Progress",
                                 "-loglevel", "4",
+                                "-t:{:d}".format( self._threads ) ] + options + [
                                 "-"    
         ],
-                               stdin=read,
+                               stdin=PIPE,
                                stdout=PIPE, 
                                stderr=PIPE,
                                env = dict( os.environ,
                                            RENDERMAN_USER_CONFIG=self._config_path,
                                            RMANTREE=self._rmantree,
-                                           TMP = "/tmp" ),
+                                           TMP = self._render_path ),
                            );
         #self._process = Popen( ["/bin/true"], stdout=PIPE, stderr=PIPE )
+
+        rib_lines = self.StreamRIBs( scene_dir, list(self._pending) )
+        self._feedthread = Thread( target=feed_input, args=(rib_lines, self._process.stdin ) )
+        self._feedthread.daemon = True
+        self._feedthread.start()
         
-        self._logqueue = Queue()
-        self._logthread = Thread( target=enqueue_output, args=(self._process.stdout, self._logqueue ) )
-        self._logthread.daemon = True
-        self._logthread.start()
+        self._logpipe = LogPipe( [ self._process.stdout, self._process.stderr ], parse_progress,
+                                 self._log_lines, self._exit_callback )
         self._jobstart = datetime.now()
         self._currentattempt = self._currentattempt + 1
         
+    def Shutdown(self, ):
+        """Releases everything the renderer holds before it is discarded.
+        Checkpoints of unfinished frames are kept for the next attempt."""
+        self.StopRender()
+
     def RestartRender(self, ):
         self.StopRender();
         self.BeginRender();
@@ -161,8 +393,9 @@ class RenderManNode:
             self._process.kill()
             self._process.wait()            
             self._lastrt = self._process.returncode
-            self._logthread.join()
-            self._logthread = None
+            self._logpipe.join()
+            self._feedthread.join()
+            self._feedthread = None
             self._process = None
 
     def job_failed(self, ):
@@ -175,51 +408,109 @@ class RenderManNode:
             self._currentattempt = 0
             self._lastrt = 1
 
-    def job_success(self, ):
-        self._lastrender = {}
-        for filename in self._lastrender_files:
-            parts = filename.split('.')
-            clean_parts = []
-            for p in parts:
-                if p == "Scene":
-                    continue;
-                try:
-                    test = int(p)
-                except:
-                    pass
-                else:
-                    continue
-                if p == "exr":
-                    continue
-                clean_parts.append( p )
-            
-            label = 'render'            
-            if  len(clean_parts) > 0 :
-                label = ".".join(clean_parts)
-                
-            with open( "/tmp/{:s}".format(filename), 'rb' ) as f:
-                self._lastrender[label] = f.read()
-                
+    def OutputLabel(self, filename):
+        parts = filename.split('.')
+        clean_parts = []
+        for p in parts:
+            if p == "Scene":
+                continue;
             try:
-                os.remove( "/tmp/{:s}".format(filename) );
-            except: 
-                self._logger.warning( "Failed to remove temporary render result." )               
+                test = int(p)
+            except:
+                pass
+            else:
+                continue
+            if p == "exr":
+                continue
+            clean_parts.append( p )
         
+        label = 'render'            
+        if  len(clean_parts) > 0 :
+            label = ".".join(clean_parts)
+        return label
+
+    def job_success(self, ):
+        self.CollectFinishedFrames( True )
         self._currentattempt = 0
         self._lastrt = 0
         self.StopRender()
         
     def check_file_for_success(self,):
+        self.CollectFinishedFrames( False )
         self.job_failed();                    
 
+    def CollectFinishedFrames(self, process_done):
+        """Moves frames whose outputs are complete from pending to finished.
+
+        prman renders the stream in order and opens a frame's displays only
+        once the previous frame is closed, so a frame is complete when a
+        later frame has produced output or the process exited cleanly."""
+        started = [ frame for frame in self._pending
+                    if any( self.WrittenSinceLaunch( osp.join( self.OutputDirectory( frame ), filename ) )
+                            for filename in self._frame_outputs.get( frame, [] ) ) ]
+        for frame in list(self._pending):
+            filenames = self._frame_outputs.get( frame, [] )
+            if len(filenames) == 0:
+                continue
+            directory = self.OutputDirectory( frame )
+            if not all( osp.exists( osp.join( directory, filename ) ) for filename in filenames ):
+                continue
+            if not process_done and not any( later > frame for later in started ):
+                continue
+            # Keep only the location of the result; it is streamed from disk on upload
+            self._finished[frame] = dict( ( self.OutputLabel( filename ), osp.join( directory, filename ) )
+                                          for filename in filenames )
+            self._lastrender = self._finished[frame]
+            self._pending.remove( frame )
+            if self._logpipe != None:
+                self._logpipe.reset_progress()
+            # Each frame of a batch gets the full timeout
+            self._jobstart = datetime.now()
+
+    def WrittenSinceLaunch(self, path):
+        """Checkpoints of an earlier attempt do not mean this launch has
+        reached their frame."""
+        try:
+            return osp.getmtime( path ) >= self._launch_time
+        except OSError:
+            return False
+
+    def Progress(self, ):
+        """Returns (frame, percent) for the frame being rendered, or None."""
+        if self._logpipe == None or len(self._pending) == 0:
+            return None
+        progress = self._logpipe.progress()
+        if progress == None:
+            return None
+        frame, percent = progress
+        if frame == None:
+            frame = self._pending[0]
+        if frame not in self._pending:
+            return None
+        return ( frame, percent )
+
+    def LoadedAt(self, ):
+        """When the current launch first reported progress, that is when it
+        had loaded the scene, or None."""
+        if self._logpipe == None:
+            return None
+        return self._logpipe.first_progress()
+
+    def TakeFinishedFrames(self, ):
+        """Returns the outputs (frame -> label -> path) of every frame that
+        finished since the last call."""
+        finished = self._finished
+        self._finished = {}
+        return finished
 
     def CheckStatus(self, ):
         if self._process != None:
             self._process.poll()
             self._lastrt = self._process.returncode
             if self._lastrt != None:
-                self._logthread.join()
-                self._logthread = None
+                self._logpipe.join()
+                self._feedthread.join()
+                self._feedthread = None
                 self._process = None
                 if self._lastrt == 0:
                     self.job_success();
@@ -227,17 +518,21 @@ class RenderManNode:
                     self._logger.info(  "Render job failed with code {:d}".format(self._lastrt) )
                     self.check_file_for_success();
             else:
-                if self._timeout >= 0:
+                self.CollectFinishedFrames( False )
+                if self.Timeout() >= 0:
                     # Check the timeout
                     time_now = datetime.now()
                     time_running = (time_now - self._jobstart).total_seconds();
-                    if time_running > self._timeout: # We have exceeded timeout
+                    if time_running > self.Timeout(): # We have exceeded timeout
                         self._logger.info(  "Render job timeout exceeded," );
                         self.check_file_for_success();                           
 
             
     def LastRender(self, ):
-        return self._lastrender
+        """Opens the outputs of the last successful render for reading.
+
+        The caller owns the returned file handles and must close them."""
+        return dict( (label, open(path, 'rb')) for label, path in self._lastrender.items() )
 
 
 def BuildRenderer(kwargs):
@@ -0,0 +1,6 @@
+def read_through(path, chunk_size=4 * 1024 * 1024):
+    """Reads a file to its end and discards it, leaving it in the page cache
+    for the renderer that reads it next."""
+    with open( path, 'rb' ) as f:
+        while f.read( chunk_size ):
+            pass
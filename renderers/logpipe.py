@@ -0,0 +1,101 @@
+import time
+from threading import Thread, Lock
+from collections import deque
+
+
+class LogPipe:
+    """Drains a renderer's output streams into a bounded ring buffer.
+
+    Every stream gets its own reader thread so a chatty renderer can never
+    block on a full pipe. Only the newest max_lines lines are kept between
+    reads. Each line is also passed to parse_progress, which returns
+    (frame, percent) when the line reports progress, with frame None if the
+    renderer does not say which frame it is on, and to parse_output, which
+    returns the path of an output the line reports as written, for
+    take_outputs. on_close runs when the first stream closes, which is our
+    earliest sign that the renderer exited.
+
+    The time of the first progress line is kept as well, as the point the
+    renderer finished loading its scene."""
+
+    def __init__(self, streams, parse_progress=None, max_lines=1000, on_close=None, parse_output=None):
+        self._lines = deque( maxlen=max_lines )
+        self._dropped = 0
+        self._lock = Lock()
+        self._parse_progress = parse_progress
+        self._parse_output = parse_output
+        self._outputs = []
+        self._progress = None
+        self._first_progress = None
+        self._threads = []
+        for index, stream in enumerate( streams ):
+            callback = None
+            if index == 0:
+                callback = on_close
+            thread = Thread( target=self._drain, args=(stream, callback) )
+            thread.daemon = True
+            thread.start()
+            self._threads.append( thread )
+
+    def _drain(self, stream, on_close):
+        for line in iter(stream.readline, b''):
+            line = line.rstrip()
+            progress = None
+            if self._parse_progress != None:
+                progress = self._parse_progress( line )
+            output = None
+            if self._parse_output != None:
+                output = self._parse_output( line )
+            with self._lock:
+                if len(self._lines) == self._lines.maxlen:
+                    self._dropped = self._dropped + 1
+                self._lines.append( line )
+                if progress != None:
+                    self._progress = progress
+                    if self._first_progress == None:
+                        self._first_progress = time.time()
+                if output != None:
+                    self._outputs.append( output )
+        stream.close()
+        if on_close != None:
+            on_close()
+
+    def read(self, ):
+        """Returns and clears the buffered lines."""
+        with self._lock:
+            lines = list( self._lines )
+            self._lines.clear()
+            if self._dropped > 0:
+                lines.insert( 0, "... {:d} lines dropped ...".format( self._dropped ) )
+                self._dropped = 0
+        return "\n".join( lines )
+
+    def take_outputs(self, ):
+        """Returns and clears the outputs reported as written."""
+        with self._lock:
+            outputs = self._outputs
+            self._outputs = []
+            return outputs
+
+    def progress(self, ):
+        with self._lock:
+            return self._progress
+
+    def reset_progress(self, ):
+        with self._lock:
+            self._progress = None
+
+    def first_progress(self, ):
+        """When the first progress line arrived since the pipe was created
+        or restart_progress was called, or None."""
+        with self._lock:
+            return self._first_progress
+
+    def restart_progress(self, ):
+        with self._lock:
+            self._progress = None
+            self._first_progress = None
+
+    def join(self, ):
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,9 @@
+def seconds(value):
+    """A duration from a renderer's section. ConfigParser hands over text,
+    and in Python 2 text never compares below a number, so a timeout left
+    as text would never fire."""
+    return float(value)
+
+def enabled(value):
+    """Whether an on/off option from a renderer's section is on."""
+    return str(value).lower() in ( 'on', 'true', 'yes', '1' )
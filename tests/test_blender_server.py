@@ -0,0 +1,160 @@
+"""Drives the Blender renderers, warm and per launch, through
+benchmark/fakeblender.py, which runs the real control script against a
+stand-in bpy module."""
+import os
+import os.path as osp
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+ROOT = osp.dirname( osp.dirname( osp.abspath( __file__ ) ) )
+if ROOT not in sys.path:
+    sys.path.insert( 0, ROOT )
+
+from renderers import Blender
+
+FAKE_BLENDER = osp.join( ROOT, "benchmark", "fakeblender.py" )
+
+
+class BlenderServerTest(unittest.TestCase):
+
+    def setUp(self, ):
+        self.root = tempfile.mkdtemp( prefix="plumage-blender-" )
+        self.scene_path = osp.join( self.root, "scenes" )
+        self.render_path = osp.join( self.root, "slot" )
+        os.makedirs( osp.join( self.scene_path, "shot" ) )
+        os.makedirs( osp.join( self.render_path, "Renders" ) )
+        self.write_scene( content="first" )
+        self.node = None
+
+    def tearDown(self, ):
+        if self.node != None:
+            self.node.Shutdown()
+        shutil.rmtree( self.root, ignore_errors=True )
+
+    def write_scene(self, **settings):
+        with open( osp.join( self.scene_path, "shot", "scene.blend" ), 'w' ) as f:
+            json.dump( settings, f )
+
+    def build(self, **options):
+        kwargs = { "exec": FAKE_BLENDER,
+                   "config_path": self.root,
+                   "scene_path": self.scene_path,
+                   "render_path": self.render_path,
+                   "timeout": 30,
+                   "attempts": 2,
+                   "warm": "on" }
+        kwargs.update( options )
+        self.node = Blender.BuildRenderer( kwargs )
+        if kwargs["warm"] == "on":
+            self.assertTrue( isinstance( self.node, Blender.BlenderServerNode ) )
+        return self.node
+
+    def render(self, frames, region=None, running=None):
+        """Renders frames of the scene and returns the status and the
+        stand-in's output for each finished frame. Frames that finished
+        while the renderer was still running are added to running."""
+        self.node.SetScene( "shot" )
+        self.node.SetRegion( region )
+        self.node.SetFrames( frames )
+        self.node.BeginRender()
+        outputs = {}
+        deadline = time.time() + 30
+        while True:
+            status = self.node.Status()
+            for frame, files in self.node.TakeFinishedFrames().items():
+                with open( files["render"] ) as f:
+                    outputs[frame] = json.load( f )
+                if running != None and status == "RUNNING":
+                    running.append( frame )
+            if status != "RUNNING":
+                return status, outputs
+            self.assertTrue( time.time() < deadline, "render did not finish" )
+            time.sleep( 0.02 )
+
+    def test_keeps_the_scene_loaded_between_requests(self, ):
+        self.build()
+        status, outputs = self.render( [ 1, 2 ] )
+        self.assertEqual( status, "SUCCESS" )
+        self.assertEqual( sorted( outputs.keys() ), [ 1, 2 ] )
+        status, more = self.render( [ 3 ] )
+        self.assertEqual( status, "SUCCESS" )
+        self.assertEqual( more[3]["pid"], outputs[1]["pid"] )
+        self.assertEqual( more[3]["loads"], 1 )
+
+    def test_reloads_a_replaced_scene_file(self, ):
+        self.build()
+        status, outputs = self.render( [ 1 ] )
+        self.assertEqual( outputs[1]["content"], "first" )
+        self.write_scene( content="second version" )
+        status, outputs = self.render( [ 2 ] )
+        self.assertEqual( status, "SUCCESS" )
+        self.assertEqual( outputs[2]["content"], "second version" )
+        self.assertEqual( outputs[2]["loads"], 2 )
+
+    def test_recycles_after_recycle_frames(self, ):
+        self.build( recycle_frames=2 )
+        status, outputs = self.render( [ 1, 2 ] )
+        status, more = self.render( [ 3 ] )
+        self.assertEqual( status, "SUCCESS" )
+        self.assertNotEqual( more[3]["pid"], outputs[1]["pid"] )
+
+    def test_restarts_a_crashed_server(self, ):
+        marker = osp.join( self.root, "crash" )
+        open( marker, 'w' ).close()
+        self.write_scene( content="first", crash_once=marker )
+        self.build()
+        status, outputs = self.render( [ 1 ] )
+        # The crashed process removed the marker, so the frame came from its replacement
+        self.assertEqual( status, "SUCCESS" )
+        self.assertFalse( osp.exists( marker ) )
+        self.assertEqual( outputs[1]["pid"], self.node._server.pid )
+
+    def test_fails_once_attempts_are_used_up(self, ):
+        marker = osp.join( self.root, "crash" )
+        open( marker, 'w' ).close()
+        self.write_scene( content="first", crash_once=marker )
+        self.build( attempts=1 )
+        status, outputs = self.render( [ 1 ] )
+        self.assertEqual( status, "FAILURE" )
+        self.assertEqual( outputs, {} )
+        status, outputs = self.render( [ 1 ] )
+        self.assertEqual( status, "SUCCESS" )
+
+    def test_region_does_not_leak_into_the_next_request(self, ):
+        self.build( tile_overlap=0 )
+        status, outputs = self.render( [ 1 ], region=[ 0.5, 1.0, 0.0, 0.25 ] )
+        self.assertEqual( outputs[1]["border"], [ True, 0.5, 1.0, 0.75, 1.0 ] )
+        status, outputs = self.render( [ 2 ] )
+        self.assertEqual( outputs[2]["border"], [ False, 0.0, 1.0, 0.0, 1.0 ] )
+        self.assertEqual( outputs[2]["loads"], 1 )
+
+    def test_frames_finish_as_the_server_reports_them(self, ):
+        self.write_scene( content="first", render_time=0.2 )
+        self.build()
+        running = []
+        status, outputs = self.render( [ 1, 2, 3 ], running=running )
+        self.assertEqual( sorted( outputs.keys() ), [ 1, 2, 3 ] )
+        self.assertEqual( running[:2], [ 1, 2 ] )
+
+    def test_launched_frames_finish_as_blender_saves_them(self, ):
+        self.write_scene( content="first", render_time=0.2 )
+        self.build( warm="off" )
+        running = []
+        status, outputs = self.render( [ 1, 2, 3 ], running=running )
+        self.assertEqual( status, "SUCCESS" )
+        self.assertEqual( sorted( outputs.keys() ), [ 1, 2, 3 ] )
+        self.assertEqual( running[:2], [ 1, 2 ] )
+
+    def test_deterministic_seeds_follow_the_frame(self, ):
+        self.build( deterministic="on" )
+        status, outputs = self.render( [ 4, 5 ] )
+        base = self.node.SeedBase()
+        self.assertEqual( [ outputs[4]["seed"], outputs[5]["seed"] ], [ base + 4, base + 5 ] )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Frame timeouts derived from the local render history."""
+import os.path as osp
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = osp.dirname( osp.dirname( osp.abspath( __file__ ) ) )
+if ROOT not in sys.path:
+    sys.path.insert( 0, ROOT )
+
+from node.history import RenderHistory, percentile
+
+
+class RenderHistoryTest(unittest.TestCase):
+
+    def setUp(self, ):
+        self.root = tempfile.mkdtemp( prefix="plumage-history-" )
+        self.path = osp.join( self.root, "render_history.json" )
+
+    def tearDown(self, ):
+        shutil.rmtree( self.root, ignore_errors=True )
+
+    def build(self, **options):
+        settings = { "min_samples": 3, "percentile": 0.95, "factor": 3.0, "min_timeout": 60, "max_timeout": 3600 }
+        settings.update( options )
+        return RenderHistory( self.path, **settings )
+
+    def record(self, history, samples, scene="shot", render_type="BLENDER"):
+        for seconds in samples:
+            history.record( scene, render_type, seconds )
+
+    def test_percentile(self, ):
+        samples = range( 1, 101 )
+        self.assertEqual( percentile( samples, 0.5 ), 51 )
+        self.assertEqual( percentile( samples, 0.95 ), 96 )
+        self.assertEqual( percentile( samples, 1.0 ), 100 )
+        self.assertEqual( percentile( [ 7 ], 0.95 ), 7 )
+
+    def test_no_timeout_until_min_samples(self, ):
+        history = self.build()
+        self.record( history, [ 100, 100 ] )
+        self.assertEqual( history.timeout( "shot", "BLENDER" ), None )
+        self.assertEqual( history.expected( "shot", "BLENDER" ), None )
+        self.record( history, [ 100 ] )
+        self.assertEqual( history.timeout( "shot", "BLENDER" ), 300 )
+        self.assertEqual( history.expected( "shot", "BLENDER" ), 100 )
+
+    def test_timeout_is_the_percentile_times_factor(self, ):
+        history = self.build()
+        self.record( history, range( 100, 300, 10 ) )
+        # The 95th percentile of 20 samples is the last
+        self.assertEqual( history.timeout( "shot", "BLENDER" ), 290 * 3.0 )
+
+    def test_timeout_is_clamped(self, ):
+        history = self.build()
+        self.record( history, [ 1, 2, 3 ], scene="quick" )
+        self.record( history, [ 5000, 5000, 5000 ], scene="slow" )
+        self.assertEqual( history.timeout( "quick", "BLENDER" ), 60 )
+        self.assertEqual( history.timeout( "slow", "BLENDER" ), 3600 )
+
+    def test_scenes_and_renderers_are_kept_apart(self, ):
+        history = self.build()
+        self.record( history, [ 100, 100, 100 ], scene="shot", render_type="BLENDER" )
+        self.assertEqual( history.timeout( "shot", "RENDERMAN" ), None )
+        self.assertEqual( history.timeout( "other", "BLENDER" ), None )
+
+    def test_history_survives_a_restart(self, ):
+        self.record( self.build(), [ 100, 200, 300 ] )
+        history = self.build()
+        self.assertEqual( history.timeout( "shot", "BLENDER" ), 900 )
+
+    def test_only_the_newest_samples_count(self, ):
+        history = self.build( max_samples=3 )
+        self.record( history, [ 1000, 1000, 1000, 10, 10, 10 ] )
+        self.assertEqual( history.timeout( "shot", "BLENDER" ), 60 )
+
+    def test_stats_of_the_given_scenes(self, ):
+        history = self.build()
+        self.record( history, [ 100, 100, 100 ], scene="shot" )
+        self.record( history, [ 10 ], scene="other" )
+        self.assertEqual( sorted( stat["scene"] for stat in history.stats() ), [ "other", "shot" ] )
+        stats = history.stats( set( [ ( "shot", "BLENDER" ) ] ) )
+        self.assertEqual( stats, [ { "scene": "shot", "type": "BLENDER", "count": 3, "median": 100, "p95": 100,
+                                     "max": 100, "timeout": 300 } ] )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Reading and rewriting the frame RIBs prman is fed: gzipped RIBs, Display
+redirection and the CropWindow of tiled jobs."""
+import os
+import os.path as osp
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+ROOT = osp.dirname( osp.dirname( osp.abspath( __file__ ) ) )
+if ROOT not in sys.path:
+    sys.path.insert( 0, ROOT )
+
+from renderers import Renderman
+
+RIB = """Format 200 100 1
+CropWindow 0 1 0 1
+Display "beauty.0001.exr" "openexr" "rgba"
+Display "diffuse.0001.exr" "openexr" "Ci"
+WorldBegin
+WorldEnd
+"""
+
+
+class SanitizeRIBTest(unittest.TestCase):
+
+    def setUp(self, ):
+        self.root = tempfile.mkdtemp( prefix="plumage-renderman-" )
+        self.scene_dir = osp.join( self.root, "scene" )
+        self.output_path = osp.join( self.root, "out" )
+        os.makedirs( self.scene_dir )
+        os.makedirs( self.output_path )
+        self.node = Renderman.RenderManNode( **{ "exec": "prman", "config_path": self.root, "scene_path": self.root,
+                                                 "render_path": self.root, "timeout": 0, "attempts": 1,
+                                                 "rmantree": self.root, "tile_overlap": 2 } )
+
+    def tearDown(self, ):
+        shutil.rmtree( self.root, ignore_errors=True )
+
+    def sanitize(self, frame=1):
+        renders = []
+        rib_file = self.node.OpenRIB( self.scene_dir, frame )
+        try:
+            lines = [ line.strip() for line in self.node.SanitizeRIB( rib_file, renders, self.output_path ) ]
+        finally:
+            rib_file.close()
+        return lines, renders
+
+    def write_gzipped(self, path):
+        rib_file = gzip.open( path, 'wb' )
+        try:
+            rib_file.write( RIB )
+        finally:
+            rib_file.close()
+
+    def test_displays_are_redirected(self, ):
+        with open( osp.join( self.scene_dir, "Scene.0001.rib" ), 'w' ) as f:
+            f.write( RIB )
+        lines, renders = self.sanitize()
+        self.assertEqual( renders, [ "beauty.0001.exr", "diffuse.0001.exr" ] )
+        displays = [ line for line in lines if line.startswith( "Display" ) ]
+        self.assertEqual( displays, [ 'Display "{:s}" "openexr" "rgba"'.format( osp.join( self.output_path, "beauty.0001.exr" ) ),
+                                      'Display "+{:s}" "openexr" "Ci"'.format( osp.join( self.output_path, "diffuse.0001.exr" ) ) ] )
+        # Without a region the RIB's own CropWindow stays
+        self.assertTrue( "CropWindow 0 1 0 1" in lines )
+
+    def test_gzipped_rib_is_found_and_read(self, ):
+        self.write_gzipped( osp.join( self.scene_dir, "Scene.0001.rib.gz" ) )
+        self.assertEqual( self.node.RIBPath( self.scene_dir, 1 ), osp.join( self.scene_dir, "Scene.0001.rib.gz" ) )
+        lines, renders = self.sanitize()
+        self.assertEqual( renders, [ "beauty.0001.exr", "diffuse.0001.exr" ] )
+        self.assertEqual( lines[0], "Format 200 100 1" )
+
+    def test_gzipped_rib_is_read_by_its_magic(self, ):
+        self.write_gzipped( osp.join( self.scene_dir, "Scene.0001.rib" ) )
+        lines, renders = self.sanitize()
+        self.assertEqual( lines[-1], "WorldEnd" )
+        self.assertEqual( len(renders), 2 )
+
+    def test_stale_outputs_are_removed(self, ):
+        with open( osp.join( self.scene_dir, "Scene.0001.rib" ), 'w' ) as f:
+            f.write( RIB )
+        stale = osp.join( self.output_path, "beauty.0001.exr" )
+        open( stale, 'w' ).close()
+        self.sanitize()
+        self.assertFalse( osp.exists( stale ) )
+
+    def test_region_replaces_the_crop_window(self, ):
+        with open( osp.join( self.scene_dir, "Scene.0001.rib" ), 'w' ) as f:
+            f.write( RIB )
+        self.node.SetRegion( [ 0.25, 0.5, 0.5, 1.0 ] )
+        lines, renders = self.sanitize()
+        crops = [ line for line in lines if line.startswith( "CropWindow" ) ]
+        # Padded by 2 pixels of the 200x100 Format, not of prman's default 640x480
+        self.assertEqual( crops, [ "CropWindow 0.240000 0.510000 0.480000 1.000000" ] )
+        # Options must come before the world block
+        self.assertEqual( lines.index( crops[0] ) + 1, lines.index( "WorldBegin" ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+"""The durable upload spool, driven by hand: sync() and poll() are called
+directly instead of from the spool's threads."""
+import os
+import os.path as osp
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+ROOT = osp.dirname( osp.dirname( osp.abspath( __file__ ) ) )
+if ROOT not in sys.path:
+    sys.path.insert( 0, ROOT )
+
+from node import uploader
+from node.spool import RenderSpool, MANIFEST
+
+
+class Result(object):
+    """A finished upload of one output."""
+
+    def __init__(self, value):
+        self._value = value
+
+    def ready(self, ):
+        return True
+
+    def get(self, ):
+        return self._value
+
+
+class StubUploader(object):
+    """Finishes every upload at once with the next of outcomes, or with
+    UPLOADED once they run out, and records what it was given."""
+
+    def __init__(self, outcomes=()):
+        self.outcomes = list( outcomes )
+        self.uploads = []
+
+    def upload_render(self, uuid, files, extension, filenames=None):
+        contents = {}
+        for label, handle in files.items():
+            contents[label] = handle.read()
+            handle.close()
+        self.uploads.append( ( uuid, contents ) )
+        outcome = self.outcomes.pop( 0 ) if len(self.outcomes) > 0 else uploader.UPLOADED
+        return uploader.RenderUpload( uuid, dict( ( label, Result( outcome ) ) for label in files ) )
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self, ):
+        self.root = tempfile.mkdtemp( prefix="plumage-spool-" )
+        self.spool_path = osp.join( self.root, "spool" )
+        self.uploader = StubUploader()
+        self.failures = []
+
+    def tearDown(self, ):
+        shutil.rmtree( self.root, ignore_errors=True )
+
+    def build(self, **options):
+        return RenderSpool( self.spool_path, self.uploader,
+                            on_failed=lambda manifest, reason: self.failures.append( ( manifest["uuid"], reason ) ),
+                            **options )
+
+    def output(self, name, content):
+        path = osp.join( self.root, name )
+        with open( path, 'w' ) as f:
+            f.write( content )
+        return path
+
+    def manifest(self, uuid):
+        with open( osp.join( self.spool_path, uuid, MANIFEST ) ) as f:
+            return json.load( f )
+
+    def test_uploads_once_durable(self, ):
+        spool = self.build()
+        spool.submit( "frame-1", { "render": self.output( "a.png", "pixels" ) }, "png", "BLENDER" )
+        self.assertTrue( spool.contains( "frame-1" ) )
+        spool.poll()
+        self.assertEqual( self.uploader.uploads, [] )
+        spool.sync()
+        self.assertEqual( spool.durable(), [ ( "frame-1", None ) ] )
+        self.assertEqual( spool.durable(), [] )
+        self.assertEqual( self.manifest( "frame-1" )["labels"]["render"]["state"], "pending" )
+        spool.poll()
+        self.assertEqual( self.uploader.uploads, [ ( "frame-1", { "render": "pixels" } ) ] )
+        spool.poll()
+        self.assertFalse( spool.contains( "frame-1" ) )
+        self.assertFalse( osp.exists( osp.join( self.spool_path, "frame-1" ) ) )
+
+    def test_recovers_complete_entries(self, ):
+        spool = self.build()
+        spool.submit( "frame-1", { "render": self.output( "a.png", "pixels" ) }, "png", hold=True )
+        spool.sync()
+        # Moved in but never synced, so never acked
+        spool.submit( "frame-2", { "render": self.output( "b.png", "pixels" ) }, "png" )
+        recovered = self.build()
+        self.assertTrue( recovered.contains( "frame-1" ) )
+        self.assertFalse( recovered.contains( "frame-2" ) )
+        self.assertFalse( osp.exists( osp.join( self.spool_path, "frame-2" ) ) )
+        # Post-processing that did not finish is skipped
+        recovered.poll()
+        self.assertEqual( self.uploader.uploads, [ ( "frame-1", { "render": "pixels" } ) ] )
+
+    def test_failed_uploads_back_off(self, ):
+        self.uploader.outcomes = [ uploader.FAILED ] * 3
+        spool = self.build( retry_interval=10, max_retry_interval=25 )
+        spool.submit( "frame-1", { "render": self.output( "a.png", "pixels" ) }, "png" )
+        spool.sync()
+        for attempt, delay in [ ( 1, 10 ), ( 2, 20 ), ( 3, 25 ) ]:
+            spool.retry_now( "frame-1" )
+            spool.poll()
+            before = time.time()
+            spool.poll()
+            spool.sync()
+            manifest = self.manifest( "frame-1" )
+            self.assertEqual( manifest["attempts"], attempt )
+            wait = manifest["next_attempt"] - before
+            self.assertTrue( delay * 0.8 - 1 <= wait <= delay * 1.2, "attempt %d waits %.1f" % ( attempt, wait ) )
+            # Not due yet
+            spool.poll()
+            self.assertEqual( len(self.uploader.uploads), attempt )
+        spool.retry_now( "frame-1" )
+        spool.poll()
+        spool.poll()
+        self.assertFalse( spool.contains( "frame-1" ) )
+
+    def test_held_entries_wait_for_release(self, ):
+        spool = self.build()
+        spool.submit( "frame-1", { "render": self.output( "a.exr", "pixels" ) }, "exr", hold=True )
+        spool.sync()
+        spool.poll()
+        self.assertEqual( self.uploader.uploads, [] )
+        self.assertEqual( spool.outputs( "frame-1" ), { "render": osp.join( self.spool_path, "frame-1", "render.exr" ) } )
+        spool.add_output( "frame-1", "preview", self.output( "preview.jpg", "thumbnail" ) )
+        spool.release( "frame-1" )
+        spool.sync()
+        manifest = self.manifest( "frame-1" )
+        self.assertFalse( manifest["held"] )
+        self.assertEqual( manifest["labels"]["preview"], { "file": "preview.jpg", "state": "pending" } )
+        spool.poll()
+        self.assertEqual( self.uploader.uploads, [ ( "frame-1", { "render": "pixels", "preview": "thumbnail" } ) ] )
+
+    def test_rejected_uploads_are_given_up(self, ):
+        self.uploader.outcomes = [ uploader.REJECTED ]
+        spool = self.build()
+        spool.submit( "frame-1", { "render": self.output( "a.png", "pixels" ) }, "png" )
+        spool.sync()
+        spool.poll()
+        spool.poll()
+        self.assertFalse( spool.contains( "frame-1" ) )
+        self.assertEqual( len(self.failures), 1 )
+        self.assertEqual( self.failures[0][0], "frame-1" )
+        failed = osp.join( self.spool_path, "failed", "frame-1" )
+        self.assertTrue( osp.exists( osp.join( failed, "render.png" ) ) )
+        # Kept for inspection, not picked up again
+        self.assertFalse( self.build().contains( "frame-1" ) )
+
+    def test_gives_up_after_max_attempts(self, ):
+        self.uploader.outcomes = [ uploader.FAILED ] * 2
+        spool = self.build( max_attempts=2 )
+        spool.submit( "frame-1", { "render": self.output( "a.png", "pixels" ) }, "png" )
+        spool.sync()
+        for attempt in range( 2 ):
+            spool.retry_now( "frame-1" )
+            spool.poll()
+            spool.poll()
+        self.assertFalse( spool.contains( "frame-1" ) )
+        self.assertEqual( self.failures, [ ( "frame-1", "2 failed attempts" ) ] )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,266 @@
+"""Splitting frames into regions and stitching the tiles back together,
+including the PNG codec and the renderers' border and crop window math."""
+import os
+import os.path as osp
+import sys
+import math
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+import subprocess
+from distutils.spawn import find_executable
+
+import numpy
+
+ROOT = osp.dirname( osp.dirname( osp.abspath( __file__ ) ) )
+if ROOT not in sys.path:
+    sys.path.insert( 0, ROOT )
+
+from node import tiles
+from renderers import Blender, Renderman
+
+
+def test_image(width, height, channels=3, dtype=numpy.uint8):
+    """An image whose every pixel differs from its neighbours."""
+    limit = 256 if dtype == numpy.uint8 else 65536
+    values = numpy.arange( width * height * channels, dtype=numpy.int64 ) * 7919 % limit
+    return values.astype( dtype ).reshape( height, width, channels )
+
+def render_tile(image, region, overlap, cropped):
+    """What a renderer hands back for region: the region's pixels and
+    overlap pixels past it, either cut out or in an otherwise black frame."""
+    height, width = image.shape[:2]
+    x0, x1, y0, y1 = tiles.region_pixels( region, width, height )
+    if cropped:
+        return image[y0:y1, x0:x1].copy()
+    tile = numpy.zeros_like( image )
+    ys = slice( max( 0, y0 - overlap ), min( height, y1 + overlap ) )
+    xs = slice( max( 0, x0 - overlap ), min( width, x1 + overlap ) )
+    tile[ys, xs] = image[ys, xs]
+    return tile
+
+def filter_rows(raw, stride, kind):
+    """Encodes every row of raw (height x row bytes) with PNG filter kind."""
+    rows = []
+    previous = bytearray( raw.shape[1] )
+    for row in raw:
+        current = bytearray( row.tostring() )
+        out = bytearray( len(current) )
+        for i in range( len(current) ):
+            left = current[i - stride] if i >= stride else 0
+            upper_left = previous[i - stride] if i >= stride else 0
+            predictor = [ 0, left, previous[i], ( left + previous[i] ) >> 1,
+                          tiles.paeth( left, previous[i], upper_left ) ][kind]
+            out[i] = ( current[i] - predictor ) & 0xff
+        rows.append( chr( kind ) + bytes( out ) )
+        previous = current
+    return "".join( rows )
+
+def write_filtered_png(path, pixels, kind):
+    height, width, channels = pixels.shape
+    depth = 16 if pixels.dtype == numpy.uint16 else 8
+    raw = pixels.astype( ">u2" if depth == 16 else numpy.uint8 ).view( numpy.uint8 ).reshape( height, -1 )
+    color = dict( ( count, color ) for color, count in tiles.PNG_CHANNELS.items() )[channels]
+
+    def chunk(name, body):
+        return struct.pack( ">I", len(body) ) + name + body + struct.pack( ">I", zlib.crc32( name + body ) & 0xffffffff )
+
+    with open( path, 'wb' ) as f:
+        f.write( tiles.PNG_SIGNATURE )
+        f.write( chunk( "IHDR", struct.pack( ">IIBBBBB", width, height, depth, color, 0, 0, 0 ) ) )
+        f.write( chunk( "IDAT", zlib.compress( filter_rows( raw, channels * depth // 8, kind ) ) ) )
+        f.write( chunk( "IEND", "" ) )
+
+
+class Struct(object):
+
+    def __init__(self, **fields):
+        self.__dict__.update( fields )
+
+
+class SplitStitchTest(unittest.TestCase):
+
+    def check_round_trip(self, width, height, columns, rows, overlap, cropped):
+        image = test_image( width, height )
+        regions = tiles.split_frame( columns, rows )
+        rendered = [ ( region, render_tile( image, region, overlap, cropped ) ) for region in regions ]
+        numpy.testing.assert_array_equal( tiles.stitch( width, height, rendered ), image )
+
+    def test_regions_partition_the_frame(self, ):
+        for width, height, columns, rows in [ ( 64, 48, 2, 2 ), ( 101, 37, 3, 4 ), ( 7, 5, 7, 5 ), ( 13, 11, 4, 3 ) ]:
+            owners = numpy.zeros( ( height, width ), dtype=int )
+            for region in tiles.split_frame( columns, rows ):
+                x0, x1, y0, y1 = tiles.region_pixels( region, width, height )
+                owners[y0:y1, x0:x1] += 1
+            self.assertTrue( ( owners == 1 ).all(), "%dx%d in %dx%d tiles" % ( width, height, columns, rows ) )
+
+    def test_round_trip_of_uncropped_tiles(self, ):
+        for width, height, columns, rows in [ ( 64, 48, 2, 2 ), ( 101, 37, 3, 4 ), ( 13, 11, 4, 3 ) ]:
+            for overlap in [ 0, 2, 50 ]:
+                self.check_round_trip( width, height, columns, rows, overlap, cropped=False )
+
+    def test_round_trip_of_cropped_tiles(self, ):
+        for width, height, columns, rows in [ ( 64, 48, 2, 2 ), ( 101, 37, 3, 4 ), ( 13, 11, 4, 3 ) ]:
+            self.check_round_trip( width, height, columns, rows, 0, cropped=True )
+
+    def test_uncovered_frame_is_refused(self, ):
+        image = test_image( 20, 10 )
+        regions = tiles.split_frame( 2, 2 )[:3]
+        rendered = [ ( region, render_tile( image, region, 2, False ) ) for region in regions ]
+        self.assertRaises( ValueError, tiles.stitch, 20, 10, rendered )
+        self.assertRaises( ValueError, tiles.stitch, 20, 10, [] )
+
+    def test_tile_of_the_wrong_size_is_refused(self, ):
+        tile = numpy.zeros( ( 5, 7, 3 ), dtype=numpy.uint8 )
+        self.assertRaises( ValueError, tiles.stitch, 20, 10, [ ( [ 0.0, 1.0, 0.0, 1.0 ], tile ) ] )
+
+
+class PNGTest(unittest.TestCase):
+
+    def setUp(self, ):
+        self.root = tempfile.mkdtemp( prefix="plumage-tiles-" )
+
+    def tearDown(self, ):
+        shutil.rmtree( self.root, ignore_errors=True )
+
+    def test_round_trip(self, ):
+        for channels in [ 1, 2, 3, 4 ]:
+            for dtype in [ numpy.uint8, numpy.uint16 ]:
+                image = test_image( 9, 6, channels, dtype )
+                path = osp.join( self.root, "image.png" )
+                tiles.write_png( path, image )
+                loaded = tiles.read_png( path )
+                self.assertEqual( loaded.dtype, dtype )
+                numpy.testing.assert_array_equal( loaded, image )
+
+    def test_every_filter_decodes(self, ):
+        for kind in range( 5 ):
+            for channels, dtype in [ ( 3, numpy.uint8 ), ( 4, numpy.uint16 ), ( 1, numpy.uint8 ) ]:
+                image = test_image( 11, 7, channels, dtype )
+                path = osp.join( self.root, "filtered.png" )
+                write_filtered_png( path, image, kind )
+                numpy.testing.assert_array_equal( tiles.read_png( path ), image, "filter %d" % kind )
+
+    def test_assemble_png_tiles(self, ):
+        image = test_image( 30, 17, 4 )
+        paths = []
+        for index, region in enumerate( tiles.split_frame( 3, 2 ) ):
+            path = osp.join( self.root, "tile_%d.png" % index )
+            tiles.write_png( path, render_tile( image, region, 2, False ) )
+            paths.append( ( region, path ) )
+        output = osp.join( self.root, "frame.png" )
+        tiles.assemble( output, paths )
+        numpy.testing.assert_array_equal( tiles.read_png( output ), image )
+
+    def test_exr_command_pastes_each_region(self, ):
+        regions = tiles.split_frame( 2, 1 )
+        command = tiles.exr_command( "oiiotool", "frame.exr", 101, 37,
+                                     [ ( region, "tile_%d.exr" % index ) for index, region in enumerate( regions ) ] )
+        self.assertEqual( command[:3], [ "oiiotool", "tile_0.exr", "--croptofull" ] )
+        # 50.5 rounds up, so the left tile takes the middle column
+        self.assertEqual( command[3:11], [ "tile_0.exr", "--crop", "51x37+0+0", "--origin", "+0+0", "--swap", "--paste", "+0+0" ] )
+        self.assertEqual( command[11:19], [ "tile_1.exr", "--crop", "50x37+51+0", "--origin", "+0+0", "--swap", "--paste", "+51+0" ] )
+        self.assertEqual( command[-2:], [ "-o", "frame.exr" ] )
+
+    def test_exr_needs_the_frame_size(self, ):
+        self.assertRaises( ValueError, tiles.assemble, "frame.exr", [ ( [ 0.0, 1.0, 0.0, 1.0 ], "tile.exr" ) ] )
+
+
+@unittest.skipIf( find_executable( "oiiotool" ) == None, "oiiotool is not on the PATH" )
+class OIIOToolTest(unittest.TestCase):
+    """Stitches EXR tiles with the real oiiotool, so its geometry arguments
+    (WxH+x+y for --crop, +x+y for --origin and --paste) are checked against
+    the tool itself rather than against what we expect to pass it."""
+
+    def setUp(self, ):
+        self.root = tempfile.mkdtemp( prefix="plumage-oiiotool-" )
+
+    def tearDown(self, ):
+        shutil.rmtree( self.root, ignore_errors=True )
+
+    def convert(self, source, output, *arguments):
+        subprocess.check_call( [ "oiiotool", source ] + list( arguments ) + [ "-o", output ] )
+
+    def test_assemble_exr_tiles(self, ):
+        image = test_image( 45, 23 )
+        height, width = image.shape[:2]
+        frame = osp.join( self.root, "frame.png" )
+        tiles.write_png( frame, image )
+        paths = []
+        for index, region in enumerate( tiles.split_frame( 3, 2 ) ):
+            path = osp.join( self.root, "tile_%d.exr" % index )
+            if index % 2 == 0:
+                # Cropped to its region and overlap, as prman writes them
+                x0, x1, y0, y1 = tiles.region_pixels( region, width, height )
+                x0, y0 = max( 0, x0 - 2 ), max( 0, y0 - 2 )
+                x1, y1 = min( width, x1 + 2 ), min( height, y1 + 2 )
+                self.convert( frame, path, "--crop", "{:d}x{:d}+{:d}+{:d}".format( x1 - x0, y1 - y0, x0, y0 ) )
+            else:
+                tile = osp.join( self.root, "tile_%d.png" % index )
+                tiles.write_png( tile, render_tile( image, region, 2, False ) )
+                self.convert( tile, path )
+            paths.append( ( region, path ) )
+        output = osp.join( self.root, "frame.exr" )
+        tiles.assemble_exr( output, paths, width, height )
+        self.assertFalse( osp.exists( output + ".partial.exr" ) )
+        stitched = osp.join( self.root, "stitched.png" )
+        self.convert( output, stitched, "-d", "uint8" )
+        numpy.testing.assert_array_equal( tiles.read_png( stitched ), image )
+
+
+class RendererRegionTest(unittest.TestCase):
+    """The renderers render past their region by tile_overlap pixels, so
+    whatever rounding they apply the tile holds all of its region."""
+
+    def blender_border(self, region, width, height, overlap):
+        namespace = {}
+        exec Blender.REGION_SCRIPT in namespace
+        scene = Struct( render=Struct( resolution_x=width, resolution_y=height, resolution_percentage=100 ) )
+        namespace["set_region"]( scene, region, overlap )
+        return scene.render
+
+    def test_blender_border_flips_and_pads_the_region(self, ):
+        render = self.blender_border( [ 0.25, 0.5, 0.0, 0.5 ], 200, 100, 2 )
+        self.assertTrue( render.use_border )
+        self.assertFalse( render.use_crop_to_border )
+        self.assertAlmostEqual( render.border_min_x, 0.25 - 0.01 )
+        self.assertAlmostEqual( render.border_max_x, 0.5 + 0.01 )
+        # Blender measures from the bottom, the region from the top
+        self.assertAlmostEqual( render.border_min_y, 0.5 - 0.02 )
+        self.assertAlmostEqual( render.border_max_y, 1.0 )
+
+    def test_blender_border_holds_its_region(self, ):
+        for width, height, columns, rows in [ ( 1920, 1080, 3, 3 ), ( 101, 37, 4, 3 ), ( 13, 11, 4, 3 ) ]:
+            for region in tiles.split_frame( columns, rows ):
+                render = self.blender_border( region, width, height, 2 )
+                self.assertTrue( 0.0 <= render.border_min_x < render.border_max_x <= 1.0 )
+                self.assertTrue( 0.0 <= render.border_min_y < render.border_max_y <= 1.0 )
+                x0, x1, y0, y1 = tiles.region_pixels( region, width, height )
+                # Rendered rows from the top, whichever way Blender rounds
+                top = int( math.ceil( ( 1.0 - render.border_max_y ) * height ) )
+                bottom = int( math.floor( ( 1.0 - render.border_min_y ) * height ) )
+                self.assertTrue( int( math.ceil( render.border_min_x * width ) ) <= x0 )
+                self.assertTrue( int( math.floor( render.border_max_x * width ) ) >= x1 )
+                self.assertTrue( top <= y0 and bottom >= y1 )
+
+    def test_renderman_crop_window_holds_its_region(self, ):
+        node = Renderman.RenderManNode( **{ "exec": "prman", "config_path": "/tmp", "scene_path": "/tmp",
+                                            "timeout": 0, "attempts": 1, "rmantree": "/tmp", "tile_overlap": 2 } )
+        for width, height, columns, rows in [ ( 1920, 1080, 3, 3 ), ( 101, 37, 4, 3 ), ( 13, 11, 4, 3 ) ]:
+            for region in tiles.split_frame( columns, rows ):
+                node.SetRegion( region )
+                words = node.CropWindow( width, height ).split()
+                self.assertEqual( words[0], "CropWindow" )
+                xmin, xmax, ymin, ymax = [ float(word) for word in words[1:] ]
+                x0, x1, y0, y1 = tiles.region_pixels( region, width, height )
+                # prman renders the pixels from ceil(res * min) to ceil(res * max) - 1
+                self.assertTrue( int( math.ceil( xmin * width ) ) <= x0 )
+                self.assertTrue( int( math.ceil( xmax * width ) ) >= x1 )
+                self.assertTrue( int( math.ceil( ymin * height ) ) <= y0 )
+                self.assertTrue( int( math.ceil( ymax * height ) ) >= y1 )
+
+
+if __name__ == "__main__":
+    unittest.main()